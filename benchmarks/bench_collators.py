@@ -0,0 +1,110 @@
+"""
+Collate throughput of SimpleTodTrainingCollator on the rows of a prepared data
+file, compared with the per item collator it replaced, which is kept here as
+the reference. Both must produce the same batches.
+
+    python benchmarks/bench_collators.py processed_data/simple_tod/train/<data file>.csv --max-token-len 700
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import torch
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from simple_tod_collators import SimpleTodTrainingCollator
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+import utils
+
+
+def per_item_collator(collator: SimpleTodTrainingCollator, batch, is_pretrain=False):
+    input_ids, attention_masks, labels = [], [], []
+    for item in batch:
+        context_tokens, target_tokens, schema_tokens = [
+            collator.train_tokenizer(text)[0] for text in (item.context, item.target, item.schema)
+        ]
+        context_len = len(context_tokens)
+        target_len = len(target_tokens)
+        schema_len = len(schema_tokens)
+        unused_len = collator.max_token_len - context_len - target_len - schema_len
+        if unused_len < 0:
+            context_start_tokens = context_tokens[:2]
+            trimmed_context = context_tokens[unused_len * -1 + 2 :]
+            context_tokens = torch.cat([context_start_tokens, trimmed_context], axis=0)
+            context_len = len(context_tokens)
+            unused_len = 0
+        pad = torch.full([unused_len], collator.pad_token_id)
+        input_tokens = torch.cat([context_tokens, schema_tokens, target_tokens, pad])
+        if is_pretrain:
+            label = input_tokens
+        else:
+            label = torch.cat(
+                [
+                    torch.full([context_len + schema_len], -100),
+                    target_tokens,
+                    torch.full([unused_len], -100),
+                ]
+            )
+        attention_mask = torch.cat(
+            [
+                torch.full([context_len + schema_len + target_len], 1),
+                torch.full([unused_len], 0),
+            ]
+        )
+        input_ids.append(input_tokens)
+        attention_masks.append(attention_mask)
+        labels.append(label)
+    return {
+        "input_ids": torch.stack(input_ids),
+        "attention_mask": torch.stack(attention_masks),
+        "labels": torch.stack(labels),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_file")
+    parser.add_argument("--model-name", default="gpt2")
+    parser.add_argument("--max-token-len", type=int, default=700)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-batches", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = utils.read_csv_dataclass(args.data_file, SimpleTodTurnCsvRow)
+    batches = [
+        rows[i : i + args.batch_size]
+        for i in range(0, len(rows), args.batch_size)
+    ][: args.num_batches]
+    tokenizer = dstc_utils.get_tokenizer(args.model_name)
+    training_collators = [
+        SimpleTodTrainingCollator(tokenizer, args.max_token_len, is_pretrain=is_pretrain)
+        for is_pretrain in (False, True)
+    ]
+
+    for collator in training_collators:
+        for batch in batches:
+            expected = per_item_collator(collator, batch, collator.is_pretrain)
+            actual = collator(batch)
+            assert all(torch.equal(expected[k], actual[k]) for k in expected)
+
+    num_rows = sum(len(b) for b in batches)
+    collators = {
+        "per item": lambda: [per_item_collator(training_collators[0], b) for b in batches],
+        "training_collator": lambda: [training_collators[0](b) for b in batches],
+    }
+    times = {}
+    for name, fn in collators.items():
+        times[name] = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print(
+            f"{name:>18}: {times[name] * 1000:8.1f} ms for {len(batches)} batches, "
+            f"{num_rows / times[name]:8.0f} rows/s"
+        )
+    print(f"speedup: {times['per item'] / times['training_collator']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+CPU throughput of continuous batching against the static test batches, where
+every batch decodes until its longest row stopped. Rows stop at the end token
+of their task and at the task generation budgets from the targets of a train
+data file, so the rows of a batch stop at different steps. Continuous batching
+decodes test_batch_size rows at a time like the static batches, its outputs are
+checked against the shared prefix generation, which is greedy on every row.
+Uses a small randomly initialized GPT-2 unless a model is given.
+
+    python benchmarks/bench_continuous_batching.py processed_data/simple_tod/test/<data file>.csv --train-file processed_data/simple_tod/train/<data file>.csv
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import GPT2Config, GPT2LMHeadModel
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from hydra_configs import InferenceConfig
+from inference import Inference
+from my_enums import GenerationModes
+from my_datamodules import SimpleTodDataSet
+from simple_tod_collators import SimpleTodTestCollator
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+from task_generation_budgets import TaskGenerationBudgets
+import utils
+
+
+def get_model(args, tokenizer) -> GPT2LMHeadModel:
+    if args.model:
+        return GPT2LMHeadModel.from_pretrained(args.model)
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=args.max_token_len + args.new_tokens,
+        n_embd=args.n_embd,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+        # with tied embeddings a random model repeats the eos at the end of the context
+        tie_word_embeddings=False,
+    )
+    return GPT2LMHeadModel(config)
+
+
+def run(inf: Inference, batches: list) -> tuple:
+    generator = inf._get_generator()
+    start = time.perf_counter()
+    gens = [gen for _, gen in inf._generate_batches(batches, generator)]
+    seconds = time.perf_counter() - start
+    num_forward_rows = generator.num_encoded_tokens if generator else None
+    return gens, seconds, num_forward_rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_file")
+    parser.add_argument("--train-file", required=True)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--model-name", default="gpt2")
+    parser.add_argument("--max-token-len", type=int, default=256)
+    parser.add_argument("--new-tokens", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=30)
+    parser.add_argument("--num-batches", type=int, default=4)
+    parser.add_argument(
+        "--generation-modes",
+        nargs="+",
+        default=[
+            GenerationModes.BATCH.value,
+            GenerationModes.SHARED_PREFIX.value,
+            GenerationModes.CONTINUOUS.value,
+        ],
+    )
+    parser.add_argument("--n-layer", type=int, default=2)
+    parser.add_argument("--n-embd", type=int, default=128)
+    parser.add_argument("--n-head", type=int, default=4)
+    args = parser.parse_args()
+
+    tokenizer = dstc_utils.get_tokenizer(args.model_name)
+    rows = utils.read_csv_dataclass(args.data_file, SimpleTodTurnCsvRow)
+    rows = rows[: args.batch_size * args.num_batches]
+    train_rows = utils.iter_csv_dataclass(args.train_file, SimpleTodTurnCsvRow)
+    cfg = InferenceConfig(
+        project_root=os.getcwd(),
+        model=get_model(args, tokenizer),
+        tokenizer=tokenizer,
+        max_token_len=args.max_token_len,
+        generate_max_len=args.max_token_len + args.new_tokens,
+        test_batch_size=args.batch_size,
+        predictions_log_dir=tempfile.mkdtemp(),
+        device="cpu",
+        is_multi_task=True,
+        should_stop_at_task_end=True,
+    )
+    cfg.task_budgets = TaskGenerationBudgets.from_rows(train_rows, tokenizer)
+    # only the generation is timed, so the metrics are not loaded
+    inf = Inference.__new__(Inference)
+    inf.cfg = cfg
+    loader = DataLoader(
+        SimpleTodDataSet(rows),
+        batch_size=args.batch_size,
+        collate_fn=SimpleTodTestCollator(tokenizer, args.max_token_len),
+    )
+    batches = list(loader)
+
+    outputs = {}
+    for mode in args.generation_modes:
+        cfg.generation_mode = GenerationModes(mode)
+        gens, seconds, num_forward_rows = run(inf, batches)
+        outputs[mode] = [
+            tokens
+            for gen in gens
+            for tokens in gen[:, args.max_token_len :].tolist()
+        ]
+        num_tokens = sum(
+            t != tokenizer.pad_token_id for tokens in outputs[mode] for t in tokens
+        )
+        print(
+            f"{mode:>13}: {len(rows) / seconds:8.2f} turns/s, "
+            f"{num_tokens / seconds:8.1f} generated tokens/s, "
+            f"forward rows {num_forward_rows if num_forward_rows is not None else '-':>6}"
+        )
+
+    shared_prefix = outputs.get(GenerationModes.SHARED_PREFIX.value)
+    continuous = outputs.get(GenerationModes.CONTINUOUS.value)
+    if shared_prefix and continuous:
+        strip = lambda tokens: [t for t in tokens if t != tokenizer.pad_token_id]
+        num_different = sum(
+            strip(a) != strip(b) for a, b in zip(shared_prefix, continuous)
+        )
+        print(f"rows where continuous differs from shared_prefix: {num_different}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+CPU throughput of the generation that Inference.test runs for every test
+batch, in turns and generated tokens per second, for a few intra op thread
+counts and the generation modes. Uses a small randomly initialized GPT-2
+unless a model is given, the test rows come from a prepared data file.
+
+    python benchmarks/bench_cpu_inference.py processed_data/simple_tod/test/<data file>.csv --threads 1 2 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import GPT2Config, GPT2LMHeadModel
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from hydra_configs import InferenceConfig
+from inference import Inference
+from my_enums import GenerationModes
+from my_datamodules import SimpleTodDataSet
+from simple_tod_collators import SimpleTodTestCollator
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+import utils
+
+
+def get_model(args, tokenizer) -> GPT2LMHeadModel:
+    if args.model:
+        return GPT2LMHeadModel.from_pretrained(args.model)
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=args.max_token_len + args.new_tokens,
+        n_embd=args.n_embd,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+    )
+    return GPT2LMHeadModel(config)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_file")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--model-name", default="gpt2")
+    parser.add_argument("--max-token-len", type=int, default=256)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--num-batches", type=int, default=4)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--interop-threads", type=int, default=0)
+    parser.add_argument(
+        "--generation-modes", nargs="+", default=[m.value for m in GenerationModes]
+    )
+    parser.add_argument("--n-layer", type=int, default=2)
+    parser.add_argument("--n-embd", type=int, default=128)
+    parser.add_argument("--n-head", type=int, default=4)
+    args = parser.parse_args()
+
+    tokenizer = dstc_utils.get_tokenizer(args.model_name)
+    rows = utils.read_csv_dataclass(args.data_file, SimpleTodTurnCsvRow)
+    rows = rows[: args.batch_size * args.num_batches]
+    cfg = InferenceConfig(
+        project_root=os.getcwd(),
+        model=get_model(args, tokenizer),
+        tokenizer=tokenizer,
+        max_token_len=args.max_token_len,
+        generate_max_len=args.max_token_len + args.new_tokens,
+        predictions_log_dir=tempfile.mkdtemp(),
+        device="cpu",
+        num_interop_threads=args.interop_threads,
+    )
+    # only the generation is timed, so the metrics are not loaded
+    inf = Inference.__new__(Inference)
+    inf.cfg = cfg
+    loader = DataLoader(
+        SimpleTodDataSet(rows),
+        batch_size=args.batch_size,
+        collate_fn=SimpleTodTestCollator(tokenizer, args.max_token_len),
+    )
+    batches = list(loader)
+    inf._generate(batches[0], inf._get_generator())
+
+    for mode in args.generation_modes:
+        cfg.generation_mode = GenerationModes(mode)
+        for num_threads in args.threads:
+            dstc_utils.set_cpu_threads(num_threads)
+            num_tokens = 0
+            generator = inf._get_generator()
+            start = time.perf_counter()
+            for _, gen in inf._generate_batches(batches, generator):
+                new_tokens = gen[:, args.max_token_len :]
+                num_tokens += (new_tokens != tokenizer.pad_token_id).sum().item()
+            seconds = time.perf_counter() - start
+            print(
+                f"{mode:>13}, threads {num_threads:>2}: {len(rows) / seconds:8.2f} turns/s, "
+                f"{num_tokens / seconds:8.1f} generated tokens/s, "
+                f"{num_tokens / len(rows):5.1f} new tokens/turn"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Private dirty memory a forked dataloader worker gains over one epoch, with the
+rows in a python list and in the arrays of SimpleTodArrayDataSet. Refcount and
+garbage collector writes copy the shared pages of the list, so its worker grows
+with the split, while the arrays are only read. Single runs are noisy, the
+median of several epochs is reported. Needs linux and forked workers.
+
+    python benchmarks/bench_dataset_worker_memory.py --num-rows 100000 --epochs 5
+"""
+import argparse
+import os
+import statistics
+import sys
+from typing import Iterator
+
+from torch.utils.data import DataLoader, Dataset
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+from my_datamodules import SimpleTodArrayDataSet, SimpleTodDataSet
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+
+
+def get_private_dirty_mb() -> float:
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Private_Dirty:"):
+                return int(line.split()[1]) / 1024
+
+
+def get_worker_growth_mb(dataset: Dataset) -> float:
+    # the collator runs in the worker, after the rows of the batch were read
+    loader = DataLoader(
+        dataset,
+        batch_size=1000,
+        num_workers=1,
+        collate_fn=lambda batch: get_private_dirty_mb(),
+    )
+    memory = list(loader)
+    return memory[-1] - memory[0]
+
+
+def get_rows(num_rows: int) -> Iterator[SimpleTodTurnCsvRow]:
+    for i in range(num_rows):
+        yield SimpleTodTurnCsvRow(
+            f"{i}_00000", str(i % 20), f"<|context|> user {i} " * 20, f"target {i} " * 10
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-rows", type=int, default=100000)
+    parser.add_argument("--epochs", type=int, default=5)
+    args = parser.parse_args()
+
+    # no list of rows is alive while the array dataset is measured, the garbage
+    # collector of the worker would copy its pages too
+    array_dataset = SimpleTodArrayDataSet(get_rows(args.num_rows))
+    array_growth = [get_worker_growth_mb(array_dataset) for _ in range(args.epochs)]
+    del array_dataset
+    list_dataset = SimpleTodDataSet(list(get_rows(args.num_rows)))
+    list_growth = [get_worker_growth_mb(list_dataset) for _ in range(args.epochs)]
+    for name, growth in (("list", list_growth), ("array", array_growth)):
+        print(
+            f"{name:>5} worker growth over an epoch, median {statistics.median(growth):7.1f} MB, "
+            f"runs {' '.join(f'{g:.1f}' for g in growth)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Per turn latency of the five multi task rows of a long synthetic dialogue,
+with the shared prefix generator, which encodes the context of every turn,
+and the incremental dialogue generator, which keeps the keys and values of
+the history between turns. Contexts are rendered like the prepared data,
+with a sliding window of num_turns turns.
+
+    python benchmarks/bench_dialogue_kv_cache.py --dialogue-turns 40 --num-turns 26
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from simple_tod_collators import SimpleTodTestCollator
+from simple_tod_dataclasses import (
+    SimpleTodTurnCsvRow,
+    get_multi_task_special_tokens,
+    render_context,
+    render_context_turn,
+)
+from simple_tod_generation import IncrementalDialogueGenerator, SharedPrefixGenerator
+
+
+def get_utterance(words: list[str], num_words: int) -> str:
+    return " ".join(random.choice(words) for _ in range(num_words))
+
+
+def get_dialogue_turns(args) -> list[list[SimpleTodTurnCsvRow]]:
+    random.seed(0)
+    words = ["book", "a", "table", "for", "two", "at", "seven", "in", "the", "city"]
+    pairs = [
+        (get_utterance(words, args.utterance_words), get_utterance(words, args.utterance_words))
+        for _ in range(args.dialogue_turns)
+    ]
+    turns = []
+    for turn in range(args.dialogue_turns):
+        history = "".join(
+            render_context_turn(user, system)
+            for user, system in pairs[max(0, turn - args.num_turns) : turn]
+        )
+        context = render_context(history, pairs[turn][0], False)
+        turns.append(
+            [
+                SimpleTodTurnCsvRow("1", str(turn + 1), context + mtst.prompt_token, "")
+                for mtst in get_multi_task_special_tokens()
+            ]
+        )
+    return turns
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", default="gpt2")
+    parser.add_argument("--dialogue-turns", type=int, default=40)
+    parser.add_argument("--num-turns", type=int, default=26)
+    parser.add_argument("--utterance-words", type=int, default=12)
+    parser.add_argument("--max-token-len", type=int, default=2048)
+    parser.add_argument("--new-tokens", type=int, default=8)
+    parser.add_argument("--report-every", type=int, default=5)
+    parser.add_argument("--n-layer", type=int, default=2)
+    parser.add_argument("--n-embd", type=int, default=128)
+    parser.add_argument("--n-head", type=int, default=4)
+    args = parser.parse_args()
+
+    tokenizer = dstc_utils.get_tokenizer(args.model_name)
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(
+            vocab_size=len(tokenizer),
+            n_positions=args.max_token_len + args.new_tokens,
+            n_embd=args.n_embd,
+            n_layer=args.n_layer,
+            n_head=args.n_head,
+        )
+    ).eval()
+    collator = SimpleTodTestCollator(tokenizer, args.max_token_len)
+    batches = [collator(rows) for rows in get_dialogue_turns(args)]
+
+    latencies = {}
+    encoded = {}
+    for generator_class in (SharedPrefixGenerator, IncrementalDialogueGenerator):
+        generator = generator_class(
+            model, tokenizer.eos_token_id, tokenizer.pad_token_id, args.new_tokens
+        )
+        latencies[generator_class.__name__] = []
+        for batch in batches:
+            start = time.perf_counter()
+            generator.generate(
+                batch.context_tokens,
+                batch.context_attention_masks,
+                list(zip(batch.dialog_ids, batch.turn_ids)),
+            )
+            latencies[generator_class.__name__].append(time.perf_counter() - start)
+        encoded[generator_class.__name__] = generator.num_encoded_tokens
+
+    print(f"{'turn':>4} {'context tokens':>14} " + " ".join(f"{n:>30}" for n in latencies))
+    for turn in range(0, args.dialogue_turns, args.report_every):
+        context_len = batches[turn].context_attention_masks[0].sum().item()
+        print(
+            f"{turn + 1:>4} {context_len:>14} "
+            + " ".join(f"{l[turn] * 1000:>27.1f} ms" for l in latencies.values())
+        )
+    print(f"{'encoded tokens':>19} " + " ".join(f"{n:>30}" for n in encoded.values()))
+
+
+if __name__ == "__main__":
+    main()
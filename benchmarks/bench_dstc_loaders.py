@@ -0,0 +1,42 @@
+"""
+Compares building DstcDialog objects through dataclasses_json
+(json.dumps + from_json, the old data prep path) with from_raw_dict.
+
+    python benchmarks/bench_dstc_loaders.py data/dstc8-schema-guided-dialogue/train/dialogues_001.json
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+from dstc_dataclasses import DstcDialog
+import utils
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dialog_file")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    dialogs = utils.read_json(args.dialog_file)
+    num_turns = sum(len(d["turns"]) for d in dialogs)
+    paths = {
+        "from_json": lambda: [DstcDialog.from_json(json.dumps(d)) for d in dialogs],
+        "from_raw_dict": lambda: [DstcDialog.from_raw_dict(d) for d in dialogs],
+    }
+    times = {}
+    for name, fn in paths.items():
+        times[name] = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print(
+            f"{name:>14}: {times[name] * 1000:8.2f} ms for {len(dialogs)} dialogs, "
+            f"{num_turns / times[name]:10.0f} turns/s"
+        )
+    print(f"speedup: {times['from_json'] / times['from_raw_dict']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
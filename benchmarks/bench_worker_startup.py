@@ -0,0 +1,91 @@
+"""
+Time until the first batch of a spawned dataloader worker, with the collator
+passed as a standalone object and as a bound datamodule method, the way the
+collators were passed before. A bound method pickles the whole datamodule,
+including every split in cfg.datasets.
+
+    python benchmarks/bench_worker_startup.py --num-rows 200000
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+
+from torch.utils.data import DataLoader
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from hydra_configs import DataModuleConfig
+from my_datamodules import SimpleTodDataModule, SimpleTodDataSet
+from my_enums import Steps
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+
+
+class BoundDataModuleCollator:
+    """Pickles like the bound datamodule methods that were used as collate_fn"""
+
+    def __init__(self, dm: SimpleTodDataModule):
+        self.dm = dm
+
+    def __call__(self, batch):
+        return self.dm.get_training_collator()(batch)
+
+
+def get_rows(num_rows: int) -> list[SimpleTodTurnCsvRow]:
+    return [
+        SimpleTodTurnCsvRow(
+            f"{i}_00000", str(i % 20), f"<|context|> user {i} " * 20, f"target {i} " * 10
+        )
+        for i in range(num_rows)
+    ]
+
+
+def time_first_batch(dataset, collate_fn, num_workers: int) -> float:
+    start = time.perf_counter()
+    loader = DataLoader(
+        dataset,
+        batch_size=8,
+        num_workers=num_workers,
+        collate_fn=collate_fn,
+        multiprocessing_context="spawn",
+    )
+    next(iter(loader))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", default="gpt2")
+    parser.add_argument("--num-rows", type=int, default=200000)
+    parser.add_argument("--num-workers", type=int, default=2)
+    args = parser.parse_args()
+
+    cfg = DataModuleConfig(
+        project_root=os.getcwd(), tokenizer=dstc_utils.get_tokenizer(args.model_name)
+    )
+    # the collators only need the config, so the data is not prepared
+    dm = SimpleTodDataModule.__new__(SimpleTodDataModule)
+    dm.cfg = cfg
+    dm.token_cache = None
+    rows = get_rows(args.num_rows)
+    for step in Steps.list():
+        cfg.datasets[step] = SimpleTodDataSet(rows)
+    dataset = SimpleTodDataSet(rows[:1000])
+
+    collators = {
+        "bound method": BoundDataModuleCollator(dm),
+        "collator": dm.get_training_collator(),
+    }
+    for name, collate_fn in collators.items():
+        size = len(pickle.dumps(collate_fn)) / 2**20
+        seconds = time_first_batch(dataset, collate_fn, args.num_workers)
+        print(
+            f"{name:>12}: pickled {size:8.2f} MB, first batch of "
+            f"{args.num_workers} spawned workers in {seconds:6.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+How often rows of prepared data files overflow max_token_len and how many
+tokens are kept with the tokens and turns context truncation modes. Pass the
+data files of several num_turns settings to compare them. A cut utterance is
+a truncated row whose context no longer starts at a turn.
+
+    python benchmarks/context_truncation_report.py processed_data/simple_tod/train/*.csv --max-token-len 512
+"""
+import argparse
+import os
+import re
+import sys
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from my_enums import ContextTruncation
+from simple_tod_collators import SimpleTodTrainingCollator
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+import utils
+
+
+def get_num_turns(data_file: str) -> str:
+    match = re.search(r"turns_(\d+)", os.path.basename(data_file))
+    return match.group(1) if match else "?"
+
+
+def report(data_file: str, collators: dict, batch_size: int = 1000) -> dict:
+    rows = list(utils.iter_csv_dataclass(data_file, SimpleTodTurnCsvRow))
+    any_collator = next(iter(collators.values()))
+    stats = {mode: {"tokens": 0, "cut": 0} for mode in collators}
+    num_truncated = 0
+    for start in range(0, len(rows), batch_size):
+        items = any_collator.get_batch_tokens(rows[start : start + batch_size])
+        for context_tokens, target_tokens, schema_tokens in items:
+            other_len = len(target_tokens) + len(schema_tokens)
+            overflow = len(context_tokens) + other_len - any_collator.max_token_len
+            if overflow <= 0:
+                for mode in collators:
+                    stats[mode]["tokens"] += len(context_tokens) + other_len
+                continue
+            num_truncated += 1
+            for mode, collator in collators.items():
+                # the report reads csv rows, so the turn starts are found here
+                # instead of read from a tokenized shard
+                context = collator.truncate_context(
+                    context_tokens,
+                    overflow,
+                    collator.get_context_turn_starts(context_tokens),
+                )
+                stats[mode]["tokens"] += len(context) + other_len
+                if context[2] not in collator.turn_token_ids:
+                    stats[mode]["cut"] += 1
+    return {"rows": len(rows), "truncated": num_truncated, "modes": stats}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_files", nargs="+")
+    parser.add_argument("--model-name", default="gpt2")
+    parser.add_argument("--max-token-len", type=int, default=512)
+    args = parser.parse_args()
+
+    tokenizer = dstc_utils.get_tokenizer(args.model_name)
+    collators = {
+        mode.value: SimpleTodTrainingCollator(
+            tokenizer, args.max_token_len, context_truncation=mode
+        )
+        for mode in ContextTruncation
+    }
+    print(
+        f"{'num_turns':>9} {'rows':>8} {'truncated':>9} "
+        + " ".join(f"{'kept/' + mode:>12} {'cut/' + mode:>10}" for mode in collators)
+    )
+    for data_file in args.data_files:
+        result = report(data_file, collators)
+        rows = max(result["rows"], 1)
+        truncated = max(result["truncated"], 1)
+        print(
+            f"{get_num_turns(data_file):>9} {result['rows']:>8} "
+            f"{result['truncated'] / rows:>9.1%} "
+            + " ".join(
+                f"{stats['tokens'] / rows:>12.1f} {stats['cut'] / truncated:>10.1%}"
+                for stats in result["modes"].values()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
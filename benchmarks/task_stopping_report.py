@@ -0,0 +1,145 @@
+"""
+Generated tokens per multi task prompt with and without stopping rows at the
+end token of their task and at the task generation budgets, and the time the
+generation takes. The budgets come from the targets of a train data file, or
+from a saved budgets json. Uses a small randomly initialized GPT-2 unless a
+model is given, a random model rarely generates the end tokens, so most of its
+savings come from the budgets.
+
+    python benchmarks/task_stopping_report.py processed_data/simple_tod/test/<data file>.csv --train-file processed_data/simple_tod/train/<data file>.csv
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import GPT2Config, GPT2LMHeadModel
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from hydra_configs import InferenceConfig
+from inference import Inference
+from my_enums import GenerationModes
+from my_datamodules import SimpleTodDataSet
+from simple_tod_collators import SimpleTodTestCollator
+from simple_tod_dataclasses import SimpleTodTurnCsvRow, get_multi_task_special_tokens
+from task_generation_budgets import TaskGenerationBudgets
+import utils
+
+
+def get_model(args, tokenizer) -> GPT2LMHeadModel:
+    if args.model:
+        return GPT2LMHeadModel.from_pretrained(args.model)
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=args.max_token_len + args.new_tokens,
+        n_embd=args.n_embd,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+        # with tied embeddings a random model repeats the eos at the end of the context
+        tie_word_embeddings=False,
+    )
+    return GPT2LMHeadModel(config)
+
+
+def get_task(context: str) -> str:
+    for mtst in get_multi_task_special_tokens():
+        if context.endswith(mtst.prompt_token):
+            return mtst.prompt_token.value
+    return "single task"
+
+
+def get_task_budgets(args, tokenizer) -> TaskGenerationBudgets:
+    if args.budgets:
+        return TaskGenerationBudgets.load(args.budgets)
+    if args.train_file:
+        rows = utils.iter_csv_dataclass(args.train_file, SimpleTodTurnCsvRow)
+        return TaskGenerationBudgets.from_rows(rows, tokenizer, args.quantile)
+    return None
+
+
+def run(inf: Inference, batches: list, pad_token_id: int) -> tuple:
+    new_tokens = defaultdict(list)
+    generator = inf._get_generator()
+    start = time.perf_counter()
+    for batch, gen in inf._generate_batches(batches, generator):
+        counts = (gen[:, inf.cfg.max_token_len :] != pad_token_id).sum(dim=1)
+        for context, count in zip(batch.contexts_text, counts.tolist()):
+            new_tokens[get_task(context)].append(count)
+    return new_tokens, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_file")
+    parser.add_argument("--train-file", default=None)
+    parser.add_argument("--budgets", default=None)
+    parser.add_argument("--quantile", type=float, default=1.0)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--model-name", default="gpt2")
+    parser.add_argument("--max-token-len", type=int, default=256)
+    parser.add_argument("--new-tokens", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--num-batches", type=int, default=4)
+    parser.add_argument("--generation-mode", default=GenerationModes.SHARED_PREFIX.value)
+    parser.add_argument("--n-layer", type=int, default=2)
+    parser.add_argument("--n-embd", type=int, default=128)
+    parser.add_argument("--n-head", type=int, default=4)
+    args = parser.parse_args()
+
+    tokenizer = dstc_utils.get_tokenizer(args.model_name)
+    rows = utils.read_csv_dataclass(args.data_file, SimpleTodTurnCsvRow)
+    rows = rows[: args.batch_size * args.num_batches]
+    cfg = InferenceConfig(
+        project_root=os.getcwd(),
+        model=get_model(args, tokenizer),
+        tokenizer=tokenizer,
+        max_token_len=args.max_token_len,
+        generate_max_len=args.max_token_len + args.new_tokens,
+        predictions_log_dir=tempfile.mkdtemp(),
+        device="cpu",
+        is_multi_task=True,
+        generation_mode=args.generation_mode,
+    )
+    # only the generation is timed, so the metrics are not loaded
+    inf = Inference.__new__(Inference)
+    inf.cfg = cfg
+    loader = DataLoader(
+        SimpleTodDataSet(rows),
+        batch_size=args.batch_size,
+        collate_fn=SimpleTodTestCollator(tokenizer, args.max_token_len),
+    )
+    batches = list(loader)
+    task_budgets = get_task_budgets(args, tokenizer)
+
+    cfg.should_stop_at_task_end = False
+    full, full_seconds = run(inf, batches, tokenizer.pad_token_id)
+    cfg.should_stop_at_task_end = True
+    cfg.task_budgets = task_budgets
+    stopped, stopped_seconds = run(inf, batches, tokenizer.pad_token_id)
+
+    print(f"{'task':>28} {'rows':>5} {'budget':>6} {'tokens/row':>10} {'stopped':>8} {'saved':>7}")
+    for task, counts in full.items():
+        budget = task_budgets.get(task, args.new_tokens) if task_budgets else args.new_tokens
+        full_tokens, stopped_tokens = sum(counts), sum(stopped[task])
+        print(
+            f"{task:>28} {len(counts):>5} {budget:>6} {full_tokens / len(counts):>10.1f} "
+            f"{stopped_tokens / len(counts):>8.1f} {1 - stopped_tokens / full_tokens:>7.1%}"
+        )
+    full_tokens = sum(map(sum, full.values()))
+    stopped_tokens = sum(map(sum, stopped.values()))
+    print(
+        f"generated tokens {full_tokens} -> {stopped_tokens} "
+        f"({1 - stopped_tokens / full_tokens:.1%} saved), "
+        f"{full_seconds:.2f}s -> {stopped_seconds:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import csv
+import io
+import os
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+import utils
+
+
+class CsvRowIndex:
+    """
+    Byte offsets of the records of a csv file, so a single record can be parsed
+    without reading the rows before it. Offsets come from csv.reader and not
+    from line breaks, since quoted fields span several lines.
+    The index is built once, saved next to the csv file and rebuilt when the
+    csv file changes. Record i is file[offsets[i] : offsets[i + 1]].
+    """
+
+    def __init__(self, csv_path: Path):
+        self.csv_path = Path(csv_path)
+        self.offsets_path = self.csv_path.with_suffix(".row_index.npy")
+        self.meta_path = self.csv_path.with_suffix(".row_index.json")
+        self._file = None
+        self._file_pid = None
+        if not self._load():
+            self._build()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_file_pid"] = None
+        return state
+
+    def _get_file_state(self) -> dict:
+        stat = os.stat(self.csv_path)
+        return {"csv_file_size": stat.st_size, "csv_file_mtime_ns": stat.st_mtime_ns}
+
+    def _load(self) -> bool:
+        try:
+            meta = utils.read_json(self.meta_path)
+        except FileNotFoundError:
+            return False
+        if any(meta.get(k) != v for k, v in self._get_file_state().items()):
+            return False
+        self.header = meta["header"]
+        self.offsets = np.load(self.offsets_path, mmap_mode="r")
+        return True
+
+    def _iter_lines(self, f, position: list[int]) -> Iterator[str]:
+        for line in f:
+            position[0] += len(line)
+            yield line.decode("utf-8")
+
+    def _build(self) -> None:
+        file_state = self._get_file_state()
+        position = [0]
+        with open(self.csv_path, "rb") as f:
+            # csv.reader pulls exactly the lines of a record, so after every
+            # record the position is the start of the next one
+            reader = csv.reader(self._iter_lines(f, position))
+            self.header = next(reader)
+            offsets = [position[0]]
+            for _ in reader:
+                offsets.append(position[0])
+        self.offsets = np.array(offsets, dtype=np.int64)
+        tmp_path = self.offsets_path.with_suffix(".tmp.npy")
+        np.save(tmp_path, self.offsets)
+        os.replace(tmp_path, self.offsets_path)
+        utils.write_json({"header": self.header, **file_state}, self.meta_path)
+
+    def _get_file(self):
+        # forked dataloader workers must not share the position of one handle
+        if self._file is None or self._file_pid != os.getpid():
+            self._file = open(self.csv_path, "rb")
+            self._file_pid = os.getpid()
+        return self._file
+
+    def get(self, idx: int) -> dict[str, str]:
+        f = self._get_file()
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+        # newlines are translated the same way read_csv_dataclass reads them
+        values = next(csv.reader(io.StringIO(text, newline=None)))
+        return dict(zip(self.header, values))
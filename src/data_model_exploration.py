@@ -13,6 +13,7 @@ import dstc_utils
 from hydra_configs import DataModelExplorationConfig, DataModuleConfig
 from my_enums import DstcDomains, Steps
 from my_datamodules import SimpleTodDataModule
+from segment_token_cache import SegmentTokenCache
 from simple_tod_dataclasses import (
     SimpleTodTurnCsvRow,
 )
@@ -36,8 +37,10 @@ class DataModelExploration:
             rows.append(read_csv_dataclass(csv_file_path, SimpleTodTurnCsvRow))
         return np.concatenate(rows, axis=0)
 
-    def plot_model_size(self):
+    def plot_model_size(self) -> str:
+        """Plots the token lengths of the rows, returns the report of the token cache"""
         rows = self._get_simple_tod_rows()
+        token_cache = SegmentTokenCache(self.cfg.tokenizer)
         x_axis = np.arange(1, self.num_turns)
         turns = {
             "token_freq": [],
@@ -49,10 +52,8 @@ class DataModelExploration:
             "turn_target_avg_len": {i: [] for i in range(1, self.num_turns)},
         }
         for row in tqdm(rows):
-            c = self.tokenizer(row.context, return_tensors="pt")
-            t = self.tokenizer(row.target, return_tensors="pt")
-            context_len = c.data["input_ids"].shape[1]
-            target_len = t.data["input_ids"].shape[1]
+            context_len = len(token_cache.encode(row.context))
+            target_len = len(token_cache.encode(row.target))
             text_len = context_len + target_len
 
             turns["token_freq"].append(text_len)
@@ -104,6 +105,7 @@ class DataModelExploration:
             label_name="Target",
             title="Target Max, Avg Length",
         )
+        return token_cache.report()
 
     def _plot_max_avg_graph(
         self,
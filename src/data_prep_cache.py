@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from hydra_configs import DataPrepConfig
+from my_enums import DataFormats
+import utils
+
+# bump when the prepared rows change for the same inputs and config
+DATA_PREP_CACHE_VERSION = 2
+
+
+class DataPrepCache:
+    """
+    Content addressed cache of prepared dialogue files.
+
+    A fragment holds the prepared rows of one raw dialogue file and is keyed by
+    the hash of the prep config fields that change the rows, the schema file and
+    the contents of the dialogue file. File digests are memoized by size and
+    mtime, so unchanged files are not hashed again. The cache directory is kept
+    under max_size_mb by evicting the least recently used fragments whenever a
+    written fragment takes it over.
+    """
+
+    digests_file_name = "file_digests.json"
+
+    def __init__(self, cfg: DataPrepConfig):
+        self.cfg = cfg
+        self.cache_dir: Path = cfg.processed_data_root / "cache"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = cfg.cache_max_size_mb * 1024 * 1024
+        # bytes of the fragments on disk, counted when the first fragment is put
+        self.size: Optional[int] = None
+        self.digests_path = self.cache_dir / self.digests_file_name
+        try:
+            self.file_digests: Dict[str, list] = utils.read_json(self.digests_path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.file_digests = {}
+
+    def _hash(self, *items: str) -> str:
+        return hashlib.sha1("\0".join(items).encode("utf-8")).hexdigest()
+
+    def get_file_digest(self, path: str) -> str:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        memo = self.file_digests.get(path)
+        if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            return memo[2]
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.file_digests[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return self.file_digests[path][2]
+
+    def get_config_key(self, schema_path: Path) -> str:
+        fields = {
+            "version": DATA_PREP_CACHE_VERSION,
+            "is_multi_task": self.cfg.is_multi_task,
+            "should_add_schema": self.cfg.should_add_schema,
+            "should_add_user_actions": self.cfg.should_add_user_actions,
+            "should_add_sys_actions": self.cfg.should_add_sys_actions,
+            "num_turns": self.cfg.num_turns,
+            "delexicalize": self.cfg.delexicalize,
+            "domains": list(self.cfg.domains),
+            "is_normalized": self.cfg.data_format == DataFormats.NORMALIZED,
+            "schema": self.get_file_digest(schema_path),
+        }
+        return self._hash(json.dumps(fields, sort_keys=True))
+
+    def get_fragment_keys(self, config_key: str, dialog_paths: List[str]) -> List[str]:
+        return [self._hash(config_key, self.get_file_digest(p)) for p in dialog_paths]
+
+    def get_split_key(self, fragment_keys: List[str]) -> str:
+        return self._hash(*fragment_keys)
+
+    def _fragment_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.pkl"
+
+    def contains(self, key: str) -> bool:
+        return self._fragment_path(key).exists()
+
+    def get(self, key: str) -> Optional[any]:
+        path = self._fragment_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        # mtime records the last use for lru eviction
+        os.utime(path)
+        return data
+
+    def put(self, key: str, data: any) -> None:
+        """Writes a fragment and evicts when the cache went over max_size_mb"""
+        path = self._fragment_path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.size is None:
+            self.size = self._get_size()
+        self.size += tmp_path.stat().st_size
+        if path.exists():
+            self.size -= path.stat().st_size
+        os.replace(tmp_path, path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def _get_size(self) -> int:
+        return sum(p.stat().st_size for p in self.cache_dir.glob("*.pkl"))
+
+    def evict(self) -> None:
+        fragments = [
+            (p.stat().st_mtime, p.stat().st_size, p)
+            for p in self.cache_dir.glob("*.pkl")
+        ]
+        total_size = sum(size for _, size, _ in fragments)
+        for _, size, path in sorted(fragments):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+        self.size = total_size
+
+    def save(self) -> None:
+        utils.write_json(self.file_digests, self.digests_path)
+        self.evict()
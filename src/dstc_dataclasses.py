@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from functools import cached_property
 from typing import List, Dict, Optional
 from dataclasses_json import dataclass_json
 from enum import Enum
@@ -13,6 +14,12 @@ class DstcState:
     slot_values: Dict[str, list[str]]
     requested_slots: Optional[List[str]] = None
 
+    @classmethod
+    def from_raw_dict(self, d: dict) -> "DstcState":
+        return self(
+            d["active_intent"], d["slot_values"], d.get("requested_slots")
+        )
+
 
 @dataclass
 class DstcAction:
@@ -23,6 +30,17 @@ class DstcAction:
     service_call: Optional[any] = None
     service_results: Optional[any] = None
 
+    @classmethod
+    def from_raw_dict(self, d: dict) -> "DstcAction":
+        return self(
+            d["act"],
+            d["canonical_values"],
+            d["slot"],
+            d["values"],
+            d.get("service_call"),
+            d.get("service_results"),
+        )
+
 
 @dataclass
 class DstcFrame:
@@ -44,6 +62,16 @@ class DstcFrame:
         self.short_service = dstc_utils.get_dstc_service_name(service)
         self.service = service
 
+    @classmethod
+    def from_raw_dict(self, d: dict) -> "DstcFrame":
+        state = d.get("state")
+        return self(
+            [DstcAction.from_raw_dict(a) for a in d["actions"]],
+            d["slots"],
+            d["service"],
+            DstcState.from_raw_dict(state) if state is not None else None,
+        )
+
 
 @dataclass
 class DstcRequestedSlot:
@@ -79,6 +107,14 @@ class DstcTurn:
     speaker: str
     utterance: str
 
+    @classmethod
+    def from_raw_dict(self, d: dict) -> "DstcTurn":
+        return self(
+            [DstcFrame.from_raw_dict(f) for f in d["frames"]],
+            d["speaker"],
+            d["utterance"],
+        )
+
     def get_active_intent(self) -> Optional[str]:
         if self.speaker == Speaker.SYSTEM:
             return None
@@ -120,6 +156,15 @@ class DstcDialog:
         self.short_services = [dstc_utils.get_dstc_service_name(s) for s in services]
         self.services = services
 
+    # dataclass_json replaces from_dict, so the direct loaders use another name
+    @classmethod
+    def from_raw_dict(self, d: dict) -> "DstcDialog":
+        return self(
+            d["dialogue_id"],
+            [DstcTurn.from_raw_dict(t) for t in d["turns"]],
+            d["services"],
+        )
+
 
 @dataclass
 class DstcSchemaIntent:
@@ -146,6 +191,17 @@ class DstcSchemaIntent:
         self.optional_slots = optional_slots
         self.result_slots = result_slots
 
+    @classmethod
+    def from_raw_dict(self, d: dict) -> "DstcSchemaIntent":
+        return self(
+            d["name"],
+            d["description"],
+            d["is_transactional"],
+            d["required_slots"],
+            d["optional_slots"],
+            d["result_slots"],
+        )
+
     def __str__(self):
         return "".join(
             [
@@ -172,6 +228,12 @@ class DstcSchemaSlot:
     is_categorical: bool
     possible_values: List[str]
 
+    @classmethod
+    def from_raw_dict(self, d: dict) -> "DstcSchemaSlot":
+        return self(
+            d["name"], d["description"], d["is_categorical"], d["possible_values"]
+        )
+
     def __eq__(self, slot_name: str) -> bool:
         return self.name == slot_name
 
@@ -199,7 +261,25 @@ class DstcSchema:
     intents: List[DstcSchemaIntent]
     step: Optional[str] = None
 
+    @classmethod
+    def from_raw_dict(self, d: dict) -> "DstcSchema":
+        return self(
+            d["service_name"],
+            d["description"],
+            [DstcSchemaSlot.from_raw_dict(s) for s in d["slots"]],
+            [DstcSchemaIntent.from_raw_dict(i) for i in d["intents"]],
+            d.get("step"),
+        )
+
+    @cached_property
+    def slot_names(self) -> set[str]:
+        return {slot.name for slot in self.slots}
+
     def __str__(self):
+        return self.rendered
+
+    @cached_property
+    def rendered(self) -> str:
         return "".join(
             [
                 SpecialTokens.begin_schema,
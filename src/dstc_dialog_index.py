@@ -0,0 +1,90 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, List
+
+import dstc_utils
+import utils
+
+
+class DstcDialogIndex:
+    """
+    Persistent index of the raw dialogue files of a split. For every file it
+    stores the id, the short service names and the byte range of each dialogue,
+    so prep can skip files without in-domain dialogues and read only the
+    matching dialogues of the other files. Entries are rebuilt when the size or
+    mtime of a file changes.
+    """
+
+    def __init__(self, index_path: Path):
+        self.index_path = index_path
+        try:
+            self.files: Dict[str, dict] = utils.read_json(index_path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.files = {}
+
+    def _get_file_state(self, path: str) -> dict:
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _build_file_entry(self, path: str) -> dict:
+        with open(path, "rb") as f:
+            # latin-1 maps every byte to one character, so string positions are
+            # byte offsets. Ids and service names are ascii and decode unchanged
+            text = f.read().decode("latin-1")
+        decoder = json.JSONDecoder()
+        dialogs = []
+        pos = text.index("[") + 1
+        while True:
+            while text[pos] in " \t\r\n,":
+                pos += 1
+            if text[pos] == "]":
+                break
+            d, end = decoder.raw_decode(text, pos)
+            dialogs.append(
+                [
+                    d["dialogue_id"],
+                    [dstc_utils.get_dstc_service_name(s) for s in d["services"]],
+                    pos,
+                    end - pos,
+                ]
+            )
+            pos = end
+        return {**self._get_file_state(path), "dialogs": dialogs}
+
+    def update(self, paths: List[str]) -> int:
+        """Indexes new and changed files, returns the number of files indexed"""
+        num_indexed = 0
+        for path in map(os.path.abspath, paths):
+            entry = self.files.get(path)
+            state = self._get_file_state(path)
+            if entry and all(entry[k] == v for k, v in state.items()):
+                continue
+            self.files[path] = self._build_file_entry(path)
+            num_indexed += 1
+        return num_indexed
+
+    def save(self) -> None:
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        utils.write_json(self.files, self.index_path)
+
+    def _get_matching_dialogs(self, path: str, domains: List[str]) -> List[list]:
+        return [
+            d
+            for d in self.files[os.path.abspath(path)]["dialogs"]
+            if all(s in domains for s in d[1])
+        ]
+
+    def read_dialogs(self, path: str, domains: List[str]) -> List[dict]:
+        """Parses only the dialogues of a file whose services are all in domains"""
+        dialogs = self._get_matching_dialogs(path, domains)
+        if not dialogs:
+            return []
+        if len(dialogs) == len(self.files[os.path.abspath(path)]["dialogs"]):
+            return utils.read_json(path)
+        out = []
+        with open(path, "rb") as f:
+            for _, _, offset, length in dialogs:
+                f.seek(offset)
+                out.append(json.loads(f.read(length)))
+        return out
@@ -1,12 +1,15 @@
 import glob
+import hashlib
 import re
 from pathlib import Path
 from typing import List, Optional, Union
+import torch
 from transformers import AutoTokenizer, PreTrainedTokenizerFast
 
 from tokenizers.processors import TemplateProcessing
 
 from my_enums import SimpleTodConstants, SpecialTokens
+import utils
 
 
 def get_dstc_service_name(service_name: str) -> str:
@@ -31,6 +34,16 @@ def get_csv_data_path(
     )
 
 
+def get_data_path(
+    step: str = "train",
+    num_dialogs: int = 1,
+    cfg=None,
+) -> Path:
+    return get_csv_data_path(step, num_dialogs, cfg).with_suffix(
+        f".{cfg.data_format}"
+    )
+
+
 def get_tokenizer(model_name: str = "gpt2") -> PreTrainedTokenizerFast:
     tokenizer = AutoTokenizer.from_pretrained(
         model_name,
@@ -50,6 +63,34 @@ def get_tokenizer(model_name: str = "gpt2") -> PreTrainedTokenizerFast:
     return tokenizer
 
 
+def get_device(device: str = "auto") -> torch.device:
+    """auto is cuda when it is available and cpu otherwise"""
+    if device == "auto":
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.device(device)
+
+
+def set_cpu_threads(num_threads: int = 0, num_interop_threads: int = 0) -> None:
+    """Intra op and inter op thread counts of torch on cpu, 0 keeps the default"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # only possible before the first inter op parallel work
+            utils.get_logger().warning(
+                f"Could not set inter op threads to {num_interop_threads}, "
+                f"using {torch.get_num_interop_threads()}"
+            )
+
+
+def get_tokenizer_key(tokenizer: PreTrainedTokenizerFast) -> str:
+    # identifies the vocab, merges, special tokens and post processor
+    serialized = tokenizer.backend_tokenizer.to_str()
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()[:16]
+
+
 def get_token_id(tokenizer: AutoTokenizer, token_str: str) -> int:
     return tokenizer(token_str)["input_ids"][0]
 
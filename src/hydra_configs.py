@@ -1,13 +1,14 @@
 from lib2to3.pgen2.tokenize import tokenize
 import os
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
 from datasets import Dataset
 
 from transformers import AutoTokenizer, GPT2LMHeadModel, GPT2PreTrainedModel
 
-from my_enums import DstcDomains, SpecialTokens, Steps
+from my_enums import DstcDomains, GenerationModes, SpecialTokens, Steps
 import dstc_utils
+from task_generation_budgets import TaskGenerationBudgets
 import utils
 import re
 
@@ -40,6 +41,14 @@ class InferenceConfig:
         target_max_len: int = 424,
         is_multi_task: bool = False,
         should_add_schema: bool = False,
+        data_format: str = "csv",
+        should_use_dialog_index: bool = True,
+        device: str = "auto",
+        num_threads: int = 0,
+        num_interop_threads: int = 0,
+        generation_mode: str = "batch",
+        should_stop_at_task_end: bool = False,
+        task_budgets_path: str = None,
     ) -> None:
         self.num_workers = num_workers
         self.data_split_percent = data_split_percent or [1, 1, 0.1]
@@ -51,6 +60,9 @@ class InferenceConfig:
         self.data_prep_out_root = data_prep_out_root
         self.num_test_dialogs = num_test_dialogs
         self.delexicalize = delexicalize
+        self.device = dstc_utils.get_device(device)
+        if self.device.type == "cpu":
+            dstc_utils.set_cpu_threads(num_threads, num_interop_threads)
         self.model = self._get_model(model)
         self.model_name = model_name
         self.generate_max_len = generate_max_len
@@ -81,13 +93,24 @@ class InferenceConfig:
         self.predictions_log_dir.mkdir(parents=True, exist_ok=True)
         self.is_multi_task = is_multi_task
         self.should_add_schema = should_add_schema
+        self.data_format = data_format
+        self.should_use_dialog_index = should_use_dialog_index
+        self.generation_mode = GenerationModes(generation_mode)
+        self.should_stop_at_task_end = should_stop_at_task_end
         self.logger = utils.get_logger()
         self.tokenizer = (
             self.tokenizer
             if self.tokenizer
             else self._get_tokenizer(model)
         )
-        self.padding_regexp = re.compile(re.escape(SpecialTokens.bos_token))
+        self.task_budgets = self._get_task_budgets(model, task_budgets_path)
+        # generation pads with the pad token, bos can be generated
+        self.padding_regexp = re.compile(
+            "|".join(
+                re.escape(token)
+                for token in [SpecialTokens.bos_token, SpecialTokens.pad_token]
+            )
+        )
 
     def _get_tokenizer(self, model_path_str:str):
         model_path:Path = self.project_root / model_path_str
@@ -100,12 +123,29 @@ class InferenceConfig:
             tokenizer = dstc_utils.get_tokenizer(self.model_name)
         return tokenizer
     
+    def _get_task_budgets(
+        self, model, task_budgets_path: str = None
+    ) -> Optional[TaskGenerationBudgets]:
+        if not self.should_stop_at_task_end:
+            return None
+        if task_budgets_path:
+            path = self.project_root / task_budgets_path
+        elif isinstance(model, str):
+            # saved next to the tokenizer of the trained model
+            path = (self.project_root / model).parent.parent
+        else:
+            return None
+        task_budgets = TaskGenerationBudgets.load(path)
+        if task_budgets is None:
+            self.logger.info(f'Could not find task generation budgets in "{path}"')
+        return task_budgets
+
     def _get_model(self, model):
         if isinstance(model, str):
             model_path = self.project_root / model
-            return GPT2LMHeadModel.from_pretrained(model_path).cuda()
+            return GPT2LMHeadModel.from_pretrained(model_path).to(self.device)
         if isinstance(model, GPT2PreTrainedModel):
-            return model.cuda()
+            return model.to(self.device).eval()
 
 class TrainerConfig:
     def __init__(
@@ -143,6 +183,21 @@ class TrainerConfig:
         should_add_schema: bool = False,
         should_add_user_actions: bool = False,
         should_add_sys_actions: bool = False,
+        should_use_data_prep_cache: bool = False,
+        prep_num_workers: int = 1,
+        should_use_dialog_index: bool = True,
+        data_format: str = "csv",
+        should_use_lazy_csv: bool = False,
+        should_pretokenize: bool = False,
+        should_use_token_cache: bool = False,
+        token_cache_size: int = 100000,
+        should_pad_dynamically: bool = False,
+        pad_to_multiple_of: int = 8,
+        context_truncation: str = "tokens",
+        should_group_by_length: bool = False,
+        should_pack_rows: bool = False,
+        device: str = "auto",
+        should_stop_at_task_end: bool = False,
     ) -> None:
         self.project_root = Path(project_root)
         self.data_prep_out_root = Path(data_prep_out_root)
@@ -180,6 +235,21 @@ class TrainerConfig:
         self.should_add_schema = should_add_schema
         self.should_add_sys_actions = should_add_sys_actions
         self.should_add_user_actions = should_add_user_actions
+        self.should_use_data_prep_cache = should_use_data_prep_cache
+        self.prep_num_workers = prep_num_workers
+        self.should_use_dialog_index = should_use_dialog_index
+        self.data_format = data_format
+        self.should_use_lazy_csv = should_use_lazy_csv
+        self.should_pretokenize = should_pretokenize
+        self.should_use_token_cache = should_use_token_cache
+        self.token_cache_size = token_cache_size
+        self.should_pad_dynamically = should_pad_dynamically
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.context_truncation = context_truncation
+        self.should_group_by_length = should_group_by_length
+        self.should_pack_rows = should_pack_rows
+        self.device = dstc_utils.get_device(device)
+        self.should_stop_at_task_end = should_stop_at_task_end
 
 class DataModelExplorationConfig:
     def __init__(
@@ -239,6 +309,18 @@ class DataModuleConfig:
         should_add_schema: bool = False,
         should_add_sys_actions: bool = False,
         should_add_user_actions: bool = False,
+        should_use_data_prep_cache: bool = False,
+        prep_num_workers: int = 1,
+        should_use_dialog_index: bool = True,
+        data_format: str = "csv",
+        should_use_lazy_csv: bool = False,
+        should_pretokenize: bool = False,
+        should_use_token_cache: bool = False,
+        token_cache_size: int = 100000,
+        should_pad_dynamically: bool = False,
+        pad_to_multiple_of: int = 8,
+        context_truncation: str = "tokens",
+        pin_memory: bool = True,
     ):
         self.num_workers = num_workers
         self.preprocessing_model_name = preprocessing_model_name
@@ -263,6 +345,18 @@ class DataModuleConfig:
         self.should_add_schema = should_add_schema
         self.should_add_sys_actions = should_add_sys_actions
         self.should_add_user_actions = should_add_user_actions
+        self.should_use_data_prep_cache = should_use_data_prep_cache
+        self.prep_num_workers = prep_num_workers
+        self.should_use_dialog_index = should_use_dialog_index
+        self.data_format = data_format
+        self.should_use_lazy_csv = should_use_lazy_csv
+        self.should_pretokenize = should_pretokenize
+        self.should_use_token_cache = should_use_token_cache
+        self.token_cache_size = token_cache_size
+        self.should_pad_dynamically = should_pad_dynamically
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.context_truncation = context_truncation
+        self.pin_memory = pin_memory
 
     @classmethod
     def from_trainer_config(self, trainer_config: TrainerConfig) -> "DataModuleConfig":
@@ -286,6 +380,18 @@ class DataModuleConfig:
             data_split_percent=trainer_config.data_split_percent,
             should_add_user_actions=trainer_config.should_add_user_actions,
             should_add_sys_actions=trainer_config.should_add_sys_actions,
+            should_use_data_prep_cache=trainer_config.should_use_data_prep_cache,
+            prep_num_workers=trainer_config.prep_num_workers,
+            should_use_dialog_index=trainer_config.should_use_dialog_index,
+            data_format=trainer_config.data_format,
+            should_use_lazy_csv=trainer_config.should_use_lazy_csv,
+            should_pretokenize=trainer_config.should_pretokenize,
+            should_use_token_cache=trainer_config.should_use_token_cache,
+            token_cache_size=trainer_config.token_cache_size,
+            should_pad_dynamically=trainer_config.should_pad_dynamically,
+            pad_to_multiple_of=trainer_config.pad_to_multiple_of,
+            context_truncation=trainer_config.context_truncation,
+            pin_memory=trainer_config.device.type == "cuda",
         )
 
     @classmethod
@@ -308,6 +414,9 @@ class DataModuleConfig:
             eval_batch_size=inf_config.test_batch_size,
             test_batch_size=inf_config.test_batch_size,
             data_split_percent=inf_config.data_split_percent,
+            data_format=inf_config.data_format,
+            should_use_dialog_index=inf_config.should_use_dialog_index,
+            pin_memory=inf_config.device.type == "cuda",
         )
 
     @classmethod
@@ -341,6 +450,11 @@ class DataPrepConfig:
         should_add_schema: bool = False,
         should_add_sys_actions: bool = False,
         should_add_user_actions: bool = False,
+        prep_num_workers: int = 1,
+        should_use_cache: bool = False,
+        cache_max_size_mb: int = 4096,
+        data_format: str = "csv",
+        should_use_dialog_index: bool = True,
     ):
         self.project_root = Path(project_root)
         self.data_root = self.project_root / data_root
@@ -355,6 +469,11 @@ class DataPrepConfig:
         self.should_add_schema = should_add_schema
         self.should_add_sys_actions = should_add_sys_actions
         self.should_add_user_actions = should_add_user_actions
+        self.prep_num_workers = prep_num_workers
+        self.should_use_cache = should_use_cache
+        self.cache_max_size_mb = cache_max_size_mb
+        self.data_format = data_format
+        self.should_use_dialog_index = should_use_dialog_index
 
     @classmethod
     def from_dm_config(self, dm_config: DataModuleConfig) -> "DataPrepConfig":
@@ -371,6 +490,10 @@ class DataPrepConfig:
             dm_config.should_add_schema,
             dm_config.should_add_sys_actions,
             dm_config.should_add_user_actions,
+            prep_num_workers=dm_config.prep_num_workers,
+            should_use_cache=dm_config.should_use_data_prep_cache,
+            data_format=dm_config.data_format,
+            should_use_dialog_index=dm_config.should_use_dialog_index,
         )
 
 
@@ -1,11 +1,19 @@
+from collections import deque
 import re
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 
 import hydra
 import numpy as np
 from omegaconf import DictConfig
+import torch
 from tqdm import tqdm
-from transformers import AutoTokenizer, GPT2LMHeadModel, GPT2PreTrainedModel
+from transformers import (
+    AutoTokenizer,
+    GPT2LMHeadModel,
+    GPT2PreTrainedModel,
+    StoppingCriteriaList,
+)
 
 import dstc_utils
 from metrics.intent_accuracy_metric import IntentAccuracyMetric
@@ -14,13 +22,29 @@ from metrics.tod_metrics_base import MetricCollection
 from metrics.goal_metric import GoalMetric, GoalMetricConfigFactory
 from metrics.requested_slots_metric import RequestedSlotsMetric
 from metrics.dstc_metrics import InformMetric, SuccessMetric, CombinedMetric
-from my_enums import DstcDomains, GoalMetricConfigType, SpecialTokens, TestSettings
+from my_enums import (
+    DstcDomains,
+    GenerationModes,
+    GoalMetricConfigType,
+    SpecialTokens,
+    TestSettings,
+)
 import utils
 from hydra_configs import DataModuleConfig, InferenceConfig
 from my_datamodules import SimpleTodDataModule
 from simple_tod_dataclasses import (
     InferenceRecords,
     SimpleTodConstants,
+    SimpleTodTestDataBatch,
+    get_multi_task_special_tokens,
+)
+from simple_tod_generation import (
+    ContinuousBatchingGenerator,
+    IncrementalDialogueGenerator,
+    SharedPrefixGenerator,
+    TaskEndStoppingCriteria,
+    TaskStop,
+    get_row_stop,
 )
 
 
@@ -64,7 +88,8 @@ class Inference:
         return dm.test_dataloader()
 
     def _get_token_id(self, token_str):
-        return self.cfg.tokenizer(token_str)["input_ids"][0]
+        # encoding the token would add bos in front of it
+        return self.cfg.tokenizer.convert_tokens_to_ids(token_str)
 
     def _remove_padding(self, text):
         return re.sub(self.cfg.padding_regexp, "", text)
@@ -80,6 +105,130 @@ class Inference:
             return self.cfg.domains
         raise ValueError(f"Unknown test setting {test_setting}")
 
+    def _get_max_new_tokens(self) -> int:
+        return self.cfg.generate_max_len - self.cfg.max_token_len
+
+    def _get_task_stops(self) -> Optional[Dict[int, TaskStop]]:
+        """Task end token and max new tokens of every multi task prompt token"""
+        if not (self.cfg.is_multi_task and self.cfg.should_stop_at_task_end):
+            return None
+        task_stops = {}
+        for mtst in get_multi_task_special_tokens():
+            max_new_tokens = self._get_max_new_tokens()
+            if self.cfg.task_budgets:
+                max_new_tokens = self.cfg.task_budgets.get(
+                    mtst.prompt_token.value, max_new_tokens
+                )
+            task_stops[self._get_token_id(mtst.prompt_token)] = TaskStop(
+                self._get_token_id(mtst.end_token), max_new_tokens
+            )
+        return task_stops
+
+    def _get_generator(self) -> Optional[SharedPrefixGenerator]:
+        """The generator of a test run, None when generate is called on the batch"""
+        if self.cfg.generation_mode == GenerationModes.BATCH:
+            return None
+        generator_args = dict(
+            eos_token_id=self._get_token_id(SpecialTokens.eos_token),
+            pad_token_id=self._get_token_id(SpecialTokens.pad_token),
+            max_new_tokens=self._get_max_new_tokens(),
+            task_stops=self._get_task_stops(),
+        )
+        if self.cfg.generation_mode == GenerationModes.CONTINUOUS:
+            # as many rows decode together as in a static test batch
+            return ContinuousBatchingGenerator(
+                self.cfg.model, num_slots=self.cfg.test_batch_size, **generator_args
+            )
+        generator_class = SharedPrefixGenerator
+        if self.cfg.generation_mode == GenerationModes.INCREMENTAL:
+            generator_class = IncrementalDialogueGenerator
+        return generator_class(self.cfg.model, **generator_args)
+
+    def _get_generate_inputs(self, batch: SimpleTodTestDataBatch) -> tuple:
+        """Context tokens and attention mask on the device, and the group keys"""
+        # pinned batches are copied to the gpu asynchronously
+        non_blocking = self.cfg.device.type == "cuda"
+        context_tokens = batch.context_tokens.to(
+            self.cfg.device, non_blocking=non_blocking
+        )
+        attention_mask = batch.context_attention_masks.to(
+            self.cfg.device, non_blocking=non_blocking
+        )
+        # the rows of a turn share the context up to the task prompt
+        return context_tokens, attention_mask, list(zip(batch.dialog_ids, batch.turn_ids))
+
+    def _generate_batches(
+        self,
+        batches: Iterable[SimpleTodTestDataBatch],
+        generator: Optional[SharedPrefixGenerator] = None,
+    ) -> Iterator[Tuple[SimpleTodTestDataBatch, torch.Tensor]]:
+        """
+        Every batch with its generation. With continuous batching the rows of
+        the next batches are read while earlier batches are generated.
+        """
+        if not isinstance(generator, ContinuousBatchingGenerator):
+            for batch in batches:
+                yield batch, self._generate(batch, generator)
+            return
+        waiting = deque()
+
+        def get_inputs():
+            for batch in batches:
+                waiting.append(batch)
+                yield self._get_generate_inputs(batch)
+
+        for gen in generator.generate_batches(get_inputs()):
+            yield waiting.popleft(), gen
+
+    @torch.inference_mode()
+    def _generate(
+        self,
+        batch: SimpleTodTestDataBatch,
+        generator: Optional[SharedPrefixGenerator] = None,
+    ) -> torch.Tensor:
+        context_tokens, attention_mask, group_keys = self._get_generate_inputs(batch)
+        if generator is None:
+            generator = self._get_generator()
+        if generator is not None:
+            return generator.generate(context_tokens, attention_mask, group_keys)
+        task_stops = self._get_task_stops()
+        if not task_stops:
+            return self.cfg.model.generate(
+                inputs=context_tokens,
+                attention_mask=attention_mask,
+                max_length=self.cfg.generate_max_len,
+                eos_token_id=self._get_token_id(SpecialTokens.eos_token),
+                pad_token_id=self._get_token_id(SpecialTokens.pad_token),
+                bos_token_id=self._get_token_id(SpecialTokens.bos_token),
+            )
+        stops = [
+            get_row_stop(
+                ids[mask.bool()],
+                task_stops,
+                self._get_token_id(SpecialTokens.eos_token),
+                self._get_max_new_tokens(),
+            )
+            for ids, mask in zip(context_tokens, attention_mask)
+        ]
+        stopping_criteria = TaskEndStoppingCriteria(
+            context_tokens.shape[1],
+            torch.tensor([stop for stop, _ in stops], device=self.cfg.device),
+            torch.tensor([limit for _, limit in stops], device=self.cfg.device),
+            self._get_token_id(SpecialTokens.eos_token),
+        )
+        gen = self.cfg.model.generate(
+            inputs=context_tokens,
+            attention_mask=attention_mask,
+            max_length=context_tokens.shape[1] + max(limit for _, limit in stops),
+            eos_token_id=self._get_token_id(SpecialTokens.eos_token),
+            pad_token_id=self._get_token_id(SpecialTokens.pad_token),
+            bos_token_id=self._get_token_id(SpecialTokens.bos_token),
+            stopping_criteria=StoppingCriteriaList([stopping_criteria]),
+        )
+        return stopping_criteria.pad_after_stop(
+            gen, self._get_token_id(SpecialTokens.pad_token)
+        )
+
     def test(self):
         self.cfg.logger.info(self.cfg.out_dir)
         for setting in self.cfg.test_settings:
@@ -92,7 +241,8 @@ class Inference:
                 self.cfg.logger.info(f"No data to test for {setting}")
                 continue
             inf_records = InferenceRecords()
-            for batch in tqdm(test_dataloader):
+            generator = self._get_generator()
+            for batch, gen in self._generate_batches(tqdm(test_dataloader), generator):
                 # gen = self.model.generate(
                 #     inputs=batch.context_tokens.to(self.device),
                 #     attention_mask=batch.context_attention_masks.to(self.device),
@@ -104,14 +254,6 @@ class Inference:
                 #     eos_token_id=self._get_token_id(SpecialTokens.end_response),
                 #     pad_token_id=self._get_token_id(TokenizerTokens.pad_token),
                 # )
-                gen = self.cfg.model.generate(
-                    inputs=batch.context_tokens.cuda(),
-                    attention_mask=batch.context_attention_masks.cuda(),
-                    max_length=self.cfg.generate_max_len,
-                    eos_token_id=self._get_token_id(SpecialTokens.eos_token),
-                    pad_token_id=self._get_token_id(SpecialTokens.pad_token),
-                    bos_token_id=self._get_token_id(SpecialTokens.bos_token),
-                )
                 gen_without_context = gen[:, self.cfg.max_token_len :]
                 pred_text = self.cfg.tokenizer.batch_decode(
                     gen_without_context, skip_special_tokens=False
@@ -1,28 +1,45 @@
+import dataclasses
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, Iterable, List
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytorch_lightning as pl
 from responses import target
 import torch
-from torch.utils.data import DataLoader, Dataset, default_collate
+from torch.utils.data import DataLoader, Dataset, Sampler, default_collate
 from transformers import AutoTokenizer, PreTrainedTokenizerFast
-from my_enums import Steps
+from my_enums import ContextTruncation, DataFormats, Steps
 
 import utils
 from simple_tod_dstc_data_prep import SimpleTODDSTCDataPrep
 from simple_tod_dataclasses import (
     SimpleTodTestDataBatch,
+    SimpleTodTokenizedRow,
     SimpleTodTurnCsvRow,
 )
+from csv_row_index import CsvRowIndex
+from segment_token_cache import SegmentTokenCache
+from simple_tod_collators import (
+    SimpleTodPackingCollator,
+    SimpleTodTestCollator,
+    SimpleTodTrainingCollator,
+    round_up_to_multiple,
+)
+from simple_tod_normalized_data import SimpleTodNormalizedData
+from simple_tod_tokenized_data import (
+    SimpleTodTokenizedDataPrep,
+    SimpleTodTokenizedShard,
+)
+from task_generation_budgets import TaskGenerationBudgets
 import dstc_utils
 from hydra_configs import DataModuleConfig, DataPrepConfig
 
 
 class SimpleTodDataModule(pl.LightningDataModule):
     steps = Steps.list()
-    _huggingface_ignore_label_id = -100
 
     def __init__(
         self,
@@ -30,6 +47,17 @@ class SimpleTodDataModule(pl.LightningDataModule):
     ):
         super().__init__()
         self.cfg = cfg
+        if (
+            ContextTruncation(cfg.context_truncation) == ContextTruncation.TURNS
+            and not cfg.should_pretokenize
+        ):
+            # the turn starts of a context are only stored in the tokenized shards
+            raise ValueError("Turns context truncation needs should_pretokenize")
+        self.token_cache = None
+        if cfg.should_use_token_cache:
+            self.token_cache = SegmentTokenCache(
+                cfg.tokenizer, cfg.token_cache_size, report_every=10000
+            )
         self.setup()
 
     def prepare_data(self):
@@ -38,20 +66,69 @@ class SimpleTodDataModule(pl.LightningDataModule):
 
     def setup(self):
         self.prepare_data()
+        self.data_paths: Dict[str, Path] = {}
         for step, split_percent, num_dialog in zip(
             self.steps, self.cfg.data_split_percent, self.cfg.num_dialogs
         ):
-            csv_path = dstc_utils.get_csv_data_path(
+            data_path = dstc_utils.get_data_path(
                 step,
                 num_dialog,
                 cfg=self.cfg,
             )
+            self.data_paths[step] = data_path
             try:
-                data = utils.read_csv_dataclass(csv_path, SimpleTodTurnCsvRow)
-                data = data[: int(len(data) * split_percent)]
+                if self.cfg.should_pretokenize and step != Steps.TEST:
+                    dataset = self._get_tokenized_dataset(data_path, split_percent)
+                else:
+                    dataset = self._read_dataset(data_path, split_percent)
             except FileNotFoundError:
-                data = []
-            self.cfg.datasets[step] = SimpleTodDataSet(data)
+                dataset = SimpleTodDataSet([])
+            self.cfg.datasets[step] = dataset
+
+    def _read_dataset(self, data_path: Path, split_percent: float) -> Dataset:
+        if self.cfg.data_format == DataFormats.PARQUET:
+            return SimpleTodArrowDataSet.from_parquet(data_path, split_percent)
+        if self.cfg.data_format == DataFormats.NORMALIZED:
+            return SimpleTodNormalizedDataSet(
+                SimpleTodNormalizedData(data_path, split_percent)
+            )
+        if self.cfg.should_use_lazy_csv:
+            return SimpleTodLazyCsvDataSet(CsvRowIndex(data_path), split_percent)
+        return SimpleTodArrayDataSet.from_csv(data_path, split_percent)
+
+    def _get_tokenized_dataset(
+        self, data_path: Path, split_percent: float
+    ) -> "SimpleTodTokenizedDataSet":
+        tokenized_data_prep = SimpleTodTokenizedDataPrep(self.cfg.tokenizer)
+        shard = tokenized_data_prep.load(data_path)
+        if shard is None:
+            shard = tokenized_data_prep.run(
+                data_path, self._read_dataset(data_path, 1)
+            )
+        return SimpleTodTokenizedDataSet(shard, int(len(shard) * split_percent))
+
+    def get_row_lengths(self, step: str) -> np.ndarray:
+        """Number of tokens of every row of a split, capped at max_token_len"""
+        dataset = self.cfg.datasets[step]
+        if isinstance(dataset, SimpleTodTokenizedDataSet):
+            lengths = sum(
+                dataset.shard.get_lengths(field)
+                for field in SimpleTodTokenizedShard.fields
+            )
+        else:
+            data_path = self.data_paths[step]
+            full_dataset = self._read_dataset(data_path, 1)
+            lengths = SimpleTodTokenizedDataPrep(self.cfg.tokenizer).get_lengths(
+                data_path, (full_dataset[i] for i in range(len(full_dataset)))
+            )
+        return np.minimum(lengths[: len(dataset)], self.cfg.max_token_len)
+
+    def get_task_budgets(self, step: str = Steps.TRAIN) -> TaskGenerationBudgets:
+        """Max new tokens of every multi task prompt, from the targets of a split"""
+        dataset = self._read_dataset(self.data_paths[step], 1)
+        return TaskGenerationBudgets.from_rows(
+            (dataset[i] for i in range(len(dataset))), self.cfg.tokenizer
+        )
 
     def test_dataloader(self) -> Iterable[SimpleTodTestDataBatch]:
         return DataLoader(
@@ -59,121 +136,144 @@ class SimpleTodDataModule(pl.LightningDataModule):
             batch_size=self.cfg.test_batch_size,
             shuffle=False,
             num_workers=self.cfg.num_workers,
-            collate_fn=self.my_test_collate,
-            pin_memory=True,
+            collate_fn=self.get_test_collator(),
+            pin_memory=self.cfg.pin_memory,
         )
 
-    def tokenize(self, item):
-        return self.cfg.tokenizer(
-            item,
-            return_tensors="pt",
-            truncation=True,
-            padding="max_length",
-            max_length=self.cfg.max_token_len,
+    def get_training_collator(
+        self, is_pretrain: bool = False
+    ) -> SimpleTodTrainingCollator:
+        return SimpleTodTrainingCollator(
+            self.cfg.tokenizer,
+            self.cfg.max_token_len,
+            self.token_cache,
+            self.cfg.context_truncation,
+            is_pretrain=is_pretrain,
+            should_pad_dynamically=self.cfg.should_pad_dynamically,
+            pad_to_multiple_of=self.cfg.pad_to_multiple_of,
         )
 
-    def train_tokenizer(self, item):
-        try:
-            tokens = self.cfg.tokenizer.encode(
-                item,
-                return_tensors="pt",
-            )
-        except TypeError as e:
-            tokens = torch.empty([1, 0], dtype=torch.int64)
-        return tokens
-
-    def get_training_labels(self, context_len, unused_len, target_tokens):
-        return torch.cat(
-            [
-                torch.full([context_len], self._huggingface_ignore_label_id),
-                target_tokens,
-                torch.full([unused_len], self._huggingface_ignore_label_id),
-            ]
+    def get_packing_collator(self, is_pretrain: bool = False) -> SimpleTodPackingCollator:
+        return SimpleTodPackingCollator(
+            self.cfg.tokenizer,
+            self.cfg.max_token_len,
+            self.token_cache,
+            self.cfg.context_truncation,
+            is_pretrain=is_pretrain,
+        )
+
+    def get_test_collator(self) -> SimpleTodTestCollator:
+        return SimpleTodTestCollator(
+            self.cfg.tokenizer, self.cfg.max_token_len, self.token_cache
         )
 
-    def pretraining_collator(self, batch: list[SimpleTodTurnCsvRow]):
-        return self.training_collator(batch, True)
+    def get_packed_dataset(self, step: str) -> "SimpleTodPackedDataSet":
+        lengths = self.get_row_lengths(step)
+        packs = pack_rows(lengths, self.cfg.max_token_len)
+        print(f"packed {len(lengths)} {step} rows into {len(packs)} sequences")
+        return SimpleTodPackedDataSet(self.cfg.datasets[step], packs, lengths)
 
-    def training_collator(
-        self, batch: list[SimpleTodTurnCsvRow], is_pretrain: bool = False
-    ):
-        input_ids = []
-        attention_masks = []
-        labels = []
-
-        for item in batch:
-            context_tokens = self.train_tokenizer(item.context)[0]
-            target_tokens = self.train_tokenizer(item.target)[0]
-            schema_tokens = self.train_tokenizer(item.schema)[0]
-            context_len = len(context_tokens)
-            target_len = len(target_tokens)
-            schema_len = len(schema_tokens)
-            unused_len = self.cfg.max_token_len - context_len - target_len - schema_len
-            # handling case when input is greater than tokenizer length
-            if unused_len < 0:
-                context_start_tokens = context_tokens[:2]
-                trimmed_context = context_tokens[unused_len * -1 + 2 :]
-                context_tokens = torch.cat(
-                    [context_start_tokens, trimmed_context], axis=0
-                )
-                context_len = len(context_tokens)
-                unused_len = 0
-
-            pad = torch.full([unused_len], self.cfg.tokenizer.pad_token_id)
-            input_tokens = torch.cat(
-                [context_tokens, schema_tokens, target_tokens, pad]
-            )
-            if is_pretrain:
-                label = input_tokens
-            else:
-                label = torch.cat(
-                    [
-                        torch.full(
-                            [context_len + schema_len],
-                            self._huggingface_ignore_label_id,
-                        ),
-                        target_tokens,
-                        torch.full([unused_len], self._huggingface_ignore_label_id),
-                    ]
-                )
-            attention_mask = torch.cat(
-                [
-                    torch.full([context_len + schema_len + target_len], 1),
-                    torch.full([unused_len], 0),
-                ]
-            )
-            input_ids.append(input_tokens)
-            attention_masks.append(torch.tensor(attention_mask))
-            labels.append(label)
-
-        return {
-            "input_ids": torch.stack(input_ids),
-            "attention_mask": torch.stack(attention_masks),
-            "labels": torch.stack(labels),
-        }
 
-    def my_test_collate(self, batch: list[SimpleTodTurnCsvRow]):
-        dialog_ids, turn_ids, contexts, schemas, targets = [], [], [], [], []
-        for item in batch:
-            dialog_ids.append(item.dialog_id)
-            turn_ids.append(item.turn_id)
-            contexts.append(item.context)
-            targets.append(item.target)
+def pack_rows(lengths: np.ndarray, max_len: int) -> List[List[int]]:
+    """
+    Groups row indices into packs of at most max_len tokens. Rows are sorted by
+    length, every pack starts with the longest row left and is filled with the
+    shortest rows left while they fit.
+    """
+    order = np.argsort(lengths, kind="stable")
+    lo, hi = 0, len(order) - 1
+    packs = []
+    while lo <= hi:
+        pack = [int(order[hi])]
+        total = lengths[order[hi]]
+        hi -= 1
+        while lo <= hi and total + lengths[order[lo]] <= max_len:
+            pack.append(int(order[lo]))
+            total += lengths[order[lo]]
+            lo += 1
+        packs.append(pack)
+    return packs
 
-        contexts_tokens, targets_tokens = self.tokenize(contexts), self.tokenize(
-            targets
+
+def get_padding_waste(
+    lengths: np.ndarray,
+    indices: List[int],
+    batch_size: int,
+    max_token_len: int,
+    pad_to_multiple_of: int,
+) -> Dict[str, float]:
+    """
+    Share of pad tokens in the batches of a sampler order, when every batch is
+    padded to max_token_len and when it is padded to its longest row.
+    """
+    lengths = np.minimum(np.asarray(lengths)[indices], max_token_len)
+    num_tokens = int(lengths.sum())
+    dynamic_total = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start : start + batch_size]
+        batch_len = min(
+            max_token_len, round_up_to_multiple(int(batch.max()), pad_to_multiple_of)
         )
+        dynamic_total += batch_len * len(batch)
+    static_total = max_token_len * len(lengths)
+    return {
+        "static_waste": 1 - num_tokens / static_total if static_total else 0.0,
+        "dynamic_waste": 1 - num_tokens / dynamic_total if dynamic_total else 0.0,
+        "static_tokens": static_total,
+        "dynamic_tokens": dynamic_total,
+    }
+
+
+class SimpleTodPaddingReportSampler(Sampler):
+    """Wraps a train sampler and prints the padding waste of every epoch's order"""
+
+    def __init__(
+        self,
+        sampler: Sampler,
+        lengths: np.ndarray,
+        batch_size: int,
+        max_token_len: int,
+        pad_to_multiple_of: int,
+    ):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_token_len = max_token_len
+        self.pad_to_multiple_of = pad_to_multiple_of
 
-        return SimpleTodTestDataBatch(
-            torch.stack([*contexts_tokens["input_ids"]]),
-            torch.stack([*contexts_tokens["attention_mask"]]),
-            torch.stack([*targets_tokens["input_ids"]]),
-            torch.stack([*targets_tokens["attention_mask"]]),
-            contexts,
-            targets,
-            dialog_ids,
-            turn_ids,
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        indices = list(self.sampler)
+        waste = get_padding_waste(
+            self.lengths,
+            indices,
+            self.batch_size,
+            self.max_token_len,
+            self.pad_to_multiple_of,
+        )
+        print(
+            f"padding waste this epoch: static {waste['static_waste']:.1%} "
+            f"({waste['static_tokens']} tokens), dynamic {waste['dynamic_waste']:.1%} "
+            f"({waste['dynamic_tokens']} tokens)"
         )
+        return iter(indices)
+
+
+class SimpleTodPackedDataSet(Dataset):
+    """Items are the rows of a pack, see pack_rows"""
+
+    def __init__(self, dataset: Dataset, packs: List[List[int]], lengths: np.ndarray):
+        self.dataset = dataset
+        self.packs = packs
+        self.lengths = np.array([lengths[pack].sum() for pack in packs])
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, idx) -> List[SimpleTodTurnCsvRow]:
+        return [self.dataset[i] for i in self.packs[idx]]
 
 
 class SimpleTodDataSet(Dataset):
@@ -188,3 +288,151 @@ class SimpleTodDataSet(Dataset):
 
     def __getitem__(self, idx) -> SimpleTodTurnCsvRow:
         return self.data[idx]
+
+
+class SimpleTodArrayDataSet(Dataset):
+    """
+    Rows kept as one utf-8 buffer, an offsets array and a null mask per column.
+    Reading a row touches no python object of the split, so forked dataloader
+    workers never write to the shared pages through refcounts or the garbage
+    collector, and their memory does not grow with the size of the split.
+    Row i of a column is buffer[offsets[i] : offsets[i + 1]].
+    """
+
+    fields = [field.name for field in dataclasses.fields(SimpleTodTurnCsvRow)]
+
+    def __init__(self, rows: Iterable[SimpleTodTurnCsvRow]):
+        buffers = {name: bytearray() for name in self.fields}
+        offsets = {name: [0] for name in self.fields}
+        nulls = {name: [] for name in self.fields}
+        for row in rows:
+            for name in self.fields:
+                value = getattr(row, name)
+                nulls[name].append(value is None)
+                if value is not None:
+                    buffers[name] += value.encode("utf-8")
+                offsets[name].append(len(buffers[name]))
+        self.buffers = {
+            name: np.frombuffer(buffer, dtype=np.uint8)
+            for name, buffer in buffers.items()
+        }
+        self.offsets = {
+            name: np.array(offsets[name], dtype=np.int64) for name in self.fields
+        }
+        self.nulls = {name: np.array(nulls[name], dtype=bool) for name in self.fields}
+        self.num_rows = len(self.offsets[self.fields[0]]) - 1
+
+    @classmethod
+    def from_csv(self, path: Path, split_percent: float = 1) -> "SimpleTodArrayDataSet":
+        max_rows = None
+        if split_percent < 1:
+            # the row index counts the records without building dataclasses,
+            # so only the rows of the split are converted and stored
+            max_rows = int(len(CsvRowIndex(path)) * split_percent)
+        return self(utils.iter_csv_dataclass(path, SimpleTodTurnCsvRow, max_rows))
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx) -> SimpleTodTurnCsvRow:
+        if idx >= self.num_rows:
+            raise IndexError(idx)
+        values = {}
+        for name in self.fields:
+            if self.nulls[name][idx]:
+                values[name] = None
+                continue
+            start, end = self.offsets[name][idx], self.offsets[name][idx + 1]
+            values[name] = self.buffers[name][start:end].tobytes().decode("utf-8")
+        return SimpleTodTurnCsvRow(**values)
+
+
+class SimpleTodLazyCsvDataSet(Dataset):
+    """
+    Rows of a csv file parsed on request through a row index, so only the rows
+    of the split are ever read. Values are converted like read_csv_dataclass.
+    """
+
+    def __init__(self, index: CsvRowIndex, split_percent: float = 1):
+        self.index = index
+        self.num_rows = int(len(index) * split_percent)
+        self.fields = dataclasses.fields(SimpleTodTurnCsvRow)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx) -> SimpleTodTurnCsvRow:
+        if idx >= self.num_rows:
+            raise IndexError(idx)
+        values = self.index.get(idx)
+        return SimpleTodTurnCsvRow(
+            **{
+                field.name: None
+                if not values[field.name] and field.default is None
+                else values[field.name]
+                for field in self.fields
+            }
+        )
+
+
+class SimpleTodArrowDataSet(Dataset):
+    """
+    Rows are kept in arrow columns and a SimpleTodTurnCsvRow is only built for
+    the requested index, so the split never exists as python objects.
+    """
+
+    def __init__(self, table: pa.Table):
+        self.num_rows = table.num_rows
+        self.columns = {name: table.column(name) for name in table.column_names}
+
+    @classmethod
+    def from_parquet(
+        self, path: Path, split_percent: float = 1
+    ) -> "SimpleTodArrowDataSet":
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        num_rows = int(parquet_file.metadata.num_rows * split_percent)
+        # only decompress the row groups that hold the rows of the split
+        row_groups, total = [], 0
+        while total < num_rows:
+            row_groups.append(len(row_groups))
+            total += parquet_file.metadata.row_group(row_groups[-1]).num_rows
+        table = parquet_file.read_row_groups(row_groups, use_threads=False)
+        return self(table.slice(0, num_rows))
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx) -> SimpleTodTurnCsvRow:
+        return SimpleTodTurnCsvRow(
+            **{name: column[idx].as_py() for name, column in self.columns.items()}
+        )
+
+
+class SimpleTodNormalizedDataSet(Dataset):
+    """Rows of the normalized format, the context is rendered per requested row"""
+
+    def __init__(self, data: SimpleTodNormalizedData):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx) -> SimpleTodTurnCsvRow:
+        return self.data.get_row(idx)
+
+
+class SimpleTodTokenizedDataSet(Dataset):
+    def __init__(self, shard: SimpleTodTokenizedShard, num_rows: int = None):
+        self.shard = shard
+        self.num_rows = len(shard) if num_rows is None else num_rows
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx) -> SimpleTodTokenizedRow:
+        return SimpleTodTokenizedRow(
+            self.shard.get("context", idx),
+            self.shard.get("target", idx),
+            self.shard.get("schema", idx),
+            self.shard.get_context_turn_starts(idx),
+        )
@@ -11,6 +11,24 @@ class Steps(str, Enum):
         return [c.value for c in cls]
 
 
+class DataFormats(str, Enum):
+    CSV = "csv"
+    PARQUET = "parquet"
+    NORMALIZED = "normalized"
+
+
+class ContextTruncation(str, Enum):
+    TOKENS = "tokens"
+    TURNS = "turns"
+
+
+class GenerationModes(str, Enum):
+    BATCH = "batch"
+    SHARED_PREFIX = "shared_prefix"
+    INCREMENTAL = "incremental"
+    CONTINUOUS = "continuous"
+
+
 class TestSettings(str, Enum):
     SEEN = "seen"
     UNSEEN = "unseen"
@@ -0,0 +1,81 @@
+from typing import Optional
+
+import torch
+from transformers import GPT2LMHeadModel
+from transformers.models.gpt2.modeling_gpt2 import GPT2Attention
+
+
+class PackedGPT2Attention(GPT2Attention):
+    """
+    GPT2 attention that also adds the block diagonal mask of packed rows.
+    The mask is set by PackedGPT2LMHeadModel for the duration of a forward pass,
+    the causal mask is still applied by GPT2Attention.
+    """
+
+    packed_mask: Optional[torch.Tensor] = None
+    # set when _attn added the packed mask, checked after every packed forward
+    is_packed_mask_applied: bool = False
+
+    def _attn(self, query, key, value, attention_mask=None, head_mask=None):
+        if self.packed_mask is not None:
+            mask = self.packed_mask.to(query.dtype)
+            attention_mask = mask if attention_mask is None else attention_mask + mask
+            self.is_packed_mask_applied = True
+        return super()._attn(query, key, value, attention_mask, head_mask)
+
+
+class PackedGPT2LMHeadModel(GPT2LMHeadModel):
+    """
+    GPT2LMHeadModel that trains on several rows packed into one sequence.
+
+    forward takes segment_ids, the 1 based index of the row every token belongs
+    to (0 for padding), and a token only attends to earlier tokens of its own
+    row. Position ids restart at every row, so every row sees exactly what it
+    would see unpacked. Padding is masked through segment_ids, so no
+    attention_mask is passed. Without segment_ids it is a plain GPT2LMHeadModel,
+    and the weights are the same, so checkpoints load in GPT2LMHeadModel.
+    """
+
+    def __init__(self, config):
+        if config.reorder_and_upcast_attn:
+            # GPT2Attention then skips _attn, where the packed mask is added
+            raise ValueError("Packed rows do not support reorder_and_upcast_attn")
+        # versions with sdpa and flash attention only call _attn in the eager
+        # implementation, older versions do not have the attribute and always do
+        config._attn_implementation = "eager"
+        super().__init__(config)
+        for i, block in enumerate(self.transformer.h):
+            block.attn = PackedGPT2Attention(config, layer_idx=i)
+        self.post_init()
+
+    def _get_packed_mask(self, segment_ids: torch.Tensor) -> torch.Tensor:
+        same_row = segment_ids[:, None, :, None] == segment_ids[:, None, None, :]
+        mask = torch.zeros(same_row.shape, dtype=self.dtype, device=segment_ids.device)
+        return mask.masked_fill(~same_row, torch.finfo(self.dtype).min)
+
+    def _set_packed_mask(self, mask: Optional[torch.Tensor]) -> None:
+        for block in self.transformer.h:
+            block.attn.packed_mask = mask
+            block.attn.is_packed_mask_applied = False
+
+    def _check_packed_mask_applied(self) -> None:
+        """
+        Raises if an attention layer did not go through _attn, as in transformers
+        versions that compute attention elsewhere. Its tokens would have attended
+        to the other rows of the pack.
+        """
+        if not all(block.attn.is_packed_mask_applied for block in self.transformer.h):
+            raise RuntimeError(
+                "GPT2Attention._attn was not called, so the packed rows were not masked"
+            )
+
+    def forward(self, *args, segment_ids: torch.Tensor = None, **kwargs):
+        if segment_ids is None:
+            return super().forward(*args, **kwargs)
+        self._set_packed_mask(self._get_packed_mask(segment_ids))
+        try:
+            output = super().forward(*args, **kwargs)
+            self._check_packed_mask_applied()
+            return output
+        finally:
+            self._set_packed_mask(None)
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+import re
+import time
+from typing import Dict, List, Optional
+
+import torch
+from transformers import PreTrainedTokenizerFast
+
+
+class SegmentTokenCache:
+    """
+    LRU cache of token ids per text segment.
+
+    The tokenizer splits a text at its special tokens before running the byte
+    level BPE, so the ids of a text are the ids of its special tokens and of the
+    plain segments between them, concatenated. Utterances repeat across the
+    sliding window contexts of a dialogue and schema fragments repeat across
+    rows, so segments are tokenized once and texts are assembled from the
+    cached ids. The ids match tokenizer.encode (bos and eos are added) and the
+    left truncated, max length padded test tokenization.
+
+    Every sample_every-th text is also tokenized whole to measure the time per
+    character of the tokenizer, the saved time is the estimated time of
+    tokenizing every text whole minus the time spent in the cache.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerFast,
+        max_segments: int = 100000,
+        report_every: int = 0,
+        sample_every: int = 1000,
+    ):
+        self.tokenizer = tokenizer
+        self.max_segments = max_segments
+        self.report_every = report_every
+        self.sample_every = sample_every
+        special_tokens = set(tokenizer.all_special_tokens) | set(
+            tokenizer.get_added_vocab()
+        )
+        self.special_token_ids = {
+            t: tokenizer.convert_tokens_to_ids(t) for t in special_tokens
+        }
+        # longest first, so a token is never matched by one of its prefixes
+        self.split_pattern = re.compile(
+            "("
+            + "|".join(
+                re.escape(t) for t in sorted(special_tokens, key=len, reverse=True)
+            )
+            + ")"
+        )
+        self.segments: OrderedDict[str, List[int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.num_texts = 0
+        self.num_chars = 0
+        self.time_spent = 0.0
+        self.sampled_chars = 0
+        self.sampled_time = 0.0
+
+    def __getstate__(self):
+        # a copy sent to a dataloader worker starts empty
+        state = self.__dict__.copy()
+        state["segments"] = OrderedDict()
+        return state
+
+    def _tokenize_segments(self, segments: List[str]) -> Dict[str, List[int]]:
+        encoded = self.tokenizer(segments, add_special_tokens=False)["input_ids"]
+        return dict(zip(segments, encoded))
+
+    def _add_segments(self, segments: Dict[str, List[int]]) -> None:
+        for segment, ids in segments.items():
+            self.segments[segment] = ids
+        while len(self.segments) > self.max_segments:
+            self.segments.popitem(last=False)
+
+    def _sample_tokenizer_time(self, text: str) -> None:
+        start = time.perf_counter()
+        self.tokenizer(text, add_special_tokens=False)
+        self.sampled_time += time.perf_counter() - start
+        self.sampled_chars += len(text)
+
+    def encode_content(self, text: str) -> List[int]:
+        """Token ids of a text without bos and eos"""
+        if self.sample_every and (self.num_texts + 1) % self.sample_every == 0:
+            self._sample_tokenizer_time(text)
+        start = time.perf_counter()
+        ids = self._encode_content(text)
+        self.time_spent += time.perf_counter() - start
+        self.num_texts += 1
+        self.num_chars += len(text)
+        if self.report_every and self.num_texts % self.report_every == 0:
+            print(self.report())
+        return ids
+
+    def _encode_content(self, text: str) -> List[int]:
+        parts = [p for p in self.split_pattern.split(text) if p]
+        missing = list(
+            {
+                p: None
+                for p in parts
+                if p not in self.special_token_ids and p not in self.segments
+            }
+        )
+        new_segments = self._tokenize_segments(missing) if missing else {}
+        ids = []
+        for part in parts:
+            token_id = self.special_token_ids.get(part)
+            if token_id is not None:
+                ids.append(token_id)
+                continue
+            segment_ids = new_segments.get(part)
+            if segment_ids is None:
+                segment_ids = self.segments[part]
+                self.segments.move_to_end(part)
+                self.hits += 1
+            else:
+                self.misses += 1
+            ids.extend(segment_ids)
+        # evicting after the ids are assembled keeps the segments of this text
+        self._add_segments(new_segments)
+        return ids
+
+    def encode(self, text: Optional[str]) -> List[int]:
+        """Same ids as tokenizer.encode, a missing text has no tokens"""
+        if text is None:
+            return []
+        return [
+            self.tokenizer.bos_token_id,
+            *self.encode_content(text),
+            self.tokenizer.eos_token_id,
+        ]
+
+    def encode_padded(
+        self, texts: List[str], max_length: int
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Same as calling the tokenizer with truncation and max_length padding.
+        The tokenizer truncates from the left and keeps bos and eos.
+        """
+        input_ids = torch.full(
+            [len(texts), max_length], self.tokenizer.pad_token_id, dtype=torch.int64
+        )
+        attention_mask = torch.zeros([len(texts), max_length], dtype=torch.int64)
+        for i, text in enumerate(texts):
+            content = self.encode_content(text)
+            if len(content) > max_length - 2:
+                content = content[len(content) - (max_length - 2) :]
+            ids = [self.tokenizer.bos_token_id, *content, self.tokenizer.eos_token_id]
+            input_ids[i, : len(ids)] = torch.tensor(ids)
+            attention_mask[i, : len(ids)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def get_hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get_time_saved(self) -> float:
+        if not self.sampled_chars:
+            return 0.0
+        tokenizer_time = self.num_chars * self.sampled_time / self.sampled_chars
+        return tokenizer_time - self.time_spent
+
+    def report(self) -> str:
+        return (
+            f"token cache: {len(self.segments)} segments, hit rate {self.get_hit_rate():.1%}, "
+            f"time {self.time_spent:.2f}s, estimated tokenizer time saved {self.get_time_saved():.2f}s"
+        )
@@ -0,0 +1,302 @@
+from typing import Optional
+
+import numpy as np
+import torch
+from transformers import PreTrainedTokenizerFast
+
+from my_enums import ContextTruncation
+from segment_token_cache import SegmentTokenCache
+from simple_tod_dataclasses import (
+    SimpleTodTestDataBatch,
+    SimpleTodTokenizedRow,
+    SimpleTodTurnCsvRow,
+)
+from simple_tod_tokenized_data import get_turn_token_ids
+
+
+def round_up_to_multiple(value: int, multiple: int) -> int:
+    return -(-value // multiple) * multiple
+
+
+class SimpleTodCollator:
+    """
+    Base of the dataloader collators. Dataloader workers receive the collator
+    and not the datamodule with the splits it holds. The collator keeps the
+    whole tokenizer, which every worker unpickles, since rows that are not
+    pretokenized are encoded in the workers. A token cache is pickled empty,
+    every worker fills its own.
+    """
+
+    _huggingface_ignore_label_id = -100
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerFast,
+        max_token_len: int,
+        token_cache: Optional[SegmentTokenCache] = None,
+        context_truncation: str = ContextTruncation.TOKENS,
+    ):
+        self.tokenizer = tokenizer
+        self.pad_token_id = tokenizer.pad_token_id
+        self.max_token_len = max_token_len
+        self.token_cache = token_cache
+        self.context_truncation = ContextTruncation(context_truncation)
+        self.turn_token_ids = get_turn_token_ids(tokenizer)
+
+    def train_tokenizer(self, item):
+        if self.token_cache:
+            return torch.tensor([self.token_cache.encode(item)], dtype=torch.int64)
+        try:
+            tokens = self.tokenizer.encode(
+                item,
+                return_tensors="pt",
+            )
+        except TypeError as e:
+            tokens = torch.empty([1, 0], dtype=torch.int64)
+        return tokens
+
+    def get_item_tokens(self, item):
+        if isinstance(item, SimpleTodTokenizedRow):
+            return [
+                torch.from_numpy(tokens.astype(np.int64))
+                for tokens in (
+                    item.context_tokens,
+                    item.target_tokens,
+                    item.schema_tokens,
+                )
+            ]
+        return [
+            self.train_tokenizer(text)[0]
+            for text in (item.context, item.target, item.schema)
+        ]
+
+    def get_context_turn_starts(self, context_tokens) -> np.ndarray:
+        return np.flatnonzero(np.isin(context_tokens, self.turn_token_ids))
+
+    def truncate_context(
+        self, context_tokens, overflow: int, turn_starts: np.ndarray = None
+    ) -> np.ndarray:
+        """
+        Removes overflow tokens from the context. In turns mode the oldest whole
+        history turns are dropped, the current user utterance never is. The turn
+        starts come from the context turns of the tokenized shard, so the context
+        is not searched at collate time. Whatever still overflows, and everything
+        in tokens mode, is cut after the first 2 context tokens, the oldest
+        tokens first.
+        """
+        context_tokens = np.asarray(context_tokens)
+        if self.context_truncation == ContextTruncation.TURNS:
+            if turn_starts is None:
+                raise ValueError(
+                    "Turns context truncation needs the turn starts of pretokenized rows"
+                )
+            if len(turn_starts):
+                history_start = turn_starts[0]
+                # dropping up to turn_starts[i] removes turn_starts[i] - history_start tokens
+                i = min(
+                    np.searchsorted(turn_starts - history_start, overflow),
+                    len(turn_starts) - 1,
+                )
+                context_tokens = np.concatenate(
+                    [context_tokens[:history_start], context_tokens[turn_starts[i] :]]
+                )
+                overflow -= turn_starts[i] - history_start
+        if overflow > 0:
+            context_tokens = np.concatenate(
+                [context_tokens[:2], context_tokens[overflow + 2 :]]
+            )
+        return context_tokens
+
+    def truncate_item_tokens(
+        self, context_tokens, target_tokens, schema_tokens, turn_starts=None
+    ):
+        overflow = (
+            len(context_tokens)
+            + len(target_tokens)
+            + len(schema_tokens)
+            - self.max_token_len
+        )
+        # handling case when input is greater than tokenizer length
+        if overflow > 0:
+            context_tokens = torch.from_numpy(
+                self.truncate_context(context_tokens.numpy(), overflow, turn_starts)
+            )
+        return context_tokens, target_tokens, schema_tokens
+
+
+class SimpleTodTrainingCollator(SimpleTodCollator):
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerFast,
+        max_token_len: int,
+        token_cache: Optional[SegmentTokenCache] = None,
+        context_truncation: str = ContextTruncation.TOKENS,
+        is_pretrain: bool = False,
+        should_pad_dynamically: bool = False,
+        pad_to_multiple_of: int = 8,
+    ):
+        super().__init__(tokenizer, max_token_len, token_cache, context_truncation)
+        self.is_pretrain = is_pretrain
+        self.should_pad_dynamically = should_pad_dynamically
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def get_batch_max_len(self, lengths: list[int]) -> int:
+        if not self.should_pad_dynamically:
+            return self.max_token_len
+        return min(
+            self.max_token_len,
+            round_up_to_multiple(max(lengths), self.pad_to_multiple_of),
+        )
+
+    def get_batch_tokens(self, batch: list[SimpleTodTurnCsvRow]) -> list[list]:
+        """
+        Token ids of the context, target and schema of every item. Text fields
+        are tokenized with one batched call per field, missing fields have no tokens.
+        """
+        if isinstance(batch[0], SimpleTodTokenizedRow):
+            return [
+                [item.context_tokens, item.target_tokens, item.schema_tokens]
+                for item in batch
+            ]
+        if self.token_cache:
+            return [
+                [self.token_cache.encode(text) for text in (item.context, item.target, item.schema)]
+                for item in batch
+            ]
+        fields = []
+        for name in ("context", "target", "schema"):
+            texts = [getattr(item, name) for item in batch]
+            present = [i for i, text in enumerate(texts) if text is not None]
+            tokens = [[] for _ in texts]
+            if present:
+                encoded = self.tokenizer([texts[i] for i in present])["input_ids"]
+                for i, ids in zip(present, encoded):
+                    tokens[i] = ids
+            fields.append(tokens)
+        return [list(item_tokens) for item_tokens in zip(*fields)]
+
+    def __call__(self, batch: list[SimpleTodTurnCsvRow]):
+        items = self.get_batch_tokens(batch)
+        lengths = [sum(map(len, item_tokens)) for item_tokens in items]
+        max_len = self.get_batch_max_len(
+            [min(length, self.max_token_len) for length in lengths]
+        )
+        shape = [len(batch), max_len]
+        input_ids = np.full(shape, self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros(shape, dtype=np.int64)
+        labels = np.full(shape, self._huggingface_ignore_label_id, dtype=np.int64)
+
+        for i, (context_tokens, target_tokens, schema_tokens) in enumerate(items):
+            overflow = lengths[i] - self.max_token_len
+            # handling case when input is greater than tokenizer length
+            if overflow > 0:
+                context_tokens = self.truncate_context(
+                    context_tokens,
+                    overflow,
+                    getattr(batch[i], "context_turn_starts", None),
+                )
+            context_len = len(context_tokens)
+            schema_end = context_len + len(schema_tokens)
+            target_end = schema_end + len(target_tokens)
+            input_ids[i, :context_len] = context_tokens
+            input_ids[i, context_len:schema_end] = schema_tokens
+            input_ids[i, schema_end:target_end] = target_tokens
+            attention_mask[i, :target_end] = 1
+            if not self.is_pretrain:
+                labels[i, schema_end:target_end] = target_tokens
+
+        if self.is_pretrain:
+            labels = input_ids.copy()
+        return {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(attention_mask),
+            "labels": torch.from_numpy(labels),
+        }
+
+
+class SimpleTodPackingCollator(SimpleTodCollator):
+    """
+    Rows of a pack are placed one after the other in a max_token_len sequence.
+    Position ids restart at every row and segment_ids tell
+    PackedGPT2LMHeadModel which tokens can attend to each other. Labels are
+    masked per row as in SimpleTodTrainingCollator. The first token of a row is
+    never a label, it would be predicted from the previous row. Padding is not a
+    label either.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerFast,
+        max_token_len: int,
+        token_cache: Optional[SegmentTokenCache] = None,
+        context_truncation: str = ContextTruncation.TOKENS,
+        is_pretrain: bool = False,
+    ):
+        super().__init__(tokenizer, max_token_len, token_cache, context_truncation)
+        self.is_pretrain = is_pretrain
+
+    def __call__(self, batch: list[list[SimpleTodTurnCsvRow]]):
+        shape = [len(batch), self.max_token_len]
+        input_ids = torch.full(shape, self.pad_token_id)
+        labels = torch.full(shape, self._huggingface_ignore_label_id)
+        position_ids = torch.zeros(shape, dtype=torch.int64)
+        segment_ids = torch.zeros(shape, dtype=torch.int64)
+        for i, rows in enumerate(batch):
+            start = 0
+            for segment_id, item in enumerate(rows, 1):
+                context_tokens, target_tokens, schema_tokens = self.truncate_item_tokens(
+                    *self.get_item_tokens(item),
+                    getattr(item, "context_turn_starts", None),
+                )
+                tokens = torch.cat([context_tokens, schema_tokens, target_tokens])
+                end = start + len(tokens)
+                input_ids[i, start:end] = tokens
+                if self.is_pretrain:
+                    labels[i, start + 1 : end] = tokens[1:]
+                else:
+                    labels[i, end - len(target_tokens) : end] = target_tokens
+                position_ids[i, start:end] = torch.arange(len(tokens))
+                segment_ids[i, start:end] = segment_id
+                start = end
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "segment_ids": segment_ids,
+        }
+
+
+class SimpleTodTestCollator(SimpleTodCollator):
+    def tokenize(self, item):
+        if self.token_cache:
+            return self.token_cache.encode_padded(item, self.max_token_len)
+        return self.tokenizer(
+            item,
+            return_tensors="pt",
+            truncation=True,
+            padding="max_length",
+            max_length=self.max_token_len,
+        )
+
+    def __call__(self, batch: list[SimpleTodTurnCsvRow]) -> SimpleTodTestDataBatch:
+        dialog_ids, turn_ids, contexts, schemas, targets = [], [], [], [], []
+        for item in batch:
+            dialog_ids.append(item.dialog_id)
+            turn_ids.append(item.turn_id)
+            contexts.append(item.context)
+            targets.append(item.target)
+
+        contexts_tokens, targets_tokens = self.tokenize(contexts), self.tokenize(
+            targets
+        )
+
+        return SimpleTodTestDataBatch(
+            torch.stack([*contexts_tokens["input_ids"]]),
+            torch.stack([*contexts_tokens["attention_mask"]]),
+            torch.stack([*targets_tokens["input_ids"]]),
+            torch.stack([*targets_tokens["attention_mask"]]),
+            contexts,
+            targets,
+            dialog_ids,
+            turn_ids,
+        )
@@ -1,6 +1,5 @@
-from collections import defaultdict, deque
+from collections import defaultdict
 from dataclasses import dataclass, field
-from itertools import zip_longest
 from typing import DefaultDict, Dict, List, Optional, Tuple, Union
 import numpy as np
 import pandas as pd
@@ -102,45 +101,126 @@ class SimpleTodAction:
         )
 
 
-@dataclass
-class SimpleTodContext:
-    user_utterances: deque[str] = field(default_factory=deque)
-    system_utterances: deque[str] = field(default_factory=deque)
-    next_system_utterance: str = None
-    current_user_utterance: str = None
-    should_add_sys_actions: bool = None
+def render_context_turn(user: Optional[str], system: Optional[str]) -> str:
+    out = ""
+    if user:
+        out += SpecialTokens.user + user
+    if system:
+        out += SpecialTokens.system + system
+    return out
+
+
+def render_context(
+    rendered_history: str, current_user_utterance: str, should_add_sys_actions: bool
+) -> str:
+    out = "".join(
+        [
+            SpecialTokens.begin_context,
+            rendered_history,
+            SpecialTokens.begin_last_user_utterance,
+            current_user_utterance,
+            SpecialTokens.end_last_user_utterance,
+        ]
+    )
+    if should_add_sys_actions:
+        out += "".join(
+            [
+                SpecialTokens.sys_actions,
+                " ".join(DstcSystemActions.list()),
+            ]
+        )
+    out += SpecialTokens.end_context
+    return out
+
+
+class SimpleTodContextHistory:
+    """
+    Append only list of the (user, system) utterance pairs of a dialogue.
+    It is shared by all the contexts of the dialogue, each context only keeps
+    the end index of its window, and every pair is rendered once when added.
+    """
 
-    def __init__(self, max_length: int = 10):
-        self.user_utterances = deque(maxlen=max_length)
-        self.system_utterances = deque(maxlen=max_length)
+    def __init__(self):
+        self.user_utterances: list[str] = []
+        self.system_utterances: list[str] = []
+        self.rendered_turns: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self.rendered_turns)
+
+    def add(self, user: str, system: str) -> None:
+        self.user_utterances.append(user)
+        self.system_utterances.append(system)
+        self.rendered_turns.append(render_context_turn(user, system))
+
+    def fork(self, end: int) -> "SimpleTodContextHistory":
+        history = SimpleTodContextHistory()
+        history.user_utterances = self.user_utterances[:end]
+        history.system_utterances = self.system_utterances[:end]
+        history.rendered_turns = self.rendered_turns[:end]
+        return history
+
+
+class SimpleTodContext:
+    def __init__(
+        self,
+        max_length: int = 10,
+        history: SimpleTodContextHistory = None,
+        history_end: int = 0,
+        rendered_history: str = "",
+    ):
+        self.max_length = max_length
+        self.history = history or SimpleTodContextHistory()
+        self.history_end = history_end
+        self.rendered_history = rendered_history
+        self.next_system_utterance: str = None
+        self.current_user_utterance: str = None
+        self.should_add_sys_actions: bool = None
+
+    @property
+    def history_start(self) -> int:
+        return max(0, self.history_end - self.max_length)
+
+    @property
+    def user_utterances(self) -> list[str]:
+        return self.history.user_utterances[self.history_start : self.history_end]
+
+    @property
+    def system_utterances(self) -> list[str]:
+        return self.history.system_utterances[self.history_start : self.history_end]
+
+    def get_next_context(self) -> "SimpleTodContext":
+        """
+        Moves the current user utterance and the next system utterance into the history.
+        The history is shared with this context, and the rendered window is updated
+        by dropping the turns that slid out of it and appending the new turn.
+        """
+        history = self.history
+        if len(history) != self.history_end:
+            history = history.fork(self.history_end)
+        history.add(self.current_user_utterance, self.next_system_utterance)
+        end = self.history_end + 1
+        start = max(0, end - self.max_length)
+        drop_len = sum(
+            len(history.rendered_turns[i])
+            for i in range(self.history_start, min(start, self.history_end))
+        )
+        rendered_history = self.rendered_history[drop_len:]
+        if start < end:
+            rendered_history += history.rendered_turns[end - 1]
+        context = SimpleTodContext(self.max_length, history, end, rendered_history)
+        context.should_add_sys_actions = self.should_add_sys_actions
+        return context
 
     def __repr__(self) -> str:
         return self.__str__()
 
     def __str__(self) -> str:
-        out = SpecialTokens.begin_context
-        for user, system in zip_longest(
-            self.user_utterances, self.system_utterances, fillvalue=""
-        ):
-            if user:
-                out += SpecialTokens.user + user
-            if system:
-                out += SpecialTokens.system + system
-
-        out += (
-            SpecialTokens.begin_last_user_utterance
-            + self.current_user_utterance
-            + SpecialTokens.end_last_user_utterance
+        return render_context(
+            self.rendered_history,
+            self.current_user_utterance,
+            self.should_add_sys_actions,
         )
-        if self.should_add_sys_actions:
-            out += "".join(
-                [
-                    SpecialTokens.sys_actions,
-                    " ".join(DstcSystemActions.list()),
-                ]
-            )
-        out += SpecialTokens.end_context
-        return out
 
 
 @dataclass
@@ -150,37 +230,41 @@ class SimpleTodDst:
     requested_slots: Optional[List[DstcRequestedSlot]] = None
     actions: List[SimpleTodAction] = None
 
-    def __str__(self) -> str:
-        out = SpecialTokens.begin_dst
+    def get_parts(self) -> list[str]:
+        parts = [SpecialTokens.begin_dst]
         if self.active_intent:
-            out += SpecialTokens.begin_intent
-            out += self.active_intent
-            out += SpecialTokens.end_intent + SimpleTodConstants.NEW_LINES
+            parts += [
+                SpecialTokens.begin_intent,
+                self.active_intent,
+                SpecialTokens.end_intent,
+                SimpleTodConstants.NEW_LINES,
+            ]
 
         if self.requested_slots:
-            out += SpecialTokens.begin_requested_slots
-            out += SimpleTodConstants.ITEM_SEPARATOR.join(
-                map(str, self.requested_slots)
-            )
-            out += SpecialTokens.end_requested_slots + SimpleTodConstants.NEW_LINES
-
-        out += SpecialTokens.begin_belief
-        out += SimpleTodConstants.ITEM_SEPARATOR.join(map(str, self.beliefs))
-        out += (
-            SpecialTokens.end_belief
-            + SpecialTokens.end_dst
-            + SimpleTodConstants.NEW_LINES
-        )
+            parts += [
+                SpecialTokens.begin_requested_slots,
+                SimpleTodConstants.ITEM_SEPARATOR.join(map(str, self.requested_slots)),
+                SpecialTokens.end_requested_slots,
+                SimpleTodConstants.NEW_LINES,
+            ]
+
+        parts += [
+            SpecialTokens.begin_belief,
+            SimpleTodConstants.ITEM_SEPARATOR.join(map(str, self.beliefs)),
+            SpecialTokens.end_belief,
+            SpecialTokens.end_dst,
+            SimpleTodConstants.NEW_LINES,
+        ]
         if self.actions:
-            out += "".join(
-                [
-                    SpecialTokens.begin_user_action,
-                    SimpleTodConstants.ITEM_SEPARATOR.join(map(str, self.beliefs)),
-                    SpecialTokens.end_user_action,
-                ]
-            )
+            parts += [
+                SpecialTokens.begin_user_action,
+                SimpleTodConstants.ITEM_SEPARATOR.join(map(str, self.beliefs)),
+                SpecialTokens.end_user_action,
+            ]
+        return parts
 
-        return out
+    def __str__(self) -> str:
+        return "".join(self.get_parts())
 
 
 @dataclass
@@ -194,27 +278,40 @@ class SimpleTodTarget:
 
         return self.__str__()
 
-    def __str__(self) -> str:
-        out = "".join(
-            [
-                SpecialTokens.begin_target,
-                SpecialTokens.begin_dsts,
-                "".join(map(str, self.dsts)),
-                SpecialTokens.end_dsts,
-                SimpleTodConstants.NEW_LINES,
-            ]
-        )
-
-        out += SpecialTokens.begin_action
-        out += SimpleTodConstants.ITEM_SEPARATOR.join(map(str, self.actions))
-        out += SpecialTokens.end_action + SimpleTodConstants.NEW_LINES
+    def get_parts(self) -> list[str]:
+        return [
+            SpecialTokens.begin_target,
+            SpecialTokens.begin_dsts,
+            *(part for dst in self.dsts for part in dst.get_parts()),
+            SpecialTokens.end_dsts,
+            SimpleTodConstants.NEW_LINES,
+            SpecialTokens.begin_action,
+            SimpleTodConstants.ITEM_SEPARATOR.join(map(str, self.actions)),
+            SpecialTokens.end_action,
+            SimpleTodConstants.NEW_LINES,
+            SpecialTokens.begin_response,
+            self.response,
+            SpecialTokens.end_response,
+            SimpleTodConstants.NEW_LINES,
+            SpecialTokens.end_target,
+        ]
 
-        out += SpecialTokens.begin_response
-        out += self.response
-        out += SpecialTokens.end_response + SimpleTodConstants.NEW_LINES
+    def render(self) -> Tuple[str, Dict[str, int]]:
+        """
+        Returns the target text and the offset of the first occurrence of every
+        special token in it, so sections can be sliced out without searching.
+        """
+        parts = self.get_parts()
+        token_offsets = {}
+        offset = 0
+        for part in parts:
+            if isinstance(part, SpecialTokens):
+                token_offsets.setdefault(part.value, offset)
+            offset += len(part)
+        return "".join(parts), token_offsets
 
-        out += SpecialTokens.end_target
-        return out
+    def __str__(self) -> str:
+        return "".join(self.get_parts())
 
 
 @dataclass
@@ -233,6 +330,56 @@ class MultiTaskSpecialToken:
     prompt_token: SpecialTokens
 
 
+class SimpleTodSchemaStrCache:
+    """
+    Schema strings of a split, built from per service fragments that are rendered once.
+    The string of a row only depends on the services of the turn, the prompt token
+    and the active intent, so every combination is joined once and then reused.
+    """
+
+    def __init__(self, schemas: Dict[str, DstcSchema]):
+        self.description_fragments: Dict[str, str] = {}
+        self.slot_fragments: Dict[str, str] = {}
+        self.intent_fragments: Dict[str, list[Tuple[str, str]]] = {}
+        for name, schema in schemas.items():
+            self.description_fragments[name] = (
+                SpecialTokens.schema_description + schema.description
+            )
+            self.slot_fragments[name] = "".join(map(str, schema.slots))
+            self.intent_fragments[name] = [
+                (intent.name, str(intent)) for intent in schema.intents
+            ]
+        self.schema_strs: Dict[Tuple[Tuple[str], str, str], str] = {}
+
+    def get_fragments(
+        self, services: list[str], prompt_token: str, active_intent: str
+    ) -> list[str]:
+        fragments = [self.description_fragments[s] for s in services]
+        if prompt_token == SpecialTokens.prompt_intent:
+            fragments += [
+                fragment
+                for s in services
+                for intent_name, fragment in self.intent_fragments[s]
+                if intent_name == active_intent
+            ]
+        elif prompt_token in [
+            SpecialTokens.prompt_requested_slots,
+            SpecialTokens.prompt_belief,
+            SpecialTokens.prompt_action,
+            SpecialTokens.prompt_response,
+        ]:
+            fragments += [self.slot_fragments[s] for s in services]
+        return fragments
+
+    def get(self, services: list[str], prompt_token: str, active_intent: str) -> str:
+        key = (tuple(services), prompt_token, active_intent)
+        schema_str = self.schema_strs.get(key)
+        if schema_str is None:
+            schema_str = "".join(self.get_fragments(services, prompt_token, active_intent))
+            self.schema_strs[key] = schema_str
+        return schema_str
+
+
 @dataclass
 class SimpleTodTurn:
     context: SimpleTodContext
@@ -277,6 +424,14 @@ class SimpleTodTestDataBatch:
     turn_ids: list[int]
 
 
+@dataclass
+class SimpleTodTokenizedRow:
+    context_tokens: np.ndarray
+    target_tokens: np.ndarray
+    schema_tokens: np.ndarray
+    context_turn_starts: np.ndarray = None
+
+
 @dataclass
 class PredRef:
     pred: str
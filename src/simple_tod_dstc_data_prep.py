@@ -1,27 +1,36 @@
+from collections import deque
 import copy
-import json
+from multiprocessing import Pool
+import os
 from pathlib import Path
-from typing import Dict, List, Optional
+import resource
+import shutil
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 import hydra
-import numpy as np
 from omegaconf import DictConfig, ListConfig, OmegaConf
 from tqdm import tqdm
 import humps
 from hydra_configs import DataPrepConfig
-from my_enums import Steps, SimpleTodConstants
+from my_enums import DataFormats, Steps, SimpleTodConstants
 
 import utils
-from pathos.multiprocessing import ProcessingPool as Pool
 
+from data_prep_cache import DataPrepCache
+from dstc_dialog_index import DstcDialogIndex
 from dstc_dataclasses import DstcDialog, DstcFrame, DstcSchema, DstcTurn
-from dstc_utils import get_csv_data_path, get_dialog_file_paths
+from dstc_utils import get_data_path, get_dialog_file_paths
 
+from simple_tod_normalized_data import (
+    SimpleTodNormalizedFile,
+    SimpleTodNormalizedWriter,
+)
 from simple_tod_dataclasses import (
     MultiTaskSpecialToken,
     SimpleTodAction,
     SimpleTodBelief,
     SimpleTodContext,
     SimpleTodDst,
+    SimpleTodSchemaStrCache,
     SimpleTodTarget,
     SimpleTodTurn,
     SpecialTokens,
@@ -30,8 +39,13 @@ from simple_tod_dataclasses import (
 
 
 class SimpleTODDSTCDataPrep:
+    max_pending_files_per_worker = 2
+
     def __init__(self, cfg: DataPrepConfig):
         self.cfg = cfg
+        self.cache = DataPrepCache(cfg) if cfg.should_use_cache else None
+        self.schema_str_cache: Optional[SimpleTodSchemaStrCache] = None
+        self.dialog_index: Optional[DstcDialogIndex] = None
 
     """
         A context contains a list of user and system turns. The data format expects system turn first, and then user turn.
@@ -39,7 +53,8 @@ class SimpleTODDSTCDataPrep:
         In the first turn, system turn is null and there is only a user turn and the system turn is placed in 
         the next system utterance of the current context.
 
-        If we have a previous turn, we make a deep copy of it. Check context length by number of turns.
+        If we have a previous turn, the new context shares its history and only adds the previous
+        user and next system utterances to it. Context length is checked by number of turns.
         The system utterance for this turn is the next system utterance of the previous context.
     """
 
@@ -55,11 +70,7 @@ class SimpleTODDSTCDataPrep:
             if self.cfg.should_add_sys_actions:
                 context.should_add_sys_actions = True
         else:
-            context = copy.deepcopy(prev_tod_turn.context)
-            context.system_utterances.append(
-                prev_tod_turn.context.next_system_utterance
-            )
-            context.user_utterances.append(prev_tod_turn.context.current_user_utterance)
+            context = prev_tod_turn.context.get_next_context()
 
         if user_turn:
             utterance = user_turn.utterance
@@ -146,25 +157,20 @@ class SimpleTODDSTCDataPrep:
     def _delexicalize_utterance(
         self, turn: DstcTurn, schemas: Dict[str, DstcSchema]
     ) -> str:
-        delexicalized_utterance = turn.utterance
+        replacements = {}
         for frame in turn.frames:
-            schema = schemas[frame.short_service]
+            slot_names = schemas[frame.service].slot_names
             for action in frame.actions:
+                if action.slot not in slot_names:
+                    continue
+                replacement = (
+                    # f"<{frame.short_service}_{humps.camelize(action.slot)}>"
+                    f"<{frame.short_service}{SimpleTodConstants.DOMAIN_SLOT_SEPARATOR}{action.slot}>"
+                )
                 for value in action.values:
-                    slot = next(
-                        (slot for slot in schema.slots if slot.name == action.slot),
-                        None,
-                    )
-                    if not slot:
-                        continue
-                    replacement = (
-                        # f"<{frame.short_service}_{humps.camelize(action.slot)}>"
-                        f"<{frame.short_service}{SimpleTodConstants.DOMAIN_SLOT_SEPARATOR}{action.slot}>"
-                    )
-                    delexicalized_utterance = delexicalized_utterance.replace(
-                        value, replacement
-                    )
-        return delexicalized_utterance
+                    if value:
+                        replacements.setdefault(value, replacement)
+        return utils.replace_all(turn.utterance, replacements)
 
     def _prepare_response(
         self, system_turn: DstcTurn, schemas: Dict[str, DstcSchema]
@@ -204,11 +210,17 @@ class SimpleTODDSTCDataPrep:
     def _is_dialogue_in_domain(self, dialogue_services: List[str]) -> bool:
         return all(ds in self.cfg.domains for ds in dialogue_services)
 
-    def _extract_from_target(self, target: str, start_token: str, end_token: str):
+    def _extract_from_target(
+        self,
+        target: str,
+        token_offsets: Dict[str, int],
+        start_token: SpecialTokens,
+        end_token: SpecialTokens,
+    ):
         try:
-            start_index = target.index(start_token)
-            end_index = target.index(end_token)
-        except ValueError:
+            start_index = token_offsets[start_token.value]
+            end_index = token_offsets[end_token.value]
+        except KeyError:
             raise ValueError(
                 f"could not find start or end token in target, {start_token}, {end_token}"
             )
@@ -228,42 +240,34 @@ class SimpleTODDSTCDataPrep:
     ) -> str:
         if not schemas:
             return ""
-        schema_str_list = [
-            SpecialTokens.schema_description + schema.description for schema in schemas
-        ]
-        if mtst.prompt_token == SpecialTokens.prompt_intent:
-            intents = [
-                intent
-                for schema in schemas
-                for intent in schema.intents
-                if intent.name == turn.active_intent
-            ]
-            schema_str_list += map(str, intents)
-        elif mtst.prompt_token in [
-            SpecialTokens.prompt_requested_slots,
-            SpecialTokens.prompt_belief,
-            SpecialTokens.prompt_action,
-            SpecialTokens.prompt_response,
-        ]:
-            slots = [slot for schema in schemas for slot in schema.slots]
-            schema_str_list += map(str, slots)
-        return "".join(schema_str_list)
-
-    def _prepare_multitask_dialog(self, turn: SimpleTodTurn) -> list[str]:
-        out = []
-        multi_task_special_tokens = get_multi_task_special_tokens()
+        return self.schema_str_cache.get(
+            [schema.service_name for schema in schemas],
+            mtst.prompt_token,
+            turn.active_intent,
+        )
 
-        for mtst in multi_task_special_tokens:
+    def _get_task_targets(
+        self, turn: SimpleTodTurn
+    ) -> Iterator[Tuple[int, MultiTaskSpecialToken, str]]:
+        target, token_offsets = turn.target.render()
+        for task_id, mtst in enumerate(get_multi_task_special_tokens()):
             try:
                 text = self._extract_from_target(
-                    str(turn.target), mtst.start_token, mtst.end_token
+                    target, token_offsets, mtst.start_token, mtst.end_token
                 )
             except ValueError:
                 continue
+            yield task_id, mtst, text
+
+    def _prepare_multitask_dialog(self, turn: SimpleTodTurn) -> list[str]:
+        out = []
+        context = str(turn.context)
+
+        for _, mtst, text in self._get_task_targets(turn):
             row = SimpleTodTurn(
                 dialog_id=turn.dialog_id,
                 turn_id=turn.turn_id,
-                context=str(turn.context) + mtst.prompt_token,
+                context=context + mtst.prompt_token,
                 target=text,
             )
             if self.cfg.should_add_schema:
@@ -271,13 +275,12 @@ class SimpleTODDSTCDataPrep:
             out.append(row.to_csv_row())
         return out
 
-    def _prepare_dialog(
+    def _prepare_dialog_turns(
         self, dstc_dialog: DstcDialog, schemas: Dict[str, DstcSchema]
-    ) -> Optional[List[SimpleTodTurn]]:
-        tod_turns = []
+    ) -> Iterator[SimpleTodTurn]:
         tod_turn = None
         if not self._is_dialogue_in_domain(dstc_dialog.short_services):
-            return None
+            return
 
         for i, (user_turn, system_turn) in enumerate(
             utils.grouper(dstc_dialog.turns, 2)
@@ -289,40 +292,178 @@ class SimpleTODDSTCDataPrep:
             tod_turn.dialog_id = dstc_dialog.dialogue_id
             tod_turn.turn_id = i + 1
             tod_turn.active_intent = user_turn.get_active_intent()
+            yield tod_turn
+
+    def _prepare_dialog(
+        self, dstc_dialog: DstcDialog, schemas: Dict[str, DstcSchema]
+    ) -> Iterator[List[any]]:
+        for tod_turn in self._prepare_dialog_turns(dstc_dialog, schemas):
             if self.cfg.is_multi_task:
-                tod_turns.append(self._prepare_multitask_dialog(tod_turn))
+                yield from self._prepare_multitask_dialog(tod_turn)
             else:
-                tod_turns.append(tod_turn.to_csv_row())
-        if not self.cfg.is_multi_task:
-            return tod_turns
-        out = np.concatenate(tod_turns, axis=0)
-        return out
+                yield tod_turn.to_csv_row()
+
+    def _prepare_normalized_dialog(
+        self,
+        dstc_dialog: DstcDialog,
+        schemas: Dict[str, DstcSchema],
+        out: SimpleTodNormalizedFile,
+    ) -> None:
+        dialog_start = len(out.user_utterances)
+        for tod_turn in self._prepare_dialog_turns(dstc_dialog, schemas):
+            context = tod_turn.context
+            history_end = out.add_utterances(
+                context.current_user_utterance, context.next_system_utterance
+            )
+            history_start = dialog_start + context.history_start
+            turn_id = str(tod_turn.turn_id)
+            if not self.cfg.is_multi_task:
+                out.add_row(
+                    tod_turn.dialog_id,
+                    turn_id,
+                    history_start,
+                    history_end,
+                    -1,
+                    str(tod_turn.target),
+                    None,
+                )
+                continue
+            for task_id, mtst, text in self._get_task_targets(tod_turn):
+                schema = None
+                if self.cfg.should_add_schema:
+                    schema = self._get_schema_str(tod_turn.schemas, tod_turn, mtst)
+                out.add_row(
+                    tod_turn.dialog_id,
+                    turn_id,
+                    history_start,
+                    history_end,
+                    task_id,
+                    text,
+                    schema,
+                )
 
     def _prepare_dialog_file(
         self, path: Path, schemas: Dict[str, DstcSchema]
-    ) -> np.ndarray:
+    ) -> Union[List[List[str]], SimpleTodNormalizedFile]:
+        """
+        Prepared rows of one dialogue file. All values are written as strings,
+        so turn ids stay quoted in the csv files.
+        """
+        if self.dialog_index:
+            dialog_json_data = self.dialog_index.read_dialogs(path, self.cfg.domains)
+        else:
+            dialog_json_data = utils.read_json(path)
+        if self.cfg.data_format == DataFormats.NORMALIZED:
+            data = SimpleTodNormalizedFile()
+            for d in dialog_json_data:
+                dialog = DstcDialog.from_raw_dict(d)
+                self._prepare_normalized_dialog(dialog, schemas, data)
+            return data
         data = []
-        dialog_json_data = utils.read_json(path)
         for d in dialog_json_data:
-            dialog = DstcDialog.from_json(json.dumps(d))
-            prepped_dialog = self._prepare_dialog(dialog, schemas)
-            if prepped_dialog is None:
-                continue
-            data.append(prepped_dialog)
-        if not len(data):
-            return np.array(data)
-        return np.concatenate(data, axis=0)
+            dialog = DstcDialog.from_raw_dict(d)
+            for row in self._prepare_dialog(dialog, schemas):
+                data.append([str(value) for value in row])
+        return data
+
+    def _get_schema_path(self, step: str) -> Path:
+        return self.cfg.data_root / step / "schema.json"
 
     def _get_schemas(self, step: str) -> Dict[str, DstcSchema]:
-        path = self.cfg.data_root / step / "schema.json"
-        schema_json = utils.read_json(path)
+        schema_json = utils.read_json(self._get_schema_path(step))
         schemas = {}
         for s in schema_json:
-            schema: DstcSchema = DstcSchema.from_json(json.dumps(s))
+            schema = DstcSchema.from_raw_dict(s)
             schema.step = step
             schemas[schema.service_name] = schema
         return schemas
 
+    def _get_num_workers(self, num_files: int) -> int:
+        # None opts into a worker per cpu
+        num_workers = self.cfg.prep_num_workers or os.cpu_count() or 1
+        return min(num_workers, num_files)
+
+    def _get_worker_data_prep(self) -> "SimpleTODDSTCDataPrep":
+        """
+        Copy of the data prep sent to the pool workers, without the prep cache,
+        which only the parent reads and writes, and the schema str cache, which
+        every worker fills for its own files.
+        """
+        data_prep = copy.copy(self)
+        data_prep.cache = None
+        data_prep.schema_str_cache = None
+        return data_prep
+
+    def _prepare_dialog_files(
+        self, dialog_paths: List[str], schemas: Dict[str, DstcSchema]
+    ) -> Iterator[List[List[str]]]:
+        num_workers = self._get_num_workers(len(dialog_paths))
+        if num_workers <= 1:
+            for d in tqdm(dialog_paths):
+                yield self._prepare_dialog_file(d, schemas)
+            return
+        # schemas are sent once per worker through the initializer. Results are
+        # yielded in file order, so the output matches the serial path, and at
+        # most max_pending_files_per_worker files per worker are submitted ahead
+        # of the writer, so prepared files do not pile up when writing is slower
+        max_pending = num_workers * self.max_pending_files_per_worker
+        with Pool(
+            num_workers,
+            initializer=_init_prep_worker,
+            initargs=(self._get_worker_data_prep(), schemas),
+        ) as pool, tqdm(total=len(dialog_paths)) as progress:
+            pending = deque()
+            for path in dialog_paths:
+                pending.append(
+                    pool.apply_async(_prepare_dialog_file_in_worker, (path,))
+                )
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+                    progress.update()
+            while pending:
+                yield pending.popleft().get()
+                progress.update()
+
+    def _prepare_cached_dialog_files(
+        self,
+        dialog_paths: List[str],
+        fragment_keys: List[str],
+        schemas: Dict[str, DstcSchema],
+        should_overwrite: bool,
+    ) -> Iterator[List[List[str]]]:
+        missing = [
+            i
+            for i, key in enumerate(fragment_keys)
+            if should_overwrite or not self.cache.contains(key)
+        ]
+        print(
+            f"reusing {len(fragment_keys) - len(missing)} of {len(fragment_keys)} cached dialog files"
+        )
+        prepared = self._prepare_dialog_files(
+            [dialog_paths[i] for i in missing], schemas
+        )
+        missing = set(missing)
+        for i, (path, key) in enumerate(zip(dialog_paths, fragment_keys)):
+            if i in missing:
+                data = next(prepared)
+                self.cache.put(key, data)
+            else:
+                data = self.cache.get(key)
+                if data is None:
+                    # fragment was evicted or is unreadable
+                    data = self._prepare_dialog_file(path, schemas)
+                    self.cache.put(key, data)
+            yield data
+
+    def _get_split_key_path(self, csv_file_path: Path) -> Path:
+        return csv_file_path.with_name(csv_file_path.name + ".key")
+
+    def _is_split_up_to_date(self, csv_file_path: Path, split_key: str) -> bool:
+        try:
+            return self._get_split_key_path(csv_file_path).read_text() == split_key
+        except FileNotFoundError:
+            return False
+
     def run(self):
         steps = Steps.list()
         for step, num_dialog, should_overwrite in tqdm(
@@ -332,47 +473,116 @@ class SimpleTODDSTCDataPrep:
             step_dir.mkdir(parents=True, exist_ok=True)
             dialog_paths = get_dialog_file_paths(self.cfg.data_root, step)
             schemas = self._get_schemas(step)
-            out_data = []
+            self.schema_str_cache = SimpleTodSchemaStrCache(schemas)
             if num_dialog == "None":
                 num_dialog = len(dialog_paths)
-            csv_file_path = get_csv_data_path(
+            csv_file_path = get_data_path(
                 step=step,
                 num_dialogs=num_dialog,
                 cfg=self.cfg,
             )
+            dialog_paths = dialog_paths[:num_dialog]
+            if self.cfg.should_use_dialog_index:
+                self.dialog_index = DstcDialogIndex(step_dir / "dialog_index.json")
+                if self.dialog_index.update(dialog_paths):
+                    self.dialog_index.save()
+            if self.cache:
+                fragment_keys = self.cache.get_fragment_keys(
+                    self.cache.get_config_key(self._get_schema_path(step)),
+                    dialog_paths,
+                )
+                split_key = self.cache.get_split_key(fragment_keys)
             if csv_file_path.exists() and not should_overwrite:
-                print(
-                    f"{step} csv file already exists and overwrite is false, so skipping"
+                if not self.cache:
+                    print(
+                        f"{step} data file already exists and overwrite is false, so skipping"
+                    )
+                    continue
+                if self._is_split_up_to_date(csv_file_path, split_key):
+                    print(f"{step} data file is up to date with its inputs, so skipping")
+                    continue
+
+            if self.cache:
+                res = self._prepare_cached_dialog_files(
+                    dialog_paths, fragment_keys, schemas, should_overwrite
                 )
-                continue
-
-            # res = list(
-            #     tqdm(
-            #         Pool().imap(
-            #             self._prepare_dialog_file,
-            #             dialog_paths[:num_dialog],
-            #
-            #            itertools.repeat(schemas),
-            #         ),
-            #         total=num_dialog,
-            #     )
-            # )
-            res = []
-            for d in tqdm(dialog_paths[:num_dialog]):
-                output = self._prepare_dialog_file(d, schemas)
-                if res is not None:
-                    res.append(output)
-            out_data = [d for d in res if len(d)]
+            else:
+                res = self._prepare_dialog_files(dialog_paths, schemas)
             headers = (
                 ["dialog_id", "turn_id", "context", "target", "schema"]
                 if self.cfg.should_add_schema
                 else ["dialog_id", "turn_id", "context", "target"]
             )
-            if len(out_data) == 0:
+            num_rows = self._write_rows(headers, res, csv_file_path)
+            self._print_peak_rss(step)
+            if num_rows == 0:
                 print(f"No data for {step}")
                 continue
-            csv_data = np.concatenate(out_data, axis=0)
-            utils.write_csv(headers, csv_data, csv_file_path)
+            if self.cache:
+                self._get_split_key_path(csv_file_path).write_text(split_key)
+        if self.cache:
+            self.cache.save()
+
+    def _write_rows(
+        self, headers: List[str], files: Iterator[List[List[str]]], file_path: Path
+    ) -> int:
+        """
+        Streams the rows of every prepared dialogue file into the data file, so
+        at most one dialogue file is held in memory. Rows are written to a temp
+        file that replaces the data file only if there were any rows.
+        """
+        tmp_path = file_path.with_name(file_path.name + ".tmp")
+        if self.cfg.data_format == DataFormats.NORMALIZED:
+            writer = SimpleTodNormalizedWriter(
+                tmp_path, self.cfg.should_add_sys_actions
+            )
+        elif self.cfg.data_format == DataFormats.PARQUET:
+            writer = utils.ParquetRowWriter(headers, tmp_path)
+        else:
+            writer = utils.CsvRowWriter(headers, tmp_path)
+        with writer:
+            for rows in files:
+                writer.write_rows(rows)
+        if not writer.num_rows:
+            utils.remove_path(tmp_path)
+            return 0
+        # the normalized format is a directory, which can not be replaced in place
+        if file_path.is_dir():
+            shutil.rmtree(file_path)
+        os.replace(tmp_path, file_path)
+        return writer.num_rows
+
+    def _print_peak_rss(self, step: str) -> None:
+        """
+        Peak rss of this process and of the largest finished prep worker. The
+        kernel only keeps the maximum over the children, so the sum of the
+        workers is not known and the two are not added up.
+        """
+        # ru_maxrss is in kilobytes on linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        message = f"{step} peak rss {peak:.0f} MB"
+        # zero when no pool was started
+        worker_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        if worker_peak:
+            message += f", largest prep worker peak rss {worker_peak:.0f} MB"
+        print(message)
+
+
+_worker_data_prep: Optional[SimpleTODDSTCDataPrep] = None
+_worker_schemas: Optional[Dict[str, DstcSchema]] = None
+
+
+def _init_prep_worker(
+    data_prep: SimpleTODDSTCDataPrep, schemas: Dict[str, DstcSchema]
+):
+    global _worker_data_prep, _worker_schemas
+    _worker_data_prep = data_prep
+    _worker_data_prep.schema_str_cache = SimpleTodSchemaStrCache(schemas)
+    _worker_schemas = schemas
+
+
+def _prepare_dialog_file_in_worker(path: str) -> List[List[str]]:
+    return _worker_data_prep._prepare_dialog_file(path, _worker_schemas)
 
 
 @hydra.main(config_path="../config/data_prep/", config_name="simple_tod")
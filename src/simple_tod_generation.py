@@ -0,0 +1,539 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import GPT2LMHeadModel, StoppingCriteria
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+@dataclass
+class TaskStop:
+    end_token_id: int
+    max_new_tokens: int
+
+
+def get_row_stop(
+    row: torch.Tensor,
+    task_stops: Dict[int, TaskStop],
+    eos_token_id: int,
+    max_new_tokens: int,
+) -> Tuple[int, int]:
+    """
+    Stop token and max new tokens of an unpadded context, from the task prompt
+    at its end. Single task rows and rows of unknown tasks stop at eos.
+    """
+    if task_stops:
+        for token in reversed(row[-2:].tolist()):
+            if token in task_stops:
+                stop = task_stops[token]
+                return stop.end_token_id, min(stop.max_new_tokens, max_new_tokens)
+    return eos_token_id, max_new_tokens
+
+
+class TaskEndStoppingCriteria(StoppingCriteria):
+    """
+    Stops generate on a padded batch once every row generated eos, the end token
+    of its task or its max new tokens. generate keeps running the rows that are
+    done, pad_after_stop removes what they generated after their stop.
+    """
+
+    def __init__(
+        self,
+        context_len: int,
+        stop_token_ids: torch.Tensor,
+        max_new_tokens: torch.Tensor,
+        eos_token_id: int,
+    ):
+        self.context_len = context_len
+        self.stop_token_ids = stop_token_ids
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> bool:
+        new_tokens = input_ids[:, self.context_len :]
+        is_stopped = (new_tokens == self.stop_token_ids[:, None]) | (
+            new_tokens == self.eos_token_id
+        )
+        is_done = is_stopped.any(dim=1) | (new_tokens.shape[1] >= self.max_new_tokens)
+        return bool(is_done.all())
+
+    def pad_after_stop(self, gen: torch.Tensor, pad_token_id: int) -> torch.Tensor:
+        new_tokens = gen[:, self.context_len :]
+        positions = torch.arange(new_tokens.shape[1], device=gen.device)
+        is_stopped = (new_tokens == self.stop_token_ids[:, None]) | (
+            new_tokens == self.eos_token_id
+        )
+        # position of the first stop token, the budget when there is none
+        first_stop = torch.where(
+            is_stopped, positions, torch.full_like(positions, new_tokens.shape[1])
+        ).min(dim=1).values
+        last = torch.minimum(first_stop + 1, self.max_new_tokens)
+        new_tokens[positions >= last[:, None]] = pad_token_id
+        return gen
+
+
+class SharedPrefixGenerator:
+    """
+    Greedy generation for rows that share a context prefix.
+
+    In multi task mode the rows of a turn only differ in the prompt token at
+    the end of the context. Rows are grouped by a key such as
+    (dialog_id, turn_id), the longest common prefix of a group is encoded once
+    and its past_key_values are forked for every row, which then only encodes
+    its own suffix. The tokens of a row are the greedy continuation of its
+    unpadded context, generation of a row stops after eos, or after the end
+    token of its task when task_stops maps task prompt tokens to their stops.
+    Rows that stopped are dropped from the decode batch.
+    """
+
+    def __init__(
+        self,
+        model: GPT2LMHeadModel,
+        eos_token_id: int,
+        pad_token_id: int,
+        max_new_tokens: int,
+        task_stops: Dict[int, TaskStop] = None,
+    ):
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.max_new_tokens = max_new_tokens
+        self.task_stops = task_stops
+        self.num_encoded_tokens = 0
+
+    @staticmethod
+    def get_common_prefix_len(rows: List[torch.Tensor]) -> int:
+        # every row keeps at least one token, its logits start the generation
+        max_len = min(len(row) for row in rows) - 1
+        stacked = torch.stack([row[:max_len] for row in rows])
+        mismatch = torch.nonzero(~(stacked == stacked[0]).all(dim=0))
+        return mismatch[0].item() if len(mismatch) else max_len
+
+    @staticmethod
+    def slice_past(past: PastKeyValues, length: int) -> PastKeyValues:
+        """Keys and values of the first length tokens"""
+        return tuple(tuple(t[:, :, :length] for t in layer) for layer in past)
+
+    @staticmethod
+    def fork_past(past: PastKeyValues, num_rows: int) -> PastKeyValues:
+        # expand does not copy, the new keys and values of a row are concatenated
+        return tuple(
+            tuple(t.expand(num_rows, -1, -1, -1) for t in layer) for layer in past
+        )
+
+    @staticmethod
+    def select_past(past: PastKeyValues, indices: torch.Tensor) -> PastKeyValues:
+        return tuple(tuple(t.index_select(0, indices) for t in layer) for layer in past)
+
+    def _encode(self, input_ids: torch.Tensor, past: PastKeyValues = None):
+        self.num_encoded_tokens += input_ids.numel()
+        return self.model(input_ids=input_ids, past_key_values=past, use_cache=True)
+
+    def _greedy(
+        self,
+        input_ids: torch.Tensor,
+        past: PastKeyValues = None,
+        stops: List[Tuple[int, int]] = None,
+    ) -> List[List[int]]:
+        generated = [[] for _ in range(len(input_ids))]
+        stops = stops or [(self.eos_token_id, self.max_new_tokens)] * len(input_ids)
+        rows = list(range(len(input_ids)))
+        stop_token_ids = torch.tensor([stop for stop, _ in stops], device=input_ids.device)
+        max_new_tokens = torch.tensor([limit for _, limit in stops], device=input_ids.device)
+        for step in range(max(limit for _, limit in stops)):
+            output = self._encode(input_ids, past)
+            next_tokens = output.logits[:, -1].argmax(dim=-1)
+            for i, token in zip(rows, next_tokens.tolist()):
+                generated[i].append(token)
+            is_done = (
+                (next_tokens == self.eos_token_id)
+                | (next_tokens == stop_token_ids)
+                | (max_new_tokens <= step + 1)
+            )
+            if is_done.all():
+                break
+            past = output.past_key_values
+            if is_done.any():
+                keep = torch.nonzero(~is_done).squeeze(1)
+                past = self.select_past(past, keep)
+                rows = [rows[i] for i in keep.tolist()]
+                stop_token_ids = stop_token_ids[keep]
+                max_new_tokens = max_new_tokens[keep]
+                next_tokens = next_tokens[keep]
+            input_ids = next_tokens[:, None]
+        return generated
+
+    def encode_prefix(self, key: Hashable, prefix: torch.Tensor) -> PastKeyValues:
+        return self._encode(prefix[None]).past_key_values
+
+    def generate_group(
+        self, rows: List[torch.Tensor], key: Hashable = None
+    ) -> List[List[int]]:
+        prefix_len = self.get_common_prefix_len(rows)
+        past = None
+        if prefix_len:
+            past = self.encode_prefix(key, rows[0][:prefix_len])
+        # rows with suffixes of the same length are generated together
+        by_suffix_len: Dict[int, List[int]] = {}
+        for i, row in enumerate(rows):
+            by_suffix_len.setdefault(len(row) - prefix_len, []).append(i)
+        generated = [None] * len(rows)
+        for indices in by_suffix_len.values():
+            input_ids = torch.stack([rows[i][prefix_len:] for i in indices])
+            branch_past = (
+                self.fork_past(past, len(indices)) if past is not None else None
+            )
+            stops = [
+                get_row_stop(
+                    rows[i], self.task_stops, self.eos_token_id, self.max_new_tokens
+                )
+                for i in indices
+            ]
+            for i, tokens in zip(indices, self._greedy(input_ids, branch_past, stops)):
+                generated[i] = tokens
+        return generated
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        context_tokens: torch.Tensor,
+        attention_mask: torch.Tensor,
+        group_keys: List[Hashable],
+    ) -> torch.Tensor:
+        """
+        Same layout as generate on the padded batch: the context tokens followed
+        by the new tokens, padded to the longest generation of the batch.
+        """
+        rows = [ids[mask.bool()] for ids, mask in zip(context_tokens, attention_mask)]
+        groups: Dict[Hashable, List[int]] = {}
+        for i, key in enumerate(group_keys):
+            groups.setdefault(key, []).append(i)
+        generated = [None] * len(rows)
+        for key, indices in groups.items():
+            group_tokens = self.generate_group([rows[i] for i in indices], key)
+            for i, tokens in zip(indices, group_tokens):
+                generated[i] = tokens
+        return self.get_output(context_tokens, generated)
+
+    def get_output(
+        self, context_tokens: torch.Tensor, generated: List[List[int]]
+    ) -> torch.Tensor:
+        context_len = context_tokens.shape[1]
+        out = torch.full(
+            [len(generated), context_len + max(map(len, generated))],
+            self.pad_token_id,
+            dtype=context_tokens.dtype,
+            device=context_tokens.device,
+        )
+        out[:, :context_len] = context_tokens
+        for i, tokens in enumerate(generated):
+            out[i, context_len : context_len + len(tokens)] = torch.tensor(tokens)
+        return out
+
+
+class IncrementalDialogueGenerator(SharedPrefixGenerator):
+    """
+    SharedPrefixGenerator that keeps the keys and values of the last prefix of
+    the current dialogue. Group keys start with the dialog_id, and rows come
+    in dialogue order, as in the prepared test files.
+
+    The context of a turn starts with the history of the previous turn, so only
+    the tokens after the part shared with the previous prefix are encoded, the
+    new utterances and the current user utterance. When the window slides
+    past num_turns, or the context was truncated, the shared part ends right
+    after the start of the context and the prefix is encoded again, encoding
+    with a short past is slower than encoding from scratch.
+    """
+
+    min_reused_fraction = 0.5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dialog_id = None
+        self.prefix: torch.Tensor = None
+        self.past: PastKeyValues = None
+        self.num_reused_tokens = 0
+
+    def _get_reusable_len(self, dialog_id: Hashable, prefix: torch.Tensor) -> int:
+        if dialog_id != self.dialog_id or self.past is None:
+            return 0
+        length = min(len(self.prefix), len(prefix))
+        mismatch = torch.nonzero(self.prefix[:length] != prefix[:length])
+        return mismatch[0].item() if len(mismatch) else length
+
+    def encode_prefix(self, key: Hashable, prefix: torch.Tensor) -> PastKeyValues:
+        dialog_id = key[0] if isinstance(key, tuple) else key
+        reused = self._get_reusable_len(dialog_id, prefix)
+        if reused < self.min_reused_fraction * len(prefix):
+            reused = 0
+        past = self.slice_past(self.past, reused) if reused else None
+        if reused < len(prefix):
+            past = self._encode(prefix[None, reused:], past).past_key_values
+        self.num_reused_tokens += reused
+        # only the current dialogue is kept
+        self.dialog_id, self.prefix, self.past = dialog_id, prefix, past
+        return past
+
+
+@dataclass
+class GenerationSlots:
+    """
+    Rows decoding together. Their keys and values are right aligned in one
+    padded past, the mask is 0 for the padding and positions are the positions
+    of the next input token of every slot.
+    """
+
+    rows: List[Tuple[int, int]]
+    past: PastKeyValues
+    mask: torch.Tensor
+    positions: torch.Tensor
+    next_tokens: torch.Tensor
+    stop_token_ids: torch.Tensor
+    max_new_tokens: torch.Tensor
+    num_generated: torch.Tensor
+
+    @classmethod
+    def from_rows(
+        self,
+        rows: List[Tuple[int, int]],
+        past: PastKeyValues,
+        stops: List[Tuple[int, int]],
+    ) -> "GenerationSlots":
+        """Slots of rows with contexts of the same length, before their first token"""
+        batch_size, _, length, _ = past[0][0].shape
+        device = past[0][0].device
+        return self(
+            rows,
+            past,
+            torch.ones([batch_size, length], dtype=torch.int64, device=device),
+            torch.full([batch_size], length, device=device),
+            None,
+            torch.tensor([stop for stop, _ in stops], device=device),
+            torch.tensor([limit for _, limit in stops], device=device),
+            torch.zeros([batch_size], dtype=torch.int64, device=device),
+        )
+
+    @classmethod
+    def concat(self, slots: List["GenerationSlots"]) -> "GenerationSlots":
+        length = max(s.mask.shape[1] for s in slots)
+        past = tuple(
+            tuple(
+                torch.cat(
+                    [
+                        F.pad(s.past[layer][i], (0, 0, length - s.mask.shape[1], 0))
+                        for s in slots
+                    ]
+                )
+                for i in range(2)
+            )
+            for layer in range(len(slots[0].past))
+        )
+        mask = torch.cat([F.pad(s.mask, (length - s.mask.shape[1], 0)) for s in slots])
+        fields = [
+            "positions",
+            "next_tokens",
+            "stop_token_ids",
+            "max_new_tokens",
+            "num_generated",
+        ]
+        return self(
+            [row for s in slots for row in s.rows],
+            past,
+            mask,
+            *(torch.cat([getattr(s, field) for s in slots]) for field in fields),
+        )
+
+    def select(self, indices: torch.Tensor) -> Optional["GenerationSlots"]:
+        if not len(indices):
+            return None
+        if len(indices) == len(self.rows):
+            return self
+        mask = self.mask[indices]
+        # columns that are padding in every slot left are dropped
+        start = torch.nonzero(mask.any(dim=0))[0].item()
+        return GenerationSlots(
+            [self.rows[i] for i in indices.tolist()],
+            tuple(
+                tuple(t.index_select(0, indices)[:, :, start:] for t in layer)
+                for layer in self.past
+            ),
+            mask[:, start:],
+            self.positions[indices],
+            self.next_tokens[indices],
+            self.stop_token_ids[indices],
+            self.max_new_tokens[indices],
+            self.num_generated[indices],
+        )
+
+
+@dataclass
+class _GenerationBatch:
+    context_tokens: torch.Tensor
+    generated: List[List[int]]
+    num_running: int
+
+
+class ContinuousBatchingGenerator(SharedPrefixGenerator):
+    """
+    Greedy generation with num_slots rows decoding together. A row that stops is
+    evicted and the next waiting row takes its slot, also rows of the next
+    batches, so one long row does not keep the slots of the short rows of its
+    batch idle. Batches are returned in order once all of their rows stopped.
+
+    The context of a row is encoded when it takes a slot. The rows of a group
+    are admitted together, which can take a few slots more than num_slots, and
+    share the encoding of their common prefix.
+    """
+
+    def __init__(
+        self,
+        model: GPT2LMHeadModel,
+        eos_token_id: int,
+        pad_token_id: int,
+        max_new_tokens: int,
+        task_stops: Dict[int, TaskStop] = None,
+        num_slots: int = 32,
+    ):
+        super().__init__(model, eos_token_id, pad_token_id, max_new_tokens, task_stops)
+        self.num_slots = num_slots
+
+    def _add_tokens(
+        self,
+        slots: GenerationSlots,
+        next_tokens: torch.Tensor,
+        batches: Dict[int, "_GenerationBatch"],
+    ) -> Optional[GenerationSlots]:
+        """Adds the new token of every slot, the slots that did not stop are returned"""
+        slots.next_tokens = next_tokens
+        slots.num_generated = slots.num_generated + 1
+        is_done = (
+            (next_tokens == self.eos_token_id)
+            | (next_tokens == slots.stop_token_ids)
+            | (slots.num_generated >= slots.max_new_tokens)
+        )
+        for (batch_id, row_id), token, done in zip(
+            slots.rows, next_tokens.tolist(), is_done.tolist()
+        ):
+            batches[batch_id].generated[row_id].append(token)
+            batches[batch_id].num_running -= done
+        return slots.select(torch.nonzero(~is_done).squeeze(1))
+
+    def _prefill(
+        self, admitted: List[tuple], batches: Dict[int, "_GenerationBatch"]
+    ) -> List[GenerationSlots]:
+        """
+        Encodes the contexts of the admitted rows, the rows of a group share the
+        encoding of their common prefix and suffixes of the same length are
+        encoded together. Slots of the rows that did not stop at their first
+        token are returned.
+        """
+        groups: Dict[Hashable, List[int]] = {}
+        for i, (batch_id, _, key, row) in enumerate(admitted):
+            stop = get_row_stop(row, self.task_stops, self.eos_token_id, self.max_new_tokens)
+            if stop[1] <= 0:
+                batches[batch_id].num_running -= 1
+                continue
+            groups.setdefault(key, []).append(i)
+        new_slots = []
+        for key, indices in groups.items():
+            rows = [admitted[i][3] for i in indices]
+            prefix_len = self.get_common_prefix_len(rows) if len(rows) > 1 else 0
+            past = self.encode_prefix(key, rows[0][:prefix_len]) if prefix_len else None
+            by_suffix_len: Dict[int, List[int]] = {}
+            for i, row in zip(indices, rows):
+                by_suffix_len.setdefault(len(row) - prefix_len, []).append(i)
+            for suffix_indices in by_suffix_len.values():
+                suffix_rows = [admitted[i][3] for i in suffix_indices]
+                output = self._encode(
+                    torch.stack([row[prefix_len:] for row in suffix_rows]),
+                    self.fork_past(past, len(suffix_rows)) if past is not None else None,
+                )
+                slots = GenerationSlots.from_rows(
+                    [admitted[i][:2] for i in suffix_indices],
+                    output.past_key_values,
+                    [
+                        get_row_stop(
+                            row, self.task_stops, self.eos_token_id, self.max_new_tokens
+                        )
+                        for row in suffix_rows
+                    ],
+                )
+                slots = self._add_tokens(slots, output.logits[:, -1].argmax(dim=-1), batches)
+                if slots:
+                    new_slots.append(slots)
+        return new_slots
+
+    def _decode(
+        self, slots: GenerationSlots, batches: Dict[int, "_GenerationBatch"]
+    ) -> Optional[GenerationSlots]:
+        mask = F.pad(slots.mask, (0, 1), value=1)
+        self.num_encoded_tokens += len(slots.rows)
+        output = self.model(
+            input_ids=slots.next_tokens[:, None],
+            past_key_values=slots.past,
+            attention_mask=mask,
+            position_ids=slots.positions[:, None],
+            use_cache=True,
+        )
+        slots.past = output.past_key_values
+        slots.mask = mask
+        slots.positions = slots.positions + 1
+        return self._add_tokens(slots, output.logits[:, -1].argmax(dim=-1), batches)
+
+    @torch.inference_mode()
+    def generate_batches(
+        self, batches: Iterable[Tuple[torch.Tensor, torch.Tensor, List[Hashable]]]
+    ) -> Iterator[torch.Tensor]:
+        """
+        Takes (context_tokens, attention_mask, group_keys) batches and yields the
+        output of every batch, in the layout of generate.
+        """
+        batches = iter(batches)
+        pending: Dict[int, _GenerationBatch] = {}
+        waiting = deque()
+        slots: Optional[GenerationSlots] = None
+        num_batches = num_returned = 0
+        while True:
+            num_free = self.num_slots - (len(slots.rows) if slots else 0)
+            while len(waiting) < num_free:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                context_tokens, attention_mask, group_keys = batch
+                rows = [ids[m.bool()] for ids, m in zip(context_tokens, attention_mask)]
+                pending[num_batches] = _GenerationBatch(
+                    context_tokens, [[] for _ in rows], len(rows)
+                )
+                for row_id, (key, row) in enumerate(zip(group_keys, rows)):
+                    waiting.append((num_batches, row_id, key, row))
+                num_batches += 1
+            num_admitted = max(0, min(num_free, len(waiting)))
+            # the rows of a group are admitted together to share their prefix
+            while (
+                0 < num_admitted < len(waiting)
+                and waiting[num_admitted][2] == waiting[num_admitted - 1][2]
+            ):
+                num_admitted += 1
+            admitted = [waiting.popleft() for _ in range(num_admitted)]
+            new_slots = self._prefill(admitted, pending)
+            if new_slots:
+                slots = GenerationSlots.concat(([slots] if slots else []) + new_slots)
+            if slots:
+                slots = self._decode(slots, pending)
+            while num_returned in pending and not pending[num_returned].num_running:
+                batch = pending.pop(num_returned)
+                yield self.get_output(batch.context_tokens, batch.generated)
+                num_returned += 1
+            if not (slots or waiting or pending):
+                break
+
+    def generate(
+        self,
+        context_tokens: torch.Tensor,
+        attention_mask: torch.Tensor,
+        group_keys: List[Hashable],
+    ) -> torch.Tensor:
+        return next(self.generate_batches([(context_tokens, attention_mask, group_keys)]))
@@ -0,0 +1,189 @@
+from pathlib import Path
+import shutil
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from simple_tod_dataclasses import (
+    SimpleTodTurnCsvRow,
+    get_multi_task_special_tokens,
+    render_context,
+    render_context_turn,
+)
+import utils
+
+
+class SimpleTodNormalizedFile:
+    """
+    Prepared rows of one dialogue file in the normalized format.
+    Every (user, system) utterance pair is stored once, and a row refers to its
+    history by a range of pair indices. The current user utterance of a row is
+    the user utterance of the pair at history_end. Indices are local to the file.
+    """
+
+    def __init__(self):
+        self.user_utterances: List[Optional[str]] = []
+        self.system_utterances: List[Optional[str]] = []
+        self.rows: List[list] = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_utterances(self, user: Optional[str], system: Optional[str]) -> int:
+        self.user_utterances.append(user)
+        self.system_utterances.append(system)
+        return len(self.user_utterances) - 1
+
+    def add_row(
+        self,
+        dialog_id: str,
+        turn_id: str,
+        history_start: int,
+        history_end: int,
+        task_id: int,
+        target: str,
+        schema: Optional[str],
+    ):
+        self.rows.append(
+            [dialog_id, turn_id, history_start, history_end, task_id, target, schema]
+        )
+
+
+class SimpleTodNormalizedWriter:
+    """
+    Writes normalized dialogue files into a directory holding an utterance
+    table, a row table and a table of the distinct schema strings.
+    task_id indexes get_multi_task_special_tokens and is -1 for single task
+    rows, schema_id is -1 when a row has no schema.
+    """
+
+    row_schema = pa.schema(
+        [
+            ("dialog_id", pa.string()),
+            ("turn_id", pa.string()),
+            ("history_start", pa.int32()),
+            ("history_end", pa.int32()),
+            ("task_id", pa.int8()),
+            ("target", pa.string()),
+            ("schema_id", pa.int32()),
+        ]
+    )
+    utterance_schema = pa.schema([("user", pa.string()), ("system", pa.string())])
+
+    def __init__(self, dir_path: Path, should_add_sys_actions: bool):
+        self.dir_path = dir_path
+        self.should_add_sys_actions = should_add_sys_actions
+        self.schema_ids: Dict[str, int] = {}
+        self.num_utterances = 0
+        self.num_rows = 0
+
+    def __enter__(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+        self.dir_path.mkdir(parents=True)
+        self.utterance_writer = utils.ParquetRowWriter(
+            self.utterance_schema.names,
+            self.dir_path / "utterances.parquet",
+            schema=self.utterance_schema,
+        ).__enter__()
+        self.row_writer = utils.ParquetRowWriter(
+            self.row_schema.names,
+            self.dir_path / "rows.parquet",
+            schema=self.row_schema,
+        ).__enter__()
+        return self
+
+    def _get_schema_id(self, schema: Optional[str]) -> int:
+        if not schema:
+            return -1
+        return self.schema_ids.setdefault(schema, len(self.schema_ids))
+
+    def write_rows(self, data: SimpleTodNormalizedFile):
+        offset = self.num_utterances
+        self.utterance_writer.write_rows(
+            list(zip(data.user_utterances, data.system_utterances))
+        )
+        self.row_writer.write_rows(
+            [
+                [
+                    dialog_id,
+                    turn_id,
+                    history_start + offset,
+                    history_end + offset,
+                    task_id,
+                    target,
+                    self._get_schema_id(schema),
+                ]
+                for dialog_id, turn_id, history_start, history_end, task_id, target, schema in data.rows
+            ]
+        )
+        self.num_utterances += len(data.user_utterances)
+        self.num_rows += len(data)
+
+    def __exit__(self, *args):
+        self.utterance_writer.__exit__(*args)
+        self.row_writer.__exit__(*args)
+        pq.write_table(
+            pa.table({"schema": pa.array(list(self.schema_ids), type=pa.string())}),
+            self.dir_path / "schemas.parquet",
+            compression="zstd",
+        )
+        utils.write_json(
+            {
+                "num_rows": self.num_rows,
+                "num_utterances": self.num_utterances,
+                "should_add_sys_actions": self.should_add_sys_actions,
+            },
+            self.dir_path / "meta.json",
+        )
+
+
+class SimpleTodNormalizedData:
+    """
+    Reads a normalized data directory. Utterances and schemas are small and kept
+    as python lists, row fields stay in arrow columns, and the context of a row
+    is rendered when the row is requested.
+    """
+
+    def __init__(self, dir_path: Path, split_percent: float = 1):
+        self.meta = utils.read_json(dir_path / "meta.json")
+        utterances = pq.read_table(dir_path / "utterances.parquet")
+        self.user_utterances = utterances.column("user").to_pylist()
+        self.system_utterances = utterances.column("system").to_pylist()
+        self.schemas = pq.read_table(dir_path / "schemas.parquet").column("schema")
+        self.schemas = self.schemas.to_pylist()
+        rows = pq.read_table(dir_path / "rows.parquet", memory_map=True)
+        self.num_rows = int(rows.num_rows * split_percent)
+        self.columns = {
+            name: rows.column(name).slice(0, self.num_rows)
+            for name in rows.column_names
+        }
+        self.prompt_tokens = [mtst.prompt_token for mtst in get_multi_task_special_tokens()]
+
+    def __len__(self):
+        return self.num_rows
+
+    def get_context(self, history_start: int, history_end: int, task_id: int) -> str:
+        rendered_history = "".join(
+            render_context_turn(self.user_utterances[i], self.system_utterances[i])
+            for i in range(history_start, history_end)
+        )
+        context = render_context(
+            rendered_history,
+            self.user_utterances[history_end],
+            self.meta["should_add_sys_actions"],
+        )
+        if task_id >= 0:
+            context += self.prompt_tokens[task_id]
+        return context
+
+    def get_row(self, idx: int) -> SimpleTodTurnCsvRow:
+        row = {name: column[idx].as_py() for name, column in self.columns.items()}
+        schema_id = row["schema_id"]
+        return SimpleTodTurnCsvRow(
+            row["dialog_id"],
+            row["turn_id"],
+            self.get_context(row["history_start"], row["history_end"], row["task_id"]),
+            row["target"],
+            self.schemas[schema_id] if schema_id >= 0 else None,
+        )
@@ -0,0 +1,218 @@
+from itertools import islice
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+from tqdm import tqdm
+from transformers import PreTrainedTokenizerFast
+
+import dstc_utils
+from my_enums import SpecialTokens
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+import utils
+
+
+def get_turn_token_ids(tokenizer: PreTrainedTokenizerFast) -> list[int]:
+    """Ids of the tokens that start a turn of the context"""
+    return tokenizer.convert_tokens_to_ids(
+        [SpecialTokens.user.value, SpecialTokens.begin_last_user_utterance.value]
+    )
+
+
+class SimpleTodTokenizedShard:
+    """
+    Token ids of a prepared data file, one flat int32 array and an offsets table
+    per field. Row i of a field is ids[offsets[i] : offsets[i + 1]].
+    The context turns table holds, per row, the positions in the context ids
+    where a history turn starts, followed by the position of the last user
+    utterance. The arrays are memory mapped, so forked dataloader workers share them.
+    """
+
+    fields = ["context", "target", "schema"]
+
+    def __init__(self, shard_dir: Path):
+        self.shard_dir = shard_dir
+        self.meta = utils.read_json(shard_dir / "meta.json")
+        self.ids = {}
+        self.offsets = {}
+        for field in self.fields:
+            self.ids[field] = np.load(shard_dir / f"{field}_ids.npy", mmap_mode="r")
+            self.offsets[field] = np.load(
+                shard_dir / f"{field}_offsets.npy", mmap_mode="r"
+            )
+        self.context_turns = np.load(shard_dir / "context_turns.npy", mmap_mode="r")
+        self.context_turns_offsets = np.load(
+            shard_dir / "context_turns_offsets.npy", mmap_mode="r"
+        )
+
+    def __len__(self):
+        return self.meta["num_rows"]
+
+    def get(self, field: str, idx: int) -> np.ndarray:
+        offsets = self.offsets[field]
+        return self.ids[field][offsets[idx] : offsets[idx + 1]]
+
+    def get_lengths(self, field: str) -> np.ndarray:
+        return np.diff(self.offsets[field])
+
+    def get_context_turn_starts(self, idx: int) -> np.ndarray:
+        offsets = self.context_turns_offsets
+        return self.context_turns[offsets[idx] : offsets[idx + 1]]
+
+
+class SimpleTodTokenizedDataPrep:
+    """
+    Tokenizes every row of a prepared data file once, the same way the training
+    collator does (tokenizer.encode with bos and eos, missing fields are empty).
+    Shards live next to the data file and are keyed by the tokenizer identity,
+    a shard is rebuilt when the data file changes or was written in an older format.
+    """
+
+    format_version = 2
+
+    def __init__(self, tokenizer: PreTrainedTokenizerFast, batch_size: int = 10000):
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+
+    def get_shard_dir(self, data_path: Path) -> Path:
+        return (
+            data_path.parent
+            / f"{data_path.stem}.tokens"
+            / dstc_utils.get_tokenizer_key(self.tokenizer)
+        )
+
+    def _get_data_file_state(self, data_path: Path) -> dict:
+        stat = os.stat(data_path)
+        return {"data_file_size": stat.st_size, "data_file_mtime_ns": stat.st_mtime_ns}
+
+    def load(self, data_path: Path) -> Optional[SimpleTodTokenizedShard]:
+        shard_dir = self.get_shard_dir(data_path)
+        try:
+            meta = utils.read_json(shard_dir / "meta.json")
+        except FileNotFoundError:
+            return None
+        if meta.get("format_version") != self.format_version or any(
+            meta.get(k) != v for k, v in self._get_data_file_state(data_path).items()
+        ):
+            return None
+        return SimpleTodTokenizedShard(shard_dir)
+
+    def _iter_row_batches(
+        self, rows: Iterable[SimpleTodTurnCsvRow], desc: str
+    ) -> Iterator[list[SimpleTodTurnCsvRow]]:
+        """Rows batch_size at a time, so the rows of a split are never all held"""
+        rows = iter(tqdm(rows, desc=desc))
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def _tokenize_field(
+        self, texts: list[Optional[str]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Ids and offsets of a field of a batch of rows, missing fields are empty"""
+        lengths = np.zeros(len(texts), dtype=np.int64)
+        chunks = []
+        present = [i for i, text in enumerate(texts) if text is not None]
+        if present:
+            encoded = self.tokenizer([texts[i] for i in present])["input_ids"]
+            for i, ids in zip(present, encoded):
+                lengths[i] = len(ids)
+                chunks.append(np.asarray(ids, dtype=np.int32))
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+        return ids, offsets
+
+    def _tokenize_rows(
+        self, rows: Iterable[SimpleTodTurnCsvRow], desc: str
+    ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Ids and offsets of every field of the rows"""
+        fields = SimpleTodTokenizedShard.fields
+        ids_chunks = {field: [] for field in fields}
+        lengths_chunks = {field: [] for field in fields}
+        for batch in self._iter_row_batches(rows, desc):
+            for field in fields:
+                ids, offsets = self._tokenize_field([getattr(r, field) for r in batch])
+                ids_chunks[field].append(ids)
+                lengths_chunks[field].append(np.diff(offsets))
+        tokenized = {}
+        for field in fields:
+            lengths = np.concatenate(lengths_chunks[field] or [np.zeros(0, np.int64)])
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            ids = np.concatenate(ids_chunks[field] or [np.zeros(0, np.int32)])
+            tokenized[field] = ids, offsets
+        return tokenized
+
+    def _get_context_turns(
+        self, ids: np.ndarray, offsets: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Positions of the user and last user utterance tokens, relative to the row"""
+        turn_token_ids = get_turn_token_ids(self.tokenizer)
+        positions = np.flatnonzero(np.isin(ids, turn_token_ids))
+        rows = np.searchsorted(offsets, positions, side="right") - 1
+        turns = (positions - offsets[rows]).astype(np.int32)
+        turns_offsets = np.zeros(len(offsets), dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(offsets) - 1), out=turns_offsets[1:])
+        return turns, turns_offsets
+
+    def get_lengths(
+        self, data_path: Path, rows: Iterable[SimpleTodTurnCsvRow]
+    ) -> np.ndarray:
+        """
+        Number of tokens of every row, context, target and schema together.
+        Read from the shard if there is one, otherwise computed once and saved
+        in the shard directory. rows are only read when the lengths are computed.
+        """
+        shard = self.load(data_path)
+        if shard is not None:
+            return sum(shard.get_lengths(f) for f in SimpleTodTokenizedShard.fields)
+        shard_dir = self.get_shard_dir(data_path)
+        lengths_path = shard_dir / "lengths.npy"
+        meta_path = shard_dir / "lengths_meta.json"
+        state = self._get_data_file_state(data_path)
+        try:
+            if utils.read_json(meta_path) == state:
+                return np.load(lengths_path)
+        except FileNotFoundError:
+            pass
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        batch_lengths = []
+        desc = f"counting tokens of {data_path.name}"
+        for batch in self._iter_row_batches(rows, desc):
+            batch_lengths.append(
+                sum(
+                    np.diff(self._tokenize_field([getattr(r, field) for r in batch])[1])
+                    for field in SimpleTodTokenizedShard.fields
+                )
+            )
+        lengths = np.concatenate(batch_lengths or [np.zeros(0, np.int64)])
+        np.save(lengths_path, lengths)
+        utils.write_json(state, meta_path)
+        return lengths
+
+    def run(
+        self, data_path: Path, rows: Iterable[SimpleTodTurnCsvRow]
+    ) -> SimpleTodTokenizedShard:
+        shard_dir = self.get_shard_dir(data_path)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        (shard_dir / "meta.json").unlink(missing_ok=True)
+        tokenized = self._tokenize_rows(rows, f"tokenizing {data_path.name}")
+        for field, (ids, offsets) in tokenized.items():
+            np.save(shard_dir / f"{field}_ids.npy", ids)
+            np.save(shard_dir / f"{field}_offsets.npy", offsets)
+            if field == "context":
+                turns, turns_offsets = self._get_context_turns(ids, offsets)
+                np.save(shard_dir / "context_turns.npy", turns)
+                np.save(shard_dir / "context_turns_offsets.npy", turns_offsets)
+        # meta is written last, a shard without it is never loaded
+        meta = {
+            "num_rows": len(tokenized["context"][1]) - 1,
+            "format_version": self.format_version,
+            **self._get_data_file_state(data_path),
+        }
+        utils.write_json(meta, shard_dir / "meta.json")
+        return SimpleTodTokenizedShard(shard_dir)
@@ -0,0 +1,102 @@
+import json
+import math
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from transformers import PreTrainedTokenizerFast
+
+from simple_tod_dataclasses import SimpleTodTurnCsvRow, get_multi_task_special_tokens
+
+
+class TaskGenerationBudgets:
+    """
+    Max new tokens of the rows of every multi task prompt, estimated from the
+    token lengths of the train targets of the task: a quantile of the lengths
+    plus a margin. Saved as json next to the tokenizer of the trained model.
+    """
+
+    file_name = "task_generation_budgets.json"
+
+    def __init__(
+        self,
+        max_new_tokens: Dict[str, int],
+        length_stats: Dict[str, Dict[str, float]] = None,
+    ):
+        self.max_new_tokens = max_new_tokens
+        self.length_stats = length_stats or {}
+
+    @classmethod
+    def from_rows(
+        self,
+        rows: Iterable[SimpleTodTurnCsvRow],
+        tokenizer: PreTrainedTokenizerFast,
+        quantile: float = 1.0,
+        margin: float = 0.1,
+        batch_size: int = 1000,
+    ) -> "TaskGenerationBudgets":
+        prompt_tokens = [mtst.prompt_token.value for mtst in get_multi_task_special_tokens()]
+        lengths: Dict[str, List[int]] = {prompt: [] for prompt in prompt_tokens}
+        prompts, targets = [], []
+
+        def add_batch():
+            tokens = tokenizer(targets, add_special_tokens=False)["input_ids"]
+            for prompt, target_tokens in zip(prompts, tokens):
+                lengths[prompt].append(len(target_tokens))
+            prompts.clear()
+            targets.clear()
+
+        for row in rows:
+            prompt = next((p for p in prompt_tokens if row.context.endswith(p)), None)
+            if prompt is None or not row.target:
+                continue
+            prompts.append(prompt)
+            targets.append(row.target)
+            if len(targets) == batch_size:
+                add_batch()
+        if targets:
+            add_batch()
+
+        max_new_tokens, length_stats = {}, {}
+        for prompt, task_lengths in lengths.items():
+            if not task_lengths:
+                continue
+            task_lengths = np.array(task_lengths)
+            limit = np.quantile(task_lengths, quantile)
+            max_new_tokens[prompt] = math.ceil(limit * (1 + margin))
+            length_stats[prompt] = {
+                "count": len(task_lengths),
+                "mean": float(task_lengths.mean()),
+                "p50": float(np.quantile(task_lengths, 0.5)),
+                "p99": float(np.quantile(task_lengths, 0.99)),
+                "max": int(task_lengths.max()),
+            }
+        return self(max_new_tokens, length_stats)
+
+    def get(self, prompt_token: str, default: int) -> int:
+        return self.max_new_tokens.get(prompt_token, default)
+
+    def save(self, out_dir: Path) -> Path:
+        path = Path(out_dir) / self.file_name
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "max_new_tokens": self.max_new_tokens,
+                    "length_stats": self.length_stats,
+                },
+                f,
+                indent=2,
+            )
+        return path
+
+    @classmethod
+    def load(self, path: Path) -> Optional["TaskGenerationBudgets"]:
+        """None when the budgets were not saved"""
+        path = Path(path)
+        if path.is_dir():
+            path = path / self.file_name
+        if not path.exists():
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return self(data["max_new_tokens"], data.get("length_stats"))
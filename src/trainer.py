@@ -1,20 +1,70 @@
 from omegaconf import DictConfig
 import hydra
+import numpy as np
+import torch
 from transformers import (
     GPT2LMHeadModel,
     Trainer,
     TrainingArguments,
     logging,
 )
+from transformers.trainer_pt_utils import LengthGroupedSampler
 from hydra_configs import DataModuleConfig, InferenceConfig, TrainerConfig
 from inference import Inference
-from my_datamodules import SimpleTodDataModule
+from my_datamodules import SimpleTodDataModule, SimpleTodPaddingReportSampler
+from my_enums import Steps
+from packed_gpt2 import PackedGPT2LMHeadModel
 import os
 import warnings
 
 warnings.filterwarnings("ignore")
 
 
+class SimpleTodLengthAwareTrainer(Trainer):
+    """
+    Trainer that knows the token count of every train row. It can group rows
+    of similar length into the same batches and reports the padding waste of
+    every epoch.
+    """
+
+    def __init__(
+        self,
+        *args,
+        train_lengths: np.ndarray = None,
+        should_group_by_length: bool = False,
+        max_token_len: int = 512,
+        pad_to_multiple_of: int = 8,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.train_lengths = train_lengths
+        self.should_group_by_length = should_group_by_length
+        self.max_token_len = max_token_len
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_lengths is None:
+            return super()._get_train_sampler(*args, **kwargs)
+        if self.should_group_by_length:
+            # seeded, so the batches of a run are reproduced by its seed
+            generator = torch.Generator()
+            generator.manual_seed(self.args.seed)
+            sampler = LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                lengths=self.train_lengths.tolist(),
+                generator=generator,
+            )
+        else:
+            sampler = super()._get_train_sampler(*args, **kwargs)
+        return SimpleTodPaddingReportSampler(
+            sampler,
+            self.train_lengths,
+            self.args.train_batch_size,
+            self.max_token_len,
+            self.pad_to_multiple_of,
+        )
+
+
 class SimpleTODTrainer:
     def __init__(
         self,
@@ -22,16 +72,26 @@ class SimpleTODTrainer:
     ) -> None:
         self.cfg = trainer_config
 
+    def _get_model_class(self) -> type[GPT2LMHeadModel]:
+        if self.cfg.should_pack_rows:
+            return PackedGPT2LMHeadModel
+        return GPT2LMHeadModel
+
     def run(self):
 
-        model = GPT2LMHeadModel.from_pretrained(self.cfg.model_name)
+        model = self._get_model_class().from_pretrained(self.cfg.model_name)
         model.resize_token_embeddings(len(self.cfg.tokenizer))
-        model = model.cuda()
+        model = model.to(self.cfg.device)
 
         dm = SimpleTodDataModule(DataModuleConfig.from_trainer_config(self.cfg))
         self.train(model, dm)
         print("Training done")
         print("-" * 80)
+        task_budgets_path = None
+        if self.cfg.is_multi_task and self.cfg.should_stop_at_task_end:
+            # saved next to the tokenizer, where inference looks for them
+            task_budgets = dm.get_task_budgets()
+            task_budgets_path = str(task_budgets.save(self.cfg.output_dir).resolve())
         if self.cfg.should_test:
             inf = Inference(
                 InferenceConfig(
@@ -50,6 +110,13 @@ class SimpleTODTrainer:
                     domains=self.cfg.domains,
                     num_turns=self.cfg.num_turns,
                     tokenizer=self.cfg.tokenizer,
+                    device=str(self.cfg.device),
+                    is_multi_task=self.cfg.is_multi_task,
+                    should_add_schema=self.cfg.should_add_schema,
+                    data_format=self.cfg.data_format,
+                    should_use_dialog_index=self.cfg.should_use_dialog_index,
+                    should_stop_at_task_end=self.cfg.should_stop_at_task_end,
+                    task_budgets_path=task_budgets_path,
                 )
             )
             inf.test()
@@ -71,16 +138,37 @@ class SimpleTODTrainer:
             weight_decay=0.01,
             logging_dir=self.cfg.logging_dir,
             dataloader_num_workers=self.cfg.num_workers,
-            dataloader_pin_memory=True,
+            dataloader_pin_memory=self.cfg.device.type == "cuda",
+            no_cuda=self.cfg.device.type != "cuda",
+        )
+        train_dataset = dm.cfg.datasets[Steps.TRAIN]
+        eval_dataset = dm.cfg.datasets[Steps.DEV]
+        pretraining_collator = dm.get_training_collator(is_pretrain=True)
+        training_collator = dm.get_training_collator()
+        train_lengths = None
+        if self.cfg.should_pack_rows:
+            train_dataset = dm.get_packed_dataset(Steps.TRAIN)
+            eval_dataset = dm.get_packed_dataset(Steps.DEV)
+            pretraining_collator = dm.get_packing_collator(is_pretrain=True)
+            training_collator = dm.get_packing_collator()
+            train_lengths = train_dataset.lengths
+        elif self.cfg.should_group_by_length or self.cfg.should_pad_dynamically:
+            train_lengths = dm.get_row_lengths(Steps.TRAIN)
+        length_args = dict(
+            train_lengths=train_lengths,
+            should_group_by_length=self.cfg.should_group_by_length,
+            max_token_len=self.cfg.max_token_len,
+            pad_to_multiple_of=self.cfg.pad_to_multiple_of,
         )
 
         # start training
-        pre_trainer = Trainer(
+        pre_trainer = SimpleTodLengthAwareTrainer(
             model=model,
             args=training_args,
-            train_dataset=dm.cfg.datasets["train"],
-            eval_dataset=dm.cfg.datasets["dev"],
-            data_collator=dm.pretraining_collator,
+            train_dataset=train_dataset,
+            eval_dataset=eval_dataset,
+            data_collator=pretraining_collator,
+            **length_args,
         )
         # pre_trainer.pad_token_id = self.cfg.tokenizer.pad_token_id
         if not self.cfg.pretrain_model_path:
@@ -88,15 +176,16 @@ class SimpleTODTrainer:
             pre_trainer.save_model()
         else:
             pretrain_out = self.cfg.project_root / self.cfg.pretrain_model_path
-        model_train = GPT2LMHeadModel.from_pretrained(pretrain_out)
+        model_train = self._get_model_class().from_pretrained(pretrain_out)
         training_args.output_dir = str(self.cfg.output_dir / "train")
         training_args.num_train_epochs = self.cfg.train_epochs
-        trainer = Trainer(
+        trainer = SimpleTodLengthAwareTrainer(
             model=model_train,
             args=training_args,
-            train_dataset=dm.cfg.datasets["train"],
-            eval_dataset=dm.cfg.datasets["dev"],
-            data_collator=dm.training_collator,
+            train_dataset=train_dataset,
+            eval_dataset=eval_dataset,
+            data_collator=training_collator,
+            **length_args,
         )
         # trainer.pad_token_id = self.cfg.tokenizer.pad_token_id
         trainer.train()
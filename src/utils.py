@@ -1,10 +1,14 @@
 import csv
 import json
+import re
+import shutil
 from collections import deque
-from itertools import zip_longest
+from itertools import islice, zip_longest
 from pathlib import Path
 
 from dataclass_csv import DataclassReader
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # from transformers.utils import logging
 import logging
@@ -23,6 +27,88 @@ def write_csv(headers: list[str], data, file_name: Path):
         csvwriter.writerows(data)
 
 
+class CsvRowWriter:
+    """Writes rows to a csv file as they arrive, the same format as write_csv"""
+
+    def __init__(self, headers: list[str], file_name: Path):
+        self.headers = headers
+        self.file_name = file_name
+        self.num_rows = 0
+
+    def __enter__(self):
+        self.file = open(self.file_name, "w", encoding="UTF8", newline="")
+        self.csvwriter = csv.writer(self.file, quoting=csv.QUOTE_NONNUMERIC)
+        self.csvwriter.writerow(self.headers)
+        return self
+
+    def write_rows(self, rows: list[list[any]]):
+        self.csvwriter.writerows(rows)
+        self.num_rows += len(rows)
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+class ParquetRowWriter:
+    """
+    Writes rows to a parquet file as they arrive, buffering at most one row
+    group in memory. Columns are strings unless an arrow schema is given.
+    """
+
+    def __init__(
+        self,
+        headers: list[str],
+        file_name: Path,
+        row_group_size: int = 10000,
+        schema: pa.Schema = None,
+    ):
+        self.headers = headers
+        self.file_name = file_name
+        self.row_group_size = row_group_size
+        self.schema = schema or pa.schema([(h, pa.string()) for h in headers])
+        self.buffer = []
+        self.num_rows = 0
+
+    def __enter__(self):
+        self.writer = pq.ParquetWriter(
+            self.file_name, self.schema, compression="zstd"
+        )
+        return self
+
+    def _flush(self):
+        columns = list(zip(*self.buffer))
+        self.writer.write_table(
+            pa.table(
+                [
+                    pa.array(col, type=field.type)
+                    for col, field in zip(columns, self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+        self.buffer = []
+
+    def write_rows(self, rows: list[list[any]]):
+        for row in rows:
+            # rows without a schema leave out the trailing column, like in csv
+            self.buffer.append(list(row) + [None] * (len(self.headers) - len(row)))
+            if len(self.buffer) == self.row_group_size:
+                self._flush()
+        self.num_rows += len(rows)
+
+    def __exit__(self, *args):
+        if self.buffer:
+            self._flush()
+        self.writer.close()
+
+
+def remove_path(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
 def write_json(data: list[any], path: str):
     with open(path, "w") as f:
         json.dump(data, f)
@@ -46,9 +132,13 @@ def read_csv(path: str):
 
 
 def read_csv_dataclass(path: str, d_class):
+    return list(iter_csv_dataclass(path, d_class))
+
+
+def iter_csv_dataclass(path: str, d_class, max_rows: int = None):
+    """Stops reading after max_rows rows, all rows are read when it is None"""
     with open(path) as f:
-        reader = DataclassReader(f, d_class)
-        return [r for r in reader]
+        yield from islice(DataclassReader(f, d_class), max_rows)
 
 
 def get_num_items(num, max_value):
@@ -70,3 +160,13 @@ def grouper(iterable, n=2, fillvalue=None):
     # iterable.appendleft(None)
     args = [iter(iterable)] * n
     return zip_longest(fillvalue=fillvalue, *args)
+
+
+def replace_all(text: str, replacements: dict[str, str]) -> str:
+    # single left to right pass, at each position the longest matching key wins
+    if not replacements:
+        return text
+    pattern = re.compile(
+        "|".join(map(re.escape, sorted(replacements, key=len, reverse=True)))
+    )
+    return pattern.sub(lambda match: replacements[match.group(0)], text)
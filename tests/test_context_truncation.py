@@ -0,0 +1,89 @@
+import pytest
+
+import os
+import sys
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from my_enums import ContextTruncation
+from simple_tod_collators import SimpleTodCollator
+from simple_tod_dataclasses import (
+    SimpleTodTurnCsvRow,
+    render_context,
+    render_context_turn,
+)
+from simple_tod_tokenized_data import SimpleTodTokenizedDataPrep
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return dstc_utils.get_tokenizer()
+
+
+@pytest.fixture(scope="module")
+def collator(tokenizer):
+    return SimpleTodCollator(tokenizer, 1024, context_truncation=ContextTruncation.TURNS)
+
+
+def get_context(num_turns: int) -> str:
+    history = "".join(
+        render_context_turn(f"user says {i} " * 3, f"system says {i} " * 2)
+        for i in range(num_turns)
+    )
+    return render_context(history, "book a table", False)
+
+
+def get_context_tokens(tokenizer, num_turns: int) -> np.ndarray:
+    return np.array(tokenizer.encode(get_context(num_turns)))
+
+
+def test_turns_drops_exactly_one_turn(tokenizer, collator):
+    tokens = get_context_tokens(tokenizer, 3)
+    starts = collator.get_context_turn_starts(tokens)
+    first_turn_len = starts[1] - starts[0]
+    for overflow in (1, first_turn_len):
+        out = collator.truncate_context(tokens, overflow, starts)
+        assert out.tolist() == tokens[: starts[0]].tolist() + tokens[starts[1] :].tolist()
+
+
+def test_turns_short_history_falls_back_to_token_cut(tokenizer, collator):
+    tokens = get_context_tokens(tokenizer, 2)
+    starts = collator.get_context_turn_starts(tokens)
+    history_len = starts[-1] - starts[0]
+    overflow = history_len + 3
+    out = collator.truncate_context(tokens, overflow, starts)
+    without_history = np.concatenate([tokens[: starts[0]], tokens[starts[-1] :]])
+    assert len(out) == len(tokens) - overflow
+    assert out.tolist() == without_history[:2].tolist() + without_history[5:].tolist()
+
+
+def test_turns_without_history_cuts_tokens(tokenizer, collator):
+    tokens = get_context_tokens(tokenizer, 0)
+    tokens_collator = SimpleTodCollator(tokenizer, 1024)
+    starts = collator.get_context_turn_starts(tokens)
+    assert len(starts) == 1
+    out = collator.truncate_context(tokens, 3, starts)
+    assert out.tolist() == tokens_collator.truncate_context(tokens, 3).tolist()
+    assert len(out) == len(tokens) - 3
+
+
+def test_shard_turn_starts_match_collator(tokenizer, collator, tmp_path):
+    data_path = tmp_path / "data.csv"
+    data_path.write_text("")
+    rows = [
+        SimpleTodTurnCsvRow("1", str(i), get_context(i), "target") for i in range(4)
+    ] + [SimpleTodTurnCsvRow("1", "5", "")]
+    shard = SimpleTodTokenizedDataPrep(tokenizer).run(data_path, rows)
+    for i in range(len(rows)):
+        assert (
+            shard.get_context_turn_starts(i).tolist()
+            == collator.get_context_turn_starts(shard.get("context", i)).tolist()
+        )
+
+
+def test_turns_without_turn_starts_raises(tokenizer, collator):
+    with pytest.raises(ValueError):
+        collator.truncate_context(get_context_tokens(tokenizer, 2), 3)
@@ -0,0 +1,42 @@
+import pytest
+
+import os
+import sys
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+from csv_row_index import CsvRowIndex
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+import utils
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "data.csv"
+    with utils.CsvRowWriter(["dialog_id", "turn_id", "context", "target", "schema"], path) as w:
+        w.write_rows(
+            [
+                ["1_1", "1", "line one\nline two", "target, with comma", ""],
+                ["1_1", "2", 'a "quoted"\r\nword', "", "schema"],
+                ["2_1", "1", "ünïcode", "t", "s"],
+            ]
+        )
+    return path
+
+
+def test_rows_match_csv_reader(csv_path):
+    from my_datamodules import SimpleTodLazyCsvDataSet
+
+    expected = utils.read_csv_dataclass(csv_path, SimpleTodTurnCsvRow)
+    dataset = SimpleTodLazyCsvDataSet(CsvRowIndex(csv_path))
+    assert [dataset[i] for i in reversed(range(len(dataset)))] == expected[::-1]
+    assert len(SimpleTodLazyCsvDataSet(CsvRowIndex(csv_path), 0.7)) == 2
+
+
+def test_index_is_rebuilt_when_csv_changes(csv_path):
+    assert len(CsvRowIndex(csv_path)) == 3
+    with open(csv_path, "a", newline="") as f:
+        f.write('"3_1","1","new\nrow","",""\r\n')
+    index = CsvRowIndex(csv_path)
+    assert len(index) == 4
+    assert index.get(3)["context"] == "new\nrow"
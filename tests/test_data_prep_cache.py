@@ -0,0 +1,20 @@
+import pytest
+
+import os
+import sys
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+from data_prep_cache import DataPrepCache
+from hydra_configs import DataPrepConfig
+
+
+def test_put_keeps_the_cache_under_max_size(tmp_path):
+    cache = DataPrepCache(DataPrepConfig(str(tmp_path), "data", "out"))
+    cache.max_size = 3000
+    rows = [["1", "1", "context " * 100, "target"]]
+    for i in range(10):
+        cache.put(str(i), rows)
+        assert cache._get_size() <= cache.max_size
+        assert cache.get(str(i)) == rows
+    assert not cache.contains("0")
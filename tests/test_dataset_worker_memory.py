@@ -0,0 +1,52 @@
+import pytest
+
+import os
+import sys
+from typing import Iterator
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+from my_datamodules import SimpleTodArrayDataSet
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+import utils
+
+
+def get_rows(num_rows: int) -> Iterator[SimpleTodTurnCsvRow]:
+    for i in range(num_rows):
+        yield SimpleTodTurnCsvRow(
+            f"{i}_00000", str(i % 20), f"<|context|> user {i} " * 20, f"target {i} " * 10
+        )
+
+
+def test_array_dataset_holds_no_row_objects():
+    # forked workers only read these arrays, python objects of the rows would be
+    # copied into every worker by refcount and garbage collector writes
+    dataset = SimpleTodArrayDataSet(get_rows(1000))
+    assert set(vars(dataset)) == {"buffers", "offsets", "nulls", "num_rows"}
+    for arrays in (dataset.buffers, dataset.offsets, dataset.nulls):
+        assert set(arrays) == set(SimpleTodArrayDataSet.fields)
+        assert all(
+            isinstance(array, np.ndarray) and array.dtype != object
+            for array in arrays.values()
+        )
+
+
+def test_array_dataset_rows():
+    rows = list(get_rows(100)) + [SimpleTodTurnCsvRow("1", "1", "")]
+    dataset = SimpleTodArrayDataSet(rows)
+    assert [dataset[i] for i in range(len(dataset))] == rows
+
+
+def test_array_dataset_from_csv_reads_only_the_split(tmp_path):
+    rows = list(get_rows(10))
+    path = tmp_path / "data.csv"
+    with utils.CsvRowWriter(["dialog_id", "turn_id", "context", "target"], path) as writer:
+        writer.write_rows([[r.dialog_id, r.turn_id, r.context, r.target] for r in rows])
+    dataset = SimpleTodArrayDataSet.from_csv(path, 0.35)
+    assert len(dataset) == 3
+    # the rows after the split are never stored
+    assert len(dataset.offsets["context"]) == 4
+    assert [dataset[i] for i in range(len(dataset))] == rows[:3]
+    assert len(SimpleTodArrayDataSet.from_csv(path)) == 10
@@ -0,0 +1,114 @@
+import pytest
+
+import json
+import os
+import sys
+from dataclasses import asdict
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+from dstc_dataclasses import DstcDialog, DstcSchema
+
+
+@pytest.fixture
+def dialog_dict():
+    return {
+        "dialogue_id": "1_00000",
+        "services": ["Restaurants_1"],
+        "turns": [
+            {
+                "frames": [
+                    {
+                        "actions": [
+                            {
+                                "act": "INFORM_INTENT",
+                                "canonical_values": ["FindRestaurants"],
+                                "slot": "intent",
+                                "values": ["FindRestaurants"],
+                            }
+                        ],
+                        "service": "Restaurants_1",
+                        "slots": [],
+                        "state": {
+                            "active_intent": "FindRestaurants",
+                            "requested_slots": [],
+                            "slot_values": {"city": ["San Jose"]},
+                        },
+                    }
+                ],
+                "speaker": "USER",
+                "utterance": "I want to find a place to eat in San Jose.",
+            },
+            {
+                "frames": [
+                    {
+                        "actions": [
+                            {
+                                "act": "REQUEST",
+                                "canonical_values": [],
+                                "slot": "cuisine",
+                                "values": [],
+                            }
+                        ],
+                        "service": "Restaurants_1",
+                        "service_call": {"method": "FindRestaurants"},
+                        "service_results": [],
+                        "slots": [],
+                    }
+                ],
+                "speaker": "SYSTEM",
+                "utterance": "What kind of food would you like?",
+            },
+        ],
+    }
+
+
+@pytest.fixture
+def schema_dict():
+    return {
+        "service_name": "Restaurants_1",
+        "description": "A leading provider for restaurant search and reservations",
+        "slots": [
+            {
+                "name": "city",
+                "description": "City in which the restaurant is located",
+                "is_categorical": False,
+                "possible_values": [],
+            },
+            {
+                "name": "price_range",
+                "description": "Price range for the restaurant",
+                "is_categorical": True,
+                "possible_values": ["cheap", "moderate", "pricey"],
+            },
+        ],
+        "intents": [
+            {
+                "name": "FindRestaurants",
+                "description": "Find a restaurant of a particular cuisine in a city",
+                "is_transactional": False,
+                "required_slots": ["city"],
+                "optional_slots": {"price_range": "dontcare"},
+                "result_slots": ["city", "price_range"],
+            }
+        ],
+    }
+
+
+class TestRawDictLoaders:
+    def test_dialog_matches_from_json(self, dialog_dict):
+        expected = DstcDialog.from_json(json.dumps(dialog_dict))
+        dialog = DstcDialog.from_raw_dict(dialog_dict)
+        assert asdict(dialog) == asdict(expected)
+        assert dialog.short_services == expected.short_services == ["Restaurants"]
+        assert [f.short_service for t in dialog.turns for f in t.frames] == [
+            "Restaurants",
+            "Restaurants",
+        ]
+        assert dialog.turns[1].frames[0].state is None
+
+    def test_schema_matches_from_json(self, schema_dict):
+        expected = DstcSchema.from_json(json.dumps(schema_dict))
+        schema = DstcSchema.from_raw_dict(schema_dict)
+        assert asdict(schema) == asdict(expected)
+        assert str(schema) == str(expected)
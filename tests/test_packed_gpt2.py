@@ -0,0 +1,70 @@
+import pytest
+
+import os
+import sys
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+from transformers.models.gpt2.modeling_gpt2 import GPT2Attention
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+from packed_gpt2 import PackedGPT2Attention, PackedGPT2LMHeadModel
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=50, n_positions=32, n_embd=16, n_layer=2, n_head=2)
+    return PackedGPT2LMHeadModel(config).eval()
+
+
+def test_packed_rows_match_unpacked_rows(model):
+    rows = [torch.randint(0, 50, [n]) for n in (5, 9, 3)]
+    max_len = 20
+    input_ids = torch.zeros([1, max_len], dtype=torch.int64)
+    position_ids = torch.zeros([1, max_len], dtype=torch.int64)
+    segment_ids = torch.zeros([1, max_len], dtype=torch.int64)
+    start = 0
+    for segment_id, row in enumerate(rows, 1):
+        end = start + len(row)
+        input_ids[0, start:end] = row
+        position_ids[0, start:end] = torch.arange(len(row))
+        segment_ids[0, start:end] = segment_id
+        start = end
+
+    with torch.no_grad():
+        packed = model(
+            input_ids=input_ids, position_ids=position_ids, segment_ids=segment_ids
+        ).logits[0]
+        start = 0
+        for row in rows:
+            unpacked = model(input_ids=row[None]).logits[0]
+            assert torch.allclose(packed[start : start + len(row)], unpacked, atol=1e-5)
+            start += len(row)
+
+
+def test_weights_load_in_gpt2(model, tmp_path):
+    model.save_pretrained(tmp_path)
+    gpt2 = GPT2LMHeadModel.from_pretrained(tmp_path).eval()
+    input_ids = torch.randint(0, 50, [2, 7])
+    with torch.no_grad():
+        assert torch.allclose(
+            model(input_ids=input_ids).logits, gpt2(input_ids=input_ids).logits, atol=1e-5
+        )
+
+
+def test_packed_forward_raises_when_attn_is_skipped(model, monkeypatch):
+    # as in transformers versions that compute attention without the override
+    monkeypatch.setattr(PackedGPT2Attention, "_attn", GPT2Attention._attn)
+    input_ids = torch.randint(0, 50, [1, 6])
+    segment_ids = torch.tensor([[1, 1, 1, 2, 2, 2]])
+    with pytest.raises(RuntimeError):
+        model(input_ids=input_ids, segment_ids=segment_ids)
+
+
+def test_reorder_and_upcast_attn_is_rejected():
+    config = GPT2Config(vocab_size=50, n_positions=32, n_embd=16, n_layer=1, n_head=2)
+    config.reorder_and_upcast_attn = True
+    with pytest.raises(ValueError):
+        PackedGPT2LMHeadModel(config)
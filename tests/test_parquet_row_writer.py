@@ -0,0 +1,24 @@
+import pytest
+
+import os
+import sys
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+from my_datamodules import SimpleTodArrowDataSet
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+import utils
+
+
+def test_rows_without_schema_are_written_with_a_null_schema(tmp_path):
+    path = tmp_path / "data.parquet"
+    headers = ["dialog_id", "turn_id", "context", "target", "schema"]
+    with utils.ParquetRowWriter(headers, path, row_group_size=2) as writer:
+        writer.write_rows([["1", "1", "c1", "t1", "s1"], ["1", "2", "c2", "t2"]])
+        writer.write_rows([["2", "1", "c3", "t3"]])
+    dataset = SimpleTodArrowDataSet.from_parquet(path)
+    assert [dataset[i] for i in range(len(dataset))] == [
+        SimpleTodTurnCsvRow("1", "1", "c1", "t1", "s1"),
+        SimpleTodTurnCsvRow("1", "2", "c2", "t2", None),
+        SimpleTodTurnCsvRow("2", "1", "c3", "t3", None),
+    ]
@@ -0,0 +1,31 @@
+import pytest
+
+import os
+import sys
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from my_enums import SpecialTokens
+from segment_token_cache import SegmentTokenCache
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return dstc_utils.get_tokenizer()
+
+
+def test_ids_match_tokenizer_past_max_segments(tokenizer):
+    cache = SegmentTokenCache(tokenizer, max_segments=2, sample_every=0)
+    sep = SpecialTokens.user.value
+    texts = [
+        f"book a{sep}table",
+        f"book a{sep}for two",
+        # more new segments than the cache holds
+        f"at seven{sep}in the{sep}city{sep}center",
+        f"center{sep}book a{sep}city",
+    ]
+    for text in texts:
+        assert cache.encode(text) == tokenizer.encode(text)
+        assert len(cache.segments) <= 2
+    assert cache.hits > 0
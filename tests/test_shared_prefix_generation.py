@@ -0,0 +1,218 @@
+import pytest
+
+import os
+import sys
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from hydra_configs import InferenceConfig
+from inference import Inference
+from simple_tod_generation import (
+    ContinuousBatchingGenerator,
+    IncrementalDialogueGenerator,
+    SharedPrefixGenerator,
+    TaskEndStoppingCriteria,
+    TaskStop,
+)
+
+EOS, PAD = 1, 0
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=50, n_positions=64, n_embd=16, n_layer=2, n_head=2)
+    return GPT2LMHeadModel(config).eval()
+
+
+def greedy_alone(
+    model, row: torch.Tensor, max_new_tokens: int, eos_token_id: int = EOS
+) -> list[int]:
+    with torch.no_grad():
+        out = model.generate(
+            input_ids=row[None],
+            attention_mask=torch.ones_like(row[None]),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            num_beams=1,
+            eos_token_id=eos_token_id,
+            pad_token_id=PAD,
+        )
+    return out[0, len(row) :].tolist()
+
+
+def test_rows_match_greedy_generation_alone(model):
+    context = torch.randint(2, 50, [12])
+    prompts = torch.arange(40, 45)
+    rows = [torch.cat([context, prompt[None], torch.tensor([EOS])]) for prompt in prompts]
+    rows.append(torch.randint(2, 50, [7]))
+    max_len = max(map(len, rows))
+    context_tokens = torch.full([len(rows), max_len], PAD)
+    attention_mask = torch.zeros([len(rows), max_len], dtype=torch.int64)
+    for i, row in enumerate(rows):
+        context_tokens[i, : len(row)] = row
+        attention_mask[i, : len(row)] = 1
+
+    generator = SharedPrefixGenerator(model, EOS, PAD, max_new_tokens=10)
+    out = generator.generate(
+        context_tokens, attention_mask, [("1", "1")] * len(prompts) + [("2", "1")]
+    )
+    for i, row in enumerate(rows):
+        tokens = out[i, max_len:].tolist()
+        expected = greedy_alone(model, row, 10)
+        assert tokens[: len(expected)] == expected
+        assert all(t == PAD for t in tokens[len(expected) :])
+    # the shared context is encoded once for the five prompt rows
+    assert generator.num_encoded_tokens < sum(map(len, rows)) + 10 * len(rows)
+
+
+def get_dialogue_rows(num_turns: int, window: int) -> list[tuple]:
+    """Multi task rows of one dialogue, token ids laid out like the contexts"""
+    bos, begin_context, user, system, begin_last, end_last = 2, 3, 4, 5, 6, 7
+    utterances = [
+        (torch.randint(10, 40, [3]), torch.randint(10, 40, [4])) for _ in range(num_turns)
+    ]
+    rows = []
+    for turn in range(num_turns):
+        history = [
+            torch.cat([torch.tensor([user]), u, torch.tensor([system]), s])
+            for u, s in utterances[max(0, turn - window) : turn]
+        ]
+        context = torch.cat(
+            [
+                torch.tensor([bos, begin_context]),
+                *history,
+                torch.tensor([begin_last]),
+                utterances[turn][0],
+                torch.tensor([end_last]),
+            ]
+        )
+        for prompt in range(40, 45):
+            rows.append((("1", str(turn)), torch.cat([context, torch.tensor([prompt, EOS])])))
+    return rows
+
+
+def test_incremental_generation_matches_shared_prefix(model):
+    rows = get_dialogue_rows(num_turns=6, window=3)
+    generators = [
+        SharedPrefixGenerator(model, EOS, PAD, max_new_tokens=5),
+        IncrementalDialogueGenerator(model, EOS, PAD, max_new_tokens=5),
+    ]
+    outputs = []
+    for generator in generators:
+        out = []
+        # batches split the rows of a turn
+        for start in range(0, len(rows), 7):
+            batch = rows[start : start + 7]
+            max_len = max(len(row) for _, row in batch)
+            context_tokens = torch.full([len(batch), max_len], PAD)
+            attention_mask = torch.zeros([len(batch), max_len], dtype=torch.int64)
+            for i, (_, row) in enumerate(batch):
+                context_tokens[i, : len(row)] = row
+                attention_mask[i, : len(row)] = 1
+            gen = generator.generate(
+                context_tokens, attention_mask, [key for key, _ in batch]
+            )
+            out.extend(gen[:, max_len:].tolist())
+        outputs.append([[t for t in tokens if t != PAD] for tokens in out])
+    assert outputs[0] == outputs[1]
+    assert generators[1].num_reused_tokens > 0
+    assert generators[1].num_encoded_tokens < generators[0].num_encoded_tokens
+
+
+def test_rows_stop_at_task_end_token_and_budget(model):
+    # an eos outside of the vocabulary is never generated
+    eos = 50
+    context = torch.randint(2, 40, [12])
+    rows = [torch.cat([context, torch.tensor([prompt])]) for prompt in (40, 41, 42)]
+    expected = [greedy_alone(model, row, 10, eos) for row in rows]
+    end_token_id = expected[0][2]
+    task_stops = {
+        40: TaskStop(end_token_id=end_token_id, max_new_tokens=10),
+        41: TaskStop(end_token_id=eos, max_new_tokens=4),
+    }
+    generator = SharedPrefixGenerator(model, eos, PAD, 10, task_stops)
+    context_tokens = torch.stack(rows)
+    out = generator.generate(
+        context_tokens, torch.ones_like(context_tokens), [("1", "1")] * len(rows)
+    )
+    stopped = [
+        expected[0][: expected[0].index(end_token_id) + 1],
+        expected[1][:4],
+        expected[2],
+    ]
+    context_len = len(rows[0])
+    for tokens, expected_tokens in zip(out[:, context_len:].tolist(), stopped):
+        assert tokens == expected_tokens + [PAD] * (len(tokens) - len(expected_tokens))
+
+    # generate on the batch keeps running the rows that stopped
+    gen = torch.cat([context_tokens, torch.tensor(expected)], dim=1)
+    stopping_criteria = TaskEndStoppingCriteria(
+        context_len, torch.tensor([end_token_id, eos, eos]), torch.tensor([10, 4, 10]), eos
+    )
+    assert stopping_criteria(gen, None)
+    assert not stopping_criteria(gen[:, : context_len + 2], None)
+    gen = stopping_criteria.pad_after_stop(gen, PAD)
+    for tokens, expected_tokens in zip(gen[:, context_len:].tolist(), stopped):
+        assert tokens == expected_tokens + [PAD] * (10 - len(expected_tokens))
+
+
+def test_continuous_batching_matches_greedy_generation_alone(model):
+    eos = 50
+    # rows of the tasks stop at different steps
+    budgets = {40: 2, 41: 7, 42: 3, 43: 9, 44: 5}
+    task_stops = {prompt: TaskStop(eos, budget) for prompt, budget in budgets.items()}
+    rows = get_dialogue_rows(num_turns=3, window=2)
+    rows += [(("2", str(i)), torch.randint(10, 40, [3 + i])) for i in range(6)]
+    batches, expected = [], []
+    for start in range(0, len(rows), 4):
+        batch = rows[start : start + 4]
+        max_len = max(len(row) for _, row in batch)
+        context_tokens = torch.full([len(batch), max_len], PAD)
+        attention_mask = torch.zeros([len(batch), max_len], dtype=torch.int64)
+        for i, (_, row) in enumerate(batch):
+            context_tokens[i, : len(row)] = row
+            attention_mask[i, : len(row)] = 1
+            max_new_tokens = budgets.get(row[-2].item(), 11)
+            expected.append(greedy_alone(model, row, max_new_tokens, eos))
+        batches.append((context_tokens, attention_mask, [key for key, _ in batch]))
+
+    generator = ContinuousBatchingGenerator(model, eos, PAD, 11, task_stops, num_slots=3)
+    outputs = []
+    for (context_tokens, _, _), gen in zip(batches, generator.generate_batches(batches)):
+        assert torch.equal(gen[:, : context_tokens.shape[1]], context_tokens)
+        outputs.extend(gen[:, context_tokens.shape[1] :].tolist())
+    assert len(outputs) == len(rows)
+    for tokens, expected_tokens in zip(outputs, expected):
+        assert tokens[: len(expected_tokens)] == expected_tokens
+        assert all(t == PAD for t in tokens[len(expected_tokens) :])
+
+
+def test_decoded_predictions_have_no_padding(tmp_path):
+    tokenizer = dstc_utils.get_tokenizer()
+    inf = Inference.__new__(Inference)
+    inf.cfg = InferenceConfig(
+        project_root=str(tmp_path),
+        model=None,
+        tokenizer=tokenizer,
+        predictions_log_dir=str(tmp_path / "logs"),
+        device="cpu",
+    )
+    generated = [
+        tokenizer.encode("<|beginintent|>FindBus<|endintent|>", add_special_tokens=False),
+        tokenizer.encode("<|beginbelief|>Buses^from^NY<|endbelief|>", add_special_tokens=False),
+    ]
+    generator = SharedPrefixGenerator(
+        None, tokenizer.eos_token_id, inf._get_token_id(tokenizer.pad_token), 10
+    )
+    context_tokens = torch.full([2, 4], tokenizer.pad_token_id)
+    gen = generator.get_output(context_tokens, generated)
+    pred_text = tokenizer.batch_decode(gen[:, 4:], skip_special_tokens=False)
+    assert pred_text[0] != tokenizer.decode(generated[0])
+    assert [inf._remove_padding(text) for text in pred_text] == [
+        tokenizer.decode(tokens) for tokens in generated
+    ]
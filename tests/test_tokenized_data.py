@@ -0,0 +1,35 @@
+import pytest
+
+import os
+import sys
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(myPath + "/../src"))
+import dstc_utils
+from simple_tod_dataclasses import SimpleTodTurnCsvRow
+from simple_tod_tokenized_data import SimpleTodTokenizedDataPrep, SimpleTodTokenizedShard
+
+
+def test_shard_in_batches_matches_tokenizer(tmp_path):
+    tokenizer = dstc_utils.get_tokenizer()
+    data_path = tmp_path / "data.csv"
+    data_path.write_text("")
+    rows = [
+        SimpleTodTurnCsvRow("1", str(i), f"<|context|>user {i} " * (i % 4), f"target {i}")
+        for i in range(10)
+    ] + [SimpleTodTurnCsvRow("2", "1", "")]
+    # batches of 3 rows, so fields and turns are joined across batches
+    tokenized_data_prep = SimpleTodTokenizedDataPrep(tokenizer, batch_size=3)
+    lengths = tokenized_data_prep.get_lengths(data_path, iter(rows))
+    shard = tokenized_data_prep.run(data_path, iter(rows))
+    assert len(shard) == len(rows)
+    for field in SimpleTodTokenizedShard.fields:
+        for i, row in enumerate(rows):
+            text = getattr(row, field)
+            expected = tokenizer.encode(text) if text is not None else []
+            assert shard.get(field, i).tolist() == expected
+    assert np.array_equal(
+        lengths, sum(shard.get_lengths(f) for f in SimpleTodTokenizedShard.fields)
+    )